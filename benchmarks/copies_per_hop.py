@@ -0,0 +1,212 @@
+"""
+Compares the memory copied by each step of a hop when the messages are carried as bytes (and views of bytes) to the
+text-based handling it replaced, for messages shaped like the ones relayed by the network.
+
+The copies are the peak of the memory allocated by a step (traced with tracemalloc), divided by the size of the
+message: a step copying the message twice, even one copy at a time, shows about 1, a step holding two copies at
+once shows about 2.
+
+Usage: python -m benchmarks.copies_per_hop
+"""
+import os
+import re
+import timeit
+import tracemalloc
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from benchmarks.http_parser import (
+    LEGACY_REQUEST_REGEX,
+    SERVER_HEADERS,
+    _html_body,
+    _json_body,
+)
+from domain.crypto import decrypt_using_symmetric_key, encrypt_using_symmetric_key
+from domain.http_message import (
+    _prepare_http_request,
+    response_object_to_raw_http_message,
+)
+from domain.tor_message import decode_tor_message_for_final_node, peel_response
+
+AEAD_NONCE_SIZE = 12
+
+# The number of layers peeled off a response by a client (one per node of the path)
+PATH_LENGTH = 3
+
+MESSAGE_SIZES = (1024 * 1024, 8 * 1024 * 1024)
+
+
+def _session_key() -> bytes:
+    # An AES-256-GCM session key, as derived by the x25519-aes256gcm cipher suite
+    return b"\x02" + AESGCM.generate_key(bit_length=256)
+
+
+def _legacy_encrypt(message: bytes, sym_key: bytes) -> bytes:
+    nonce = os.urandom(AEAD_NONCE_SIZE)
+    return nonce + AESGCM(sym_key[1:]).encrypt(nonce, message, None)
+
+
+def _legacy_decrypt(message: bytes, sym_key: bytes) -> bytes:
+    return AESGCM(sym_key[1:]).decrypt(
+        message[:AEAD_NONCE_SIZE], message[AEAD_NONCE_SIZE:], None
+    )
+
+
+def _legacy_decode_for_final_node(message: bytes) -> bytes:
+    return message[1:]
+
+
+def _request(size: int) -> bytes:
+    # An HTML body, the legacy regex takes the lines of a body holding a colon for headers
+    body = _html_body(size)
+    head = (
+        "PUT /pages/index.html HTTP/1.1\r\nHost: www.example.com\r\n"
+        f"Content-Type: text/html\r\nContent-Length: {len(body)}\r\n\r\n"
+    )
+    return (head + body).encode("utf-8")
+
+
+def _response(size: int) -> Response:
+    # A response as returned by requests to an exit node
+    response = Response()
+    response.status_code = 200
+    response.reason = "OK"
+    response.url = "https://api.example.com/items"
+    response.headers = CaseInsensitiveDict(SERVER_HEADERS)
+    response.encoding = "utf-8"
+    response._content = _json_body(size).encode("utf-8")
+    return response
+
+
+def legacy_exit_request(message: bytes, sym_key: bytes):
+    # The decrypted request was decoded, parsed with a regex, and its body encoded again by http.client
+    text = _legacy_decode_for_final_node(message).decode("utf-8")
+    text = text.replace("\r", "")
+    re.match(LEGACY_REQUEST_REGEX, text, re.MULTILINE)
+    # The body group of the regex, a copy of the end of the text
+    body = text[text.index("\n\n") + 2 :]
+    return body.encode("latin-1")
+
+
+def exit_request(message: bytes, sym_key: bytes):
+    # The body handed to the HTTP library is a view of the decrypted message
+    return _prepare_http_request(decode_tor_message_for_final_node(message))[3]
+
+
+def legacy_exit_response(response: Response, sym_key: bytes):
+    headers = "\r\n".join(f"{k}: {v}" for k, v in response.headers.items())
+    raw_message = (
+        f"{response.status_code} {response.reason} {response.url}\r\n{headers}"
+        f"\r\n\r\n{response.text}"
+    )
+    return _legacy_encrypt(raw_message.encode("utf-8"), sym_key)
+
+
+def exit_response(response: Response, sym_key: bytes):
+    return encrypt_using_symmetric_key(
+        response_object_to_raw_http_message(response), sym_key
+    )
+
+
+def legacy_relay(message: bytes, sym_key: bytes):
+    return _legacy_decode_for_final_node(_legacy_decrypt(message, sym_key))
+
+
+def relay(message: bytes, sym_key: bytes):
+    return decode_tor_message_for_final_node(
+        decrypt_using_symmetric_key(message, sym_key)
+    )
+
+
+def legacy_client_peel(response: bytes, sym_keys):
+    for sym_key in sym_keys[::-1]:
+        response = _legacy_decrypt(response, sym_key)
+
+    return response.decode("utf-8")
+
+
+def client_peel(response: bytes, sym_keys):
+    return peel_response(response, sym_keys)
+
+
+def _copies(function, argument, key, size: int) -> float:
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = function(argument, key)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return (peak - baseline) / size
+
+
+def _time_per_call(function, argument, key) -> float:
+    timer = timeit.Timer(lambda: function(argument, key))
+    return min(timer.repeat(5, 1))
+
+
+def _steps(size: int):
+    sym_key = _session_key()
+    sym_keys = [_session_key() for _ in range(PATH_LENGTH)]
+    request = b"\x01" + _request(size)
+    response = _response(size)
+    encrypted_request = encrypt_using_symmetric_key(request, sym_key)
+    encrypted_response = response_object_to_raw_http_message(response)
+
+    for key in sym_keys:
+        encrypted_response = encrypt_using_symmetric_key(encrypted_response, key)
+
+    encrypted_response = bytes(encrypted_response)
+
+    return {
+        "exit: request to origin": (
+            legacy_exit_request,
+            exit_request,
+            request,
+            sym_key,
+        ),
+        "exit: response to circuit": (
+            legacy_exit_response,
+            exit_response,
+            response,
+            sym_key,
+        ),
+        "node: peel one layer": (
+            legacy_relay,
+            relay,
+            bytes(encrypted_request),
+            sym_key,
+        ),
+        f"client: peel {PATH_LENGTH} layers": (
+            legacy_client_peel,
+            client_peel,
+            encrypted_response,
+            sym_keys,
+        ),
+    }
+
+
+def main():
+    print(
+        f"{'step':<28}{'size':>10}{'copies (text)':>15}{'copies (bytes)':>16}"
+        f"{'time (text)':>14}{'time (bytes)':>14}"
+    )
+
+    for size in MESSAGE_SIZES:
+        for name, (legacy_step, step, argument, key) in _steps(size).items():
+            legacy_copies = _copies(legacy_step, argument, key, size)
+            copies = _copies(step, argument, key, size)
+            legacy_time = _time_per_call(legacy_step, argument, key)
+            step_time = _time_per_call(step, argument, key)
+
+            print(
+                f"{name:<28}{size:>10}{legacy_copies:>15.2f}{copies:>16.2f}"
+                f"{legacy_time * 1e3:>12.2f}ms{step_time * 1e3:>12.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
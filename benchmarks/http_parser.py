@@ -0,0 +1,171 @@
+"""
+Compares the byte-level HTTP parser (domain.http_parser) to the regex-based parsing it replaced, on a corpus of
+requests and responses shaped like the ones relayed by the network.
+
+Usage: python -m benchmarks.http_parser
+"""
+import json
+import re
+import timeit
+
+from domain.http_message import (
+    extract_data_from_http_raw_request,
+    extract_data_from_http_raw_response,
+)
+from models import RawHttpRequest, RawHttpResponse
+
+# The regexes used to parse the messages before the byte-level parser
+LEGACY_REQUEST_REGEX = r"([A-Z]+)\s(\S*)\sHTTP\/([1-2](?:.[0-2])?)\s(?:(?:Host:\s(.*))\n)?((?:[\S ]*:[\S ]*\s?)*)(?:\s\s([\s\S]*))?"
+LEGACY_RESPONSE_REGEX = (
+    r"([0-9]{3}) ([a-zA-Z]*)\s(\S*)(?:\n((?:[\S ]*:[\S ]*\s?)*))(?:\s([\s\S]*))?"
+)
+
+BROWSER_HEADERS = {
+    "Host": "www.example.com",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:131.0) Gecko/20100101 Firefox/131.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Cookie": "; ".join(f"cookie{i}=" + "v" * 40 for i in range(20)),
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+}
+
+SERVER_HEADERS = {
+    "Date": "Sun, 18 Oct 2026 07:30:31 GMT",
+    "Server": "nginx/1.27.2",
+    "Content-Type": "text/html; charset=utf-8",
+    "Cache-Control": "public, max-age=3600",
+    "ETag": '"5f3a-1c2b3d4e"',
+    "Last-Modified": "Sat, 17 Oct 2026 21:12:00 GMT",
+    "Vary": "Accept-Encoding",
+    "Strict-Transport-Security": "max-age=63072000; includeSubDomains; preload",
+    "X-Content-Type-Options": "nosniff",
+}
+
+
+def _request(method, path, headers, body=""):
+    head = "\r\n".join(
+        [f"{method} {path} HTTP/1.1"] + [f"{k}: {v}" for k, v in headers.items()]
+    )
+    return f"{head}\r\n\r\n{body}"
+
+
+def _response(status_code, reason, url, headers, body):
+    # Formatted like the responses sent back by the exit nodes
+    head = "\r\n".join(
+        [f"{status_code} {reason} {url}"] + [f"{k}: {v}" for k, v in headers.items()]
+    )
+    return f"{head}\r\n\r\n{body}"
+
+
+def _json_body(size):
+    item_size = len(json.dumps({"id": 0, "name": "item 0", "tags": ["a", "b"]})) + 2
+    return json.dumps(
+        [
+            {"id": i, "name": f"item {i}", "tags": ["a", "b"]}
+            for i in range(size // item_size + 1)
+        ]
+    )
+
+
+def _html_body(size):
+    paragraph = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+    return "<html><body>\n" + paragraph * (size // len(paragraph)) + "</body></html>"
+
+
+CORPUS = {
+    "GET, browser headers": (
+        "request",
+        _request("GET", "/index.html", BROWSER_HEADERS),
+    ),
+    "POST, 2 KB JSON": (
+        "request",
+        _request(
+            "POST",
+            "/api/items",
+            {"Host": "api.example.com", "Content-Type": "application/json"},
+            _json_body(2 * 1024),
+        ),
+    ),
+    "POST, 1 MB JSON": (
+        "request",
+        _request(
+            "POST",
+            "/api/upload",
+            {"Host": "api.example.com", "Content-Type": "application/json"},
+            _json_body(1024 * 1024),
+        ),
+    ),
+    "200, 500 B JSON": (
+        "response",
+        _response(
+            200, "OK", "https://api.example.com/items/1", SERVER_HEADERS, _json_body(500)
+        ),
+    ),
+    "200, 100 KB HTML": (
+        "response",
+        _response(
+            200, "OK", "https://www.example.com/", SERVER_HEADERS, _html_body(100 * 1024)
+        ),
+    ),
+    "200, 4 MB HTML": (
+        "response",
+        _response(
+            200, "OK", "https://www.example.com/big", SERVER_HEADERS, _html_body(4 * 1024 * 1024)
+        ),
+    ),
+}
+
+
+def legacy_parse_request(raw_message: str) -> RawHttpRequest:
+    raw_message = raw_message.replace("\r", "")
+    match = re.match(LEGACY_REQUEST_REGEX, raw_message, re.MULTILINE)
+    method, path, http_version, host, raw_headers, body = match.groups()
+    return RawHttpRequest(host, http_version, path, method, raw_headers, body)
+
+
+def legacy_parse_response(raw_message: str) -> RawHttpResponse:
+    raw_message = raw_message.replace("\r", "")
+    match = re.match(LEGACY_RESPONSE_REGEX, raw_message, re.MULTILINE)
+    status_code, status, url, raw_headers, body = match.groups()
+    return RawHttpResponse(int(status_code), status, url, raw_headers, body)
+
+
+def _time_per_call(function, argument) -> float:
+    timer = timeit.Timer(lambda: function(argument))
+    number, _ = timer.autorange()
+    return min(timer.repeat(5, number)) / number
+
+
+def main():
+    parsers = {
+        "request": (legacy_parse_request, extract_data_from_http_raw_request),
+        "response": (legacy_parse_response, extract_data_from_http_raw_response),
+    }
+
+    print(
+        f"{'message':<24}{'size':>10}{'regex (str)':>14}{'parser (str)':>14}"
+        f"{'parser (bytes)':>16}{'speedup':>10}"
+    )
+
+    for name, (kind, message) in CORPUS.items():
+        legacy_parse, parse = parsers[kind]
+        raw_message = message.encode("utf-8")
+
+        legacy_time = _time_per_call(legacy_parse, message)
+        text_time = _time_per_call(parse, message)
+        bytes_time = _time_per_call(parse, raw_message)
+
+        print(
+            f"{name:<24}{len(raw_message):>10}{legacy_time * 1e6:>12.1f}us{text_time * 1e6:>12.1f}us"
+            f"{bytes_time * 1e6:>14.1f}us{legacy_time / bytes_time:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
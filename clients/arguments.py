@@ -0,0 +1,131 @@
+import argparse
+from typing import Optional
+
+from clients.concurrency import DEFAULT_MAX_IN_FLIGHT, DEFAULT_MAX_WORKERS
+from domain import DEFAULT_IDLE_TIMEOUT, DEFAULT_KEY_STORE_DIRECTORY, KeyStore
+from domain import DEFAULT_DNS_TTL
+from domain import HttpCache
+
+__all__ = (
+    "add_concurrency_arguments",
+    "add_connection_pool_arguments",
+    "add_key_store_arguments",
+    "key_store_from_arguments",
+    "add_exit_cache_arguments",
+    "exit_cache_from_arguments",
+)
+
+
+def add_concurrency_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the options of BoundedThreadPoolMixIn to the argument parser of a launch script.
+    """
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="number of threads handling the requests",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help="number of requests accepted at the same time, the next ones get a 503",
+    )
+
+
+def add_connection_pool_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the options of the pools of connections (to the next nodes and to the target servers) of a node to the
+    argument parser of a launch script.
+    """
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=None,
+        help="number of connections kept alive to each next node and target server "
+        "(asyncio engine: maximum number of connections open to each of them, no limit by default)",
+    )
+    parser.add_argument(
+        "--pool-idle-timeout",
+        type=float,
+        default=DEFAULT_IDLE_TIMEOUT,
+        help="time (in seconds) after which an idle connection is not reused (threaded engine: the connections of "
+        "the other nodes idle for as long are closed)",
+    )
+    parser.add_argument(
+        "--dns-cache-ttl",
+        type=float,
+        default=DEFAULT_DNS_TTL,
+        help="time (in seconds) the addresses of the target servers are kept (0 to resolve them before each new "
+        "connection)",
+    )
+    parser.add_argument(
+        "--prewarm-origins",
+        type=int,
+        default=0,
+        help="number of target servers most requested recently to which a connection is kept ready (asyncio "
+        "engine: whose addresses are kept resolved)",
+    )
+
+
+def add_key_store_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the options of the key store (see KeyStore) to the argument parser of a launch script.
+    """
+    parser.add_argument(
+        "--key-store",
+        default=DEFAULT_KEY_STORE_DIRECTORY,
+        help="directory where the keys are kept between two runs",
+    )
+    parser.add_argument(
+        "--ephemeral-keys",
+        action="store_true",
+        help="generate new keys, lost when the process stops, instead of using the key store",
+    )
+
+
+def key_store_from_arguments(args: argparse.Namespace) -> Optional[KeyStore]:
+    """
+    Returns the key store selected by the options added by add_key_store_arguments, if any.
+    """
+    return None if args.ephemeral_keys else KeyStore(args.key_store)
+
+
+def add_exit_cache_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds the options of the cache of the responses of the target servers (see HttpCache) to the argument parser of
+    a launch script.
+    """
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help="memory (in MiB) used to cache the responses to the GET requests sent as exit node (0 to disable "
+        "the cache)",
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=None,
+        help="directory where the responses dropped from the memory are cached (none by default)",
+    )
+    parser.add_argument(
+        "--cache-disk-size",
+        type=int,
+        default=None,
+        help="space (in MiB) used by the responses cached on disk (10 times the cache size by default)",
+    )
+
+
+def exit_cache_from_arguments(args: argparse.Namespace) -> Optional[HttpCache]:
+    """
+    Returns the cache selected by the options added by add_exit_cache_arguments, if any.
+    """
+    if not args.cache_size:
+        return None
+
+    return HttpCache(
+        args.cache_size * 1024 * 1024,
+        args.cache_path,
+        args.cache_disk_size * 1024 * 1024 if args.cache_disk_size is not None else None,
+    )
@@ -0,0 +1,422 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import aiohttp
+
+from clients.circuit_mux import AsyncCircuitMux, MuxStreamReset
+from clients.circuit_pool import (
+    AsyncCircuitPool,
+    DEFAULT_CIRCUIT_POOL_SIZE,
+    LEAST_LOADED,
+)
+from domain import AsyncConnectionPool, DEFAULT_CIPHER_SUITES
+from domain import DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD, DEFAULT_PAYLOAD_COMPRESSIONS
+from domain import DIRECTORY_DELTA_HEADER, DIRECTORY_VERSION_HEADER, update_known_nodes
+from domain import DirectoryCache
+from domain import DEFAULT_MAX_NODE_SHARE, select_path
+from domain import LatencyWindow
+from domain import HEDGEABLE_HTTP_METHODS, IDEMPOTENT_HTTP_METHODS, get_http_method
+from domain import is_connection_failure
+from domain import decode_raw_http_message
+from domain.circuit import (
+    CIRCUIT_CREATED,
+    CircuitError,
+    CircuitTimeoutError,
+    create_circuit_handshake_message,
+    create_circuit_relay_message,
+    peel_circuit_response,
+    raise_for_relay_status,
+)
+from domain.tor_message import TOR_MESSAGE_CONTENT_TYPE
+from models import Circuit, TorNode
+
+# The number of requests in flight at the same time on a circuit of an AsyncTorClient, the next ones wait
+DEFAULT_MAX_REQUESTS_PER_CIRCUIT = 100
+
+# The time (in seconds) the client waits for the response of the entry node
+ENTRY_NODE_TIMEOUT = 15
+
+
+# noinspection HttpUrlsUsage
+class AsyncTorClient:
+    """
+    The asyncio counterpart of TorClient, to use as an async context manager:
+
+        async with AsyncTorClient(registry_address) as client:
+            responses = await client.send_many(messages)
+
+    Many requests can be in flight at the same time, spread over a pool of circuits (see AsyncCircuitPool) with
+    at most max_requests_per_circuit requests on each circuit. The cryptographic operations run in a pool of
+    crypto_workers threads to keep the event loop responsive.
+
+    Like TorClient, it can start from a directory cached in a file (see directory_cache_path) and compresses the
+    messages exchanged with the exit nodes (see compressions and compression_threshold), and can multiplex the
+    messages sent through a circuit over a single connection (see multiplex).
+    """
+
+    def __init__(
+        self,
+        registry_address: Tuple[str, int],
+        circuit_pool_size: int = DEFAULT_CIRCUIT_POOL_SIZE,
+        circuit_strategy: str = LEAST_LOADED,
+        max_requests_per_circuit: int = DEFAULT_MAX_REQUESTS_PER_CIRCUIT,
+        crypto_workers: Optional[int] = None,
+        path_length: int = 3,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        directory_cache_path: Optional[str] = None,
+        max_node_share: float = DEFAULT_MAX_NODE_SHARE,
+        hedge_after: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        compressions: Sequence[str] = DEFAULT_PAYLOAD_COMPRESSIONS,
+        compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+        multiplex: bool = False,
+    ):
+        self.registry_address = registry_address
+        self.cipher_suites = cipher_suites
+        self.compressions = compressions
+        self.compression_threshold = compression_threshold
+        self.multiplex = multiplex
+        # The multiplexed connections, by id of circuit (at the entry node)
+        self._muxes: Dict[str, AsyncCircuitMux] = {}
+        self.path_length = path_length
+        self.max_node_share = max_node_share
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyWindow()
+        self.hedged_requests = 0
+        self.won_hedges = 0
+        self.known_nodes: List[TorNode] = []
+        # The version of the directory of the registry the known nodes come from
+        self.directory_version: Optional[str] = None
+        self.directory_cache = (
+            DirectoryCache(directory_cache_path, registry_address)
+            if directory_cache_path
+            else None
+        )
+        self._revalidation: Optional[asyncio.Task] = None
+        self.connection_pool = AsyncConnectionPool()
+        self.circuits = AsyncCircuitPool(
+            self.build_circuit,
+            self.destroy_circuit,
+            size=circuit_pool_size,
+            strategy=circuit_strategy,
+            max_requests_per_circuit=max_requests_per_circuit,
+        )
+        self._crypto_executor = ThreadPoolExecutor(
+            crypto_workers, thread_name_prefix="AsyncTorClientCrypto"
+        )
+
+    async def __aenter__(self):
+        await self.connection_pool.__aenter__()
+
+        try:
+            if self._load_cached_directory():
+                await self.circuits.warm()
+                self._revalidation = asyncio.ensure_future(
+                    self._revalidate_directory()
+                )
+            else:
+                await self.refresh()
+        except BaseException:
+            await self.connection_pool.__aexit__(None, None, None)
+            raise
+
+        return self
+
+    async def __aexit__(self, *_):
+        if self._revalidation is not None:
+            self._revalidation.cancel()
+
+        await self.circuits.close()
+        await self.connection_pool.__aexit__(None, None, None)
+        self._crypto_executor.shutdown(wait=False)
+
+    async def refresh(self):
+        """
+        Retrieves the nodes from the registry and replaces the circuits (built in the background along new paths).
+        """
+        await self.update_known_nodes()
+        await self.circuits.clear()
+
+    async def update_known_nodes(self) -> bool:
+        """
+        Same as TorClient.update_known_nodes.
+        """
+        params = {}
+        headers = {}
+
+        if self.directory_version is not None:
+            params["since"] = self.directory_version
+            headers["If-None-Match"] = f'"{self.directory_version}"'
+
+        async with self.connection_pool.request(
+            "GET",
+            f"http://{self.registry_address[0]}:{self.registry_address[1]}",
+            params=params,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=1),
+        ) as response:
+            if response.status == 304:
+                return False
+
+            self.known_nodes = update_known_nodes(
+                self.known_nodes,
+                await response.json(content_type=None),
+                DIRECTORY_DELTA_HEADER in response.headers,
+            )
+            self.directory_version = response.headers.get(DIRECTORY_VERSION_HEADER)
+
+        if self.directory_cache is not None:
+            self.directory_cache.save(self.directory_version, self.known_nodes)
+
+        return True
+
+    def _load_cached_directory(self) -> bool:
+        if self.directory_cache is None:
+            return False
+
+        cached_directory = self.directory_cache.load()
+
+        # Paths cannot be built from a directory with too few nodes
+        if cached_directory is None or len(cached_directory.nodes) < self.path_length:
+            return False
+
+        self.known_nodes = cached_directory.nodes
+        self.directory_version = cached_directory.version
+        return True
+
+    async def _revalidate_directory(self):
+        if await self._try_update_known_nodes():
+            await self.circuits.clear()
+
+    async def _try_update_known_nodes(self) -> bool:
+        try:
+            return await self.update_known_nodes()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # The registry is down, the known nodes are used until the next refresh
+            return False
+
+    async def build_circuit(self, path: Optional[List[TorNode]] = None) -> Circuit:
+        """
+        Same as TorClient.build_circuit.
+        """
+        if path is None:
+            path = select_path(self.known_nodes, self.path_length, self.max_node_share)
+
+        circuit, handshake_message = await self._run_crypto(
+            create_circuit_handshake_message,
+            path,
+            self.cipher_suites,
+            self.compressions,
+        )
+        try:
+            status, response = await self._post(
+                f"http://{path[0].ip}:{path[0].port}/circuit", handshake_message
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status, response = None, None
+
+        if (
+            status != 200
+            or await self._run_crypto(peel_circuit_response, circuit, response)
+            != CIRCUIT_CREATED
+        ):
+            # Same as TorClient.build_circuit
+            await self._try_update_known_nodes()
+            raise CircuitError("The circuit could not be built")
+
+        return circuit
+
+    async def destroy_circuit(self, circuit: Circuit):
+        """
+        Same as TorClient.destroy_circuit.
+        """
+        mux = self._muxes.pop(circuit.circuit_ids[0], None)
+
+        if mux is not None:
+            mux.close()
+
+        if circuit.is_expired():
+            return
+
+        entry_node = circuit.path[0]
+
+        try:
+            await self._post(
+                f"http://{entry_node.ip}:{entry_node.port}/circuit/{circuit.circuit_ids[0]}",
+                create_circuit_relay_message(circuit, b""),
+                method="DELETE",
+                timeout=2,
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    async def send(self, message: Union[str, bytes]) -> Union[str, bytes]:
+        """
+        Same as TorClient.send_http_message, the attempt that lost a hedge is cancelled.
+        """
+        raw_message = message.encode("utf-8") if isinstance(message, str) else message
+        hedge_delay = (
+            self.hedge_delay()
+            if get_http_method(raw_message) in HEDGEABLE_HTTP_METHODS
+            else None
+        )
+
+        if hedge_delay is None:
+            response = await self._send_with_failover(raw_message)
+        else:
+            response = await self._send_hedged(raw_message, hedge_delay)
+
+        return decode_raw_http_message(response) if isinstance(message, str) else response
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Same as TorClient.hedge_delay.
+        """
+        if self.hedge_percentile is not None:
+            delay = self.latencies.percentile(self.hedge_percentile)
+
+            if delay is not None:
+                return delay
+
+        return self.hedge_after
+
+    async def _send_with_failover(self, message: bytes) -> bytes:
+        # Every circuit of the pool may be broken (e.g. after a node restarted), the last attempt then goes through
+        # a new circuit
+        attempts = self.circuits.size + 1
+
+        for attempt in range(attempts):
+            try:
+                async with self.circuits.use() as circuit:
+                    start = time.monotonic()
+                    response = await self._send_through_circuit(circuit, message)
+                    self.latencies.add(time.monotonic() - start)
+                    return response
+            except CircuitError:
+                if attempt == attempts - 1:
+                    raise
+
+    async def send_many(
+        self, messages: Iterable[Union[str, bytes]], return_exceptions: bool = False
+    ) -> List[Union[str, bytes, BaseException]]:
+        """
+        Sends the messages concurrently and returns their responses, in the same order.
+
+        :param return_exceptions: Whether a failed message gives its exception (instead of raising it) so that
+        the responses to the other messages are still returned
+        """
+        return await asyncio.gather(
+            *(self.send(message) for message in messages),
+            return_exceptions=return_exceptions,
+        )
+
+    async def _send_hedged(self, message: bytes, hedge_delay: float) -> bytes:
+        first_attempt = asyncio.ensure_future(self._send_with_failover(message))
+        done, _ = await asyncio.wait([first_attempt], timeout=hedge_delay)
+
+        if done:
+            return first_attempt.result()
+
+        self.hedged_requests += 1
+        second_attempt = asyncio.ensure_future(self._send_with_failover(message))
+        attempts = {first_attempt, second_attempt}
+
+        try:
+            while attempts:
+                done, attempts = await asyncio.wait(
+                    attempts, return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is second_attempt:
+                            self.won_hedges += 1
+
+                        return attempt.result()
+
+            return first_attempt.result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _send_through_circuit(self, circuit: Circuit, message: bytes) -> bytes:
+        if self.multiplex:
+            return await self._send_through_circuit_mux(circuit, message)
+
+        entry_node = circuit.path[0]
+
+        try:
+            status, response = await self._post(
+                f"http://{entry_node.ip}:{entry_node.port}/circuit/{circuit.circuit_ids[0]}",
+                await self._run_crypto(
+                    create_circuit_relay_message,
+                    circuit,
+                    message,
+                    self.compression_threshold,
+                ),
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            # Same as TorClient._send_through_circuit
+            if (
+                is_connection_failure(exception)
+                or get_http_method(message) in IDEMPOTENT_HTTP_METHODS
+            ):
+                raise CircuitError("The entry node of the circuit did not answer") from exception
+
+            raise CircuitTimeoutError("The response did not come back through the circuit") from exception
+
+        raise_for_relay_status(status, message)
+
+        return await self._run_crypto(peel_circuit_response, circuit, response)
+
+    async def _send_through_circuit_mux(
+        self, circuit: Circuit, message: bytes
+    ) -> bytes:
+        try:
+            mux = await self._circuit_mux(circuit)
+            return await mux.send(message, timeout=ENTRY_NODE_TIMEOUT)
+        except (MuxStreamReset, asyncio.TimeoutError) as exception:
+            # Same as TorClient._send_through_circuit_mux
+            if get_http_method(message) in IDEMPOTENT_HTTP_METHODS:
+                raise CircuitError("The multiplexed stream of the circuit failed") from exception
+
+            raise CircuitTimeoutError("The multiplexed stream of the circuit failed") from exception
+
+    async def _circuit_mux(self, circuit: Circuit) -> AsyncCircuitMux:
+        mux = self._muxes.get(circuit.circuit_ids[0])
+
+        if mux is not None and not mux.closed:
+            return mux
+
+        new_mux = AsyncCircuitMux(circuit, self._run_crypto, self.compression_threshold)
+        await new_mux.open(self.connection_pool.session)
+
+        # Another message may have opened one in the meantime
+        mux = self._muxes.get(circuit.circuit_ids[0])
+
+        if mux is None or mux.closed:
+            self._muxes[circuit.circuit_ids[0]] = mux = new_mux
+        else:
+            new_mux.close()
+
+        return mux
+
+    async def _post(
+        self, url: str, message: bytes, method="POST", timeout=ENTRY_NODE_TIMEOUT
+    ) -> Tuple[int, bytes]:
+        async with self.connection_pool.request(
+            method,
+            url,
+            data=message,
+            headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            return response.status, await response.read()
+
+    async def _run_crypto(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._crypto_executor, function, *args
+        )
@@ -0,0 +1,675 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from cryptography.fernet import InvalidToken
+
+from domain import decrypt_using_symmetric_key, encrypt_using_symmetric_key
+from domain import KeyStore, load_crypto_container
+from domain import AsyncConnectionPool, DEFAULT_IDLE_TIMEOUT
+from domain import DEFAULT_DNS_TTL, DnsCache
+from domain import CryptoWorkerPool
+from domain import HttpCache, HttpParseError, async_send_http_request_from_raw_http_message
+from domain import compress_payload, decompress_payload
+from domain import (
+    MUX_RESET_FLAG,
+    AsyncMuxConnection,
+    MuxStreamAssembler,
+    StreamError,
+    async_read_mux_frames,
+    encode_mux_frame,
+    encode_mux_message,
+)
+from domain import (
+    async_decode_stream_chunks,
+    async_encode_stream_chunks,
+    async_read_stream_records,
+    async_send_http_request_stream,
+    encode_stream_record,
+)
+from domain import (
+    decode_final_node_compression,
+    decode_tor_message_for_final_node,
+    decode_tor_message_for_intermediate_node,
+    is_final_node,
+    TOR_MESSAGE_CONTENT_TYPE,
+)
+from domain import (
+    CIRCUIT_CREATED,
+    NOT_FORWARDED_STATUSES,
+    CircuitTable,
+    decode_circuit_handshake_message,
+    relay_failure_status,
+)
+from models import CircuitHop
+
+# The time (in seconds) a node waits for the response of the next node
+NEXT_NODE_TIMEOUT = 15
+
+# The errors of a request sent to the next node or to the target server
+RELAY_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# The errors ending a multiplexed connection, see ServerNodeHTTPHandler
+MUX_CONNECTION_ERRORS = (
+    OSError,
+    EOFError,
+    aiohttp.ClientError,
+    StreamError,
+    ValueError,
+    InvalidToken,
+)
+
+# The errors raised by a malformed stream, see ServerNodeHTTPHandler (a truncated record raises
+# asyncio.IncompleteReadError, an EOFError)
+MALFORMED_STREAM_ERRORS = (StreamError, InvalidToken, EOFError)
+
+
+# noinspection HttpUrlsUsage
+class AsyncServerNode:
+    """
+    A tor node running on asyncio. It exposes the same endpoints as ServerNodeHTTPHandler and speaks the
+    same protocol, so both kinds of node can be used in the same network.
+
+    A request waiting for the next node or for the target server does not hold a thread, so a single process can
+    relay thousands of circuits at the same time. The cryptographic operations are CPU-bound, they run in a pool
+    of crypto_workers threads to keep the event loop responsive, or in crypto_processes processes to use all the
+    cores (see CryptoWorkerPool).
+
+    The connections to the next nodes and to the target servers are kept alive in two pools, at most pool_size
+    connections are open at the same time to a given next node or target server (0 means no limit).
+
+    The node reports its capacity to the registry if given, the clients pick the nodes with a larger capacity
+    more often.
+
+    The responses to the GET requests sent as exit node are kept in exit_cache if given, see HttpCache. The
+    addresses of the target servers are kept dns_cache_ttl seconds, and kept resolved for the prewarm_origins
+    target servers most requested recently.
+    """
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        registry_address: tuple[str, int],
+        private_key_path=None,
+        public_key_path=None,
+        crypto_workers: Optional[int] = None,
+        pool_size: int = 0,
+        pool_idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        crypto_processes: int = 0,
+        key_store: Optional[KeyStore] = None,
+        capacity: Optional[int] = None,
+        exit_cache: Optional[HttpCache] = None,
+        dns_cache_ttl: float = DEFAULT_DNS_TTL,
+        prewarm_origins: int = 0,
+    ):
+        self.server_address = server_address
+        self.registry_address = registry_address
+        self.capacity = capacity
+        self.crypto = load_crypto_container(
+            f"node-{server_address[0]}-{server_address[1]}",
+            key_store,
+            public_key_path=public_key_path,
+            private_key_path=private_key_path,
+        )
+        self.circuits = CircuitTable()
+        self._crypto_executor = ThreadPoolExecutor(
+            crypto_workers, thread_name_prefix="AsyncServerNodeCrypto"
+        )
+        self.crypto_pool = (
+            CryptoWorkerPool(self.crypto, crypto_processes) if crypto_processes else None
+        )
+        self.next_node_pool = AsyncConnectionPool(pool_size, pool_idle_timeout)
+        self.exit_pool = AsyncConnectionPool(
+            pool_size,
+            pool_idle_timeout,
+            dns_cache=DnsCache(dns_cache_ttl) if dns_cache_ttl else None,
+            prewarm_origins=prewarm_origins,
+        )
+        self.exit_cache = exit_cache
+        # The multiplexed connections to the next nodes are held as long as the circuits use them, they do not take
+        # the connections of next_node_pool
+        self._mux_session: Optional[aiohttp.ClientSession] = None
+
+    def serve_forever(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        """
+        Starts the node, registers it to the registry and serves until cancelled.
+        """
+        app = web.Application(client_max_size=0)
+        app.add_routes(
+            [
+                web.get("/key", self._get_key),
+                web.post("/", self._relay_onion_message),
+                web.post("/circuit", self._create_circuit),
+                web.post("/circuit/{circuit_id}", self._relay_circuit_message),
+                web.post("/circuit/{circuit_id}/stream", self._relay_circuit_stream),
+                web.post("/circuit/{circuit_id}/mux", self._relay_circuit_mux),
+                web.delete("/circuit/{circuit_id}", self._destroy_circuit),
+            ]
+        )
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+
+        async with self.next_node_pool, self.exit_pool, aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        ) as self._mux_session:
+            try:
+                await web.TCPSite(runner, *self.server_address).start()
+                await self.register_node()
+                await asyncio.Event().wait()
+            finally:
+                await runner.cleanup()
+                self._crypto_executor.shutdown(wait=False)
+
+                if self.crypto_pool is not None:
+                    self.crypto_pool.shutdown()
+
+    async def register_node(self):
+        async with self.next_node_pool.request(
+            "POST",
+            f"http://{self.registry_address[0]}:{self.registry_address[1]}/add/{self.server_address[1]}",
+            params={"capacity": self.capacity} if self.capacity else None,
+        ):
+            pass
+
+    def connection_stats(self) -> dict:
+        """
+        Returns the usage of the pools of connections to the next nodes and to the target servers.
+        """
+        return {
+            "next_node": self.next_node_pool.stats.as_dict(),
+            "exit": self.exit_pool.stats.as_dict(),
+        }
+
+    def crypto_stats(self) -> dict:
+        """
+        Returns the usage of the pool of processes running the cryptographic operations, if any.
+        """
+        return self.crypto_pool.stats() if self.crypto_pool is not None else {}
+
+    def dns_stats(self) -> dict:
+        """
+        Returns the usage of the cache of the addresses of the target servers (see DnsCache.stats) and the
+        origins whose addresses are kept resolved.
+        """
+        return {
+            "dns_cache": self.exit_pool.dns_stats(),
+            "prewarm": self.exit_pool.prewarm_stats(),
+        }
+
+    def cache_stats(self) -> dict:
+        """
+        Returns the usage of the cache of the responses of the target servers, if any (see HttpCache.stats).
+        """
+        return self.exit_cache.stats() if self.exit_cache is not None else {}
+
+    async def _run_crypto(self, function, *args):
+        if self.crypto_pool is not None:
+            return await asyncio.wrap_future(self.crypto_pool.submit(function, *args))
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._crypto_executor, function, *args
+        )
+
+    async def _run_compression(self, function, *args):
+        # zlib and zstd release the GIL, the payloads are (de)compressed in the threads of the node instead of
+        # being sent to the processes of the crypto pool
+        return await asyncio.get_running_loop().run_in_executor(
+            self._crypto_executor, function, *args
+        )
+
+    async def _decrypt_with_node_keys(self, message: bytes) -> Tuple[bytes, bytes]:
+        if self.crypto_pool is not None:
+            return await asyncio.wrap_future(self.crypto_pool.decrypt(message))
+
+        return await self._run_crypto(self.crypto.decrypt, message)
+
+    async def _send_to_next_node(
+        self, url: str, message: bytes, method="POST"
+    ) -> Tuple[int, bytes]:
+        async with self.next_node_pool.request(
+            method,
+            url,
+            data=message,
+            headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+            timeout=aiohttp.ClientTimeout(total=NEXT_NODE_TIMEOUT),
+        ) as response:
+            return response.status, await response.read()
+
+    async def _encrypted_response(self, response: bytes, sym_key: bytes):
+        return web.Response(
+            body=await self._run_crypto(encrypt_using_symmetric_key, response, sym_key),
+            content_type=TOR_MESSAGE_CONTENT_TYPE,
+        )
+
+    async def _encrypted_stream(self, request: web.Request, chunks, sym_key: bytes):
+        response = web.StreamResponse(headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        async for chunk in chunks:
+            encrypted_chunk = await self._run_crypto(
+                encrypt_using_symmetric_key, chunk, sym_key
+            )
+            await response.write(encode_stream_record(encrypted_chunk))
+
+        await response.write_eof()
+        return response
+
+    async def _send_http_request(self, http_message: bytes) -> bytes:
+        return await async_send_http_request_from_raw_http_message(
+            http_message, self.exit_pool.session, self.exit_cache
+        )
+
+    async def _get_key(self, _: web.Request):
+        return web.Response(
+            body=self.crypto.get_advertised_keys(),
+            content_type="application/x-pem-file",
+        )
+
+    async def _relay_onion_message(self, request: web.Request):
+        decrypted_body, sym_key = await self._decrypt_with_node_keys(
+            await request.read()
+        )
+
+        if is_final_node(decrypted_body):
+            try:
+                compression = decode_final_node_compression(decrypted_body)
+                http_message = (
+                    await self._run_compression(
+                        decode_tor_message_for_final_node, decrypted_body
+                    )
+                    if compression is not None
+                    else decode_tor_message_for_final_node(decrypted_body)
+                )
+            except ValueError:
+                return web.Response(status=400)
+
+            try:
+                response = await self._send_http_request(http_message)
+            except HttpParseError:
+                return web.Response(status=400)
+            except RELAY_ERRORS as exception:
+                # Same as ServerNodeHTTPHandler._send_to_target_server
+                return web.Response(status=relay_failure_status(exception))
+
+            # Same as ServerNodeHTTPHandler._relay_onion_message
+            if compression is not None:
+                response = await self._run_compression(
+                    compress_payload, response, compression
+                )
+        else:
+            next_node, tor_message = decode_tor_message_for_intermediate_node(
+                decrypted_body
+            )
+            try:
+                status, response = await self._send_to_next_node(
+                    f"http://{next_node}", tor_message
+                )
+            except RELAY_ERRORS as exception:
+                return web.Response(status=relay_failure_status(exception))
+
+            # Same as ServerNodeHTTPHandler._relay_onion_message
+            if status != 200:
+                return web.Response(status=status)
+
+        return await self._encrypted_response(response, sym_key)
+
+    async def _create_circuit(self, request: web.Request):
+        try:
+            decrypted_body, sym_key = await self._decrypt_with_node_keys(
+                await request.read()
+            )
+            circuit_id, next_circuit_id, tor_message = (
+                decode_circuit_handshake_message(decrypted_body)
+            )
+            final_node = is_final_node(tor_message)
+
+            if final_node:
+                compression = decode_final_node_compression(tor_message)
+            else:
+                next_node, handshake_message = (
+                    decode_tor_message_for_intermediate_node(tor_message)
+                )
+        except (InvalidToken, ValueError):
+            return web.Response(status=400)
+
+        if final_node:
+
+            self.circuits.add(circuit_id, sym_key, compression=compression)
+            response = (
+                compress_payload(CIRCUIT_CREATED, compression)
+                if compression is not None
+                else CIRCUIT_CREATED
+            )
+        else:
+            try:
+                status, response = await self._send_to_next_node(
+                    f"http://{next_node}/circuit", handshake_message
+                )
+            except RELAY_ERRORS:
+                status = None
+
+            if status != 200:
+                return web.Response(status=502)
+
+            self.circuits.add(circuit_id, sym_key, next_node, next_circuit_id)
+
+        return await self._encrypted_response(response, sym_key)
+
+    async def _relay_circuit_message(self, request: web.Request):
+        circuit_id = request.match_info["circuit_id"]
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            return web.Response(status=404)
+
+        try:
+            message = await self._run_crypto(
+                decrypt_using_symmetric_key, await request.read(), circuit.sym_key
+            )
+        except InvalidToken:
+            return web.Response(status=400)
+
+        if circuit.next_node is None:
+            if circuit.compression is not None:
+                try:
+                    message = await self._run_compression(decompress_payload, message)
+                except ValueError:
+                    return web.Response(status=400)
+
+            try:
+                response = await self._send_http_request(message)
+            except HttpParseError:
+                return web.Response(status=400)
+            except RELAY_ERRORS as exception:
+                return web.Response(status=relay_failure_status(exception))
+
+            if circuit.compression is not None:
+                response = await self._run_compression(
+                    compress_payload, response, circuit.compression
+                )
+        else:
+            try:
+                status, response = await self._send_to_next_node(
+                    f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}",
+                    message,
+                )
+            except RELAY_ERRORS as exception:
+                # Same as ServerNodeHTTPHandler._relay_circuit_message
+                status = relay_failure_status(exception)
+
+            if status != 200:
+                if status in NOT_FORWARDED_STATUSES:
+                    # The rest of the circuit is broken, so is this part
+                    self.circuits.remove(circuit_id)
+
+                return web.Response(status=status)
+
+        return await self._encrypted_response(response, circuit.sym_key)
+
+    async def _relay_circuit_stream(self, request: web.Request):
+        circuit_id = request.match_info["circuit_id"]
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            return web.Response(status=404)
+
+        async def messages():
+            async for record in async_read_stream_records(request.content):
+                yield await self._run_crypto(
+                    decrypt_using_symmetric_key, record, circuit.sym_key
+                )
+
+        if circuit.next_node is None:
+            response_chunks = async_send_http_request_stream(
+                async_decode_stream_chunks(messages()), self.exit_pool.session
+            )
+
+            # Same as ServerNodeHTTPHandler._relay_circuit_stream
+            try:
+                response_head = await anext(response_chunks)
+            except (HttpParseError, *MALFORMED_STREAM_ERRORS):
+                return web.Response(status=400)
+            except RELAY_ERRORS as exception:
+                return web.Response(status=relay_failure_status(exception))
+
+            async def response():
+                yield response_head
+
+                async for chunk in response_chunks:
+                    yield chunk
+
+            return await self._encrypted_stream(
+                request, async_encode_stream_chunks(response()), circuit.sym_key
+            )
+
+        # aiohttp reports an error raised while the body is sent as a failure of the connection
+        malformed_stream = False
+
+        async def records():
+            nonlocal malformed_stream
+
+            try:
+                async for message in messages():
+                    yield encode_stream_record(message)
+            except MALFORMED_STREAM_ERRORS:
+                malformed_stream = True
+                raise
+
+        try:
+            next_response = await self.next_node_pool.request(
+                "POST",
+                f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}/stream",
+                data=records(),
+                headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+                # The whole stream may take long to be received, only the time between two reads is limited
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=NEXT_NODE_TIMEOUT,
+                    sock_read=NEXT_NODE_TIMEOUT,
+                ),
+            )
+        except RELAY_ERRORS as exception:
+            if malformed_stream:
+                return web.Response(status=400)
+
+            # Same as ServerNodeHTTPHandler._relay_circuit_stream
+            return self._relay_failure(circuit_id, relay_failure_status(exception))
+
+        async with next_response:
+            if malformed_stream:
+                return web.Response(status=400)
+
+            if next_response.status != 200:
+                return self._relay_failure(circuit_id, next_response.status)
+
+            return await self._encrypted_stream(
+                request,
+                async_read_stream_records(next_response.content),
+                circuit.sym_key,
+            )
+
+    def _relay_failure(self, circuit_id: str, status: int) -> web.Response:
+        # The next node did not relay a message of the circuit (see _relay_circuit_message)
+        if status in NOT_FORWARDED_STATUSES:
+            # The rest of the circuit is broken, so is this part
+            self.circuits.remove(circuit_id)
+
+        return web.Response(status=status)
+
+    async def _relay_circuit_mux(self, request: web.Request):
+        circuit_id = request.match_info["circuit_id"]
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            return web.Response(status=404)
+
+        if circuit.next_node is None:
+            return await self._answer_mux_streams(request, circuit)
+
+        next_connection = AsyncMuxConnection(
+            self._mux_session,
+            f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}/mux",
+        )
+
+        try:
+            status = await next_connection.open()
+        except RELAY_ERRORS:
+            status = 502
+
+        if status != 200:
+            # The rest of the circuit is broken, so is this part
+            self.circuits.remove(circuit_id)
+            return web.Response(status=status)
+
+        response = await self._mux_response(request)
+
+        async def relay_messages():
+            try:
+                async for stream_id, flags, payload in async_read_mux_frames(
+                    request.content
+                ):
+                    if not flags & MUX_RESET_FLAG:
+                        payload = await self._run_crypto(
+                            decrypt_using_symmetric_key, payload, circuit.sym_key
+                        )
+
+                    await next_connection.send(
+                        encode_mux_frame(stream_id, flags, payload)
+                    )
+            except MUX_CONNECTION_ERRORS:
+                pass
+            finally:
+                await next_connection.end()
+
+        async def relay_responses():
+            try:
+                async for stream_id, flags, payload in next_connection.frames():
+                    if not flags & MUX_RESET_FLAG:
+                        payload = await self._run_crypto(
+                            encrypt_using_symmetric_key, payload, circuit.sym_key
+                        )
+
+                    await response.write(encode_mux_frame(stream_id, flags, payload))
+            except MUX_CONNECTION_ERRORS:
+                # Same as ServerNodeHTTPHandler._relay_mux_responses
+                self.circuits.remove(circuit_id)
+
+        messages = asyncio.create_task(relay_messages())
+
+        # The connection ends once the next node ended it: after the previous node did, or when it is down
+        try:
+            await relay_responses()
+        finally:
+            messages.cancel()
+            next_connection.close()
+
+        return await self._end_mux_response(response)
+
+    async def _mux_response(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        return response
+
+    @staticmethod
+    async def _end_mux_response(response: web.StreamResponse) -> web.StreamResponse:
+        try:
+            await response.write_eof()
+        except MUX_CONNECTION_ERRORS:
+            pass
+
+        return response
+
+    async def _answer_mux_streams(self, request: web.Request, circuit: CircuitHop):
+        response = await self._mux_response(request)
+        assembler = MuxStreamAssembler()
+        streams = set()
+
+        try:
+            async for stream_id, flags, payload in async_read_mux_frames(
+                request.content
+            ):
+                if not flags & MUX_RESET_FLAG:
+                    payload = await self._run_crypto(
+                        decrypt_using_symmetric_key, payload, circuit.sym_key
+                    )
+
+                message = assembler.feed(stream_id, flags, payload)
+
+                if message is not None:
+                    # Same as ServerNodeHTTPHandler._answer_mux_streams
+                    stream = asyncio.create_task(
+                        self._answer_mux_stream(response, circuit, stream_id, message)
+                    )
+                    streams.add(stream)
+                    stream.add_done_callback(streams.discard)
+        except MUX_CONNECTION_ERRORS:
+            pass
+
+        await asyncio.gather(*streams, return_exceptions=True)
+        return await self._end_mux_response(response)
+
+    async def _answer_mux_stream(
+        self,
+        response: web.StreamResponse,
+        circuit: CircuitHop,
+        stream_id: int,
+        message: bytes,
+    ):
+        try:
+            if circuit.compression is not None:
+                message = await self._run_compression(decompress_payload, message)
+
+            http_response = await self._send_http_request(message)
+
+            if circuit.compression is not None:
+                http_response = await self._run_compression(
+                    compress_payload, http_response, circuit.compression
+                )
+
+            frames = await self._run_crypto(
+                encode_mux_message, stream_id, http_response, [circuit.sym_key]
+            )
+        except Exception:
+            # Same as ServerNodeHTTPHandler._answer_mux_stream
+            frames = [encode_mux_frame(stream_id, MUX_RESET_FLAG)]
+
+        # A frame is written whole before the next one (of any stream) is
+        for frame in frames:
+            await response.write(frame)
+
+    async def _destroy_circuit(self, request: web.Request):
+        circuit_id = request.match_info["circuit_id"]
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            return web.Response(status=404)
+
+        try:
+            # Only the client knows the session key, this proves the request comes from it
+            message = await self._run_crypto(
+                decrypt_using_symmetric_key, await request.read(), circuit.sym_key
+            )
+        except InvalidToken:
+            return web.Response(status=400)
+
+        self.circuits.remove(circuit_id)
+
+        if circuit.next_node is not None:
+            try:
+                await self._send_to_next_node(
+                    f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}",
+                    message,
+                    method="DELETE",
+                )
+            except RELAY_ERRORS:
+                # Same as ServerNodeHTTPHandler._destroy_circuit
+                pass
+
+        return web.Response(status=200)
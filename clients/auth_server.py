@@ -3,8 +3,14 @@ import socketserver
 import sys
 import uuid
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Optional
 
-from domain.crypto import CryptoContainer
+from clients.concurrency import (
+    BoundedThreadPoolMixIn,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_MAX_WORKERS,
+)
+from domain.key_store import KeyStore, load_crypto_container
 
 # The number of times the server will try to retrieve the public key from a given node.
 # The higher, the longer it will take to discover that a node is down.
@@ -12,7 +18,7 @@ MAX_NODE_PUBLIC_KEY_ATTEMPT = 5
 
 
 # noinspection HttpUrlsUsage
-class AuthServerHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandler):
+class AuthServerHTTPHandler(BaseHTTPRequestHandler):
     """
     A very simple HTTP server that only handles GET and POST requests. It exposes a
     /private and /auth endpoint.
@@ -90,7 +96,7 @@ class AuthServerHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandler)
         self.end_headers()
 
 
-class AuthServerNode(HTTPServer):
+class AuthServerNode(BoundedThreadPoolMixIn, HTTPServer):
     """
     The node using the AuthServerHttpHandler as its http handler. Stores
     the user tokens for a session.
@@ -101,10 +107,23 @@ class AuthServerNode(HTTPServer):
         server_address: tuple[str, int],
         private_key_path=None,
         public_key_path=None,
+        max_workers=DEFAULT_MAX_WORKERS,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        key_store: Optional[KeyStore] = None,
     ):
-        super().__init__(server_address, AuthServerHTTPHandler)
-
-        self.crypto = CryptoContainer(private_key_path, public_key_path)
+        super().__init__(
+            server_address,
+            AuthServerHTTPHandler,
+            max_workers=max_workers,
+            max_in_flight=max_in_flight,
+        )
+
+        self.crypto = load_crypto_container(
+            f"auth-{server_address[0]}-{server_address[1]}",
+            key_store,
+            public_key_path=public_key_path,
+            private_key_path=private_key_path,
+        )
         self.http_handler = AuthServerHTTPHandler
         self.user_tokens = {}
 
@@ -0,0 +1,313 @@
+import asyncio
+import concurrent.futures
+import http.client
+import itertools
+from concurrent.futures import Future, InvalidStateError
+from threading import Lock, Thread
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+from cryptography.fernet import InvalidToken
+
+from domain import (
+    DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    MUX_RESET_FLAG,
+    AsyncMuxConnection,
+    CircuitError,
+    MuxConnection,
+    MuxStreamAssembler,
+    StreamError,
+    compress_payload,
+    decompress_payload,
+    decrypt_from_circuit,
+    encode_mux_frame,
+    encode_mux_message,
+)
+from models import Circuit
+
+__all__ = ("CircuitMux", "AsyncCircuitMux", "MuxStreamReset")
+
+
+class MuxStreamReset(ConnectionError):
+    """
+    Raised when the stream of a message was reset by the circuit or its multiplexed connection was lost, the message
+    may or may not have been relayed to the target server.
+    """
+
+
+def _settle(future, result=None, exception: Optional[BaseException] = None):
+    # The connection may be closed while the response of a stream is being set
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except (InvalidStateError, asyncio.InvalidStateError):
+        pass
+
+
+class _CircuitMuxBase:
+    """
+    The bookkeeping shared by CircuitMux and AsyncCircuitMux: the streams waiting for their response, by id.
+    """
+
+    def __init__(self, circuit: Circuit, compression_threshold: int):
+        self.circuit = circuit
+        self.compression_threshold = compression_threshold
+        self.closed = False
+        self._responses: Dict[int, Future] = {}
+        self._stream_ids = itertools.count(1)
+        self._assembler = MuxStreamAssembler()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def _url_path(self) -> str:
+        return f"/circuit/{self.circuit.circuit_ids[0]}/mux"
+
+    def _compress(self, message: bytes) -> bytes:
+        if self.circuit.compression is None:
+            return message
+
+        return compress_payload(
+            message, self.circuit.compression, self.compression_threshold
+        )
+
+    def _receive(self, stream_id: int, flags: int, chunk: bytes):
+        # Called for every frame received (its payload decrypted), in order
+        future = self._responses.get(stream_id)
+
+        if future is None:
+            # The stream timed out, the rest of its response is dropped
+            self._assembler.feed(stream_id, MUX_RESET_FLAG, b"")
+            return
+
+        response = self._assembler.feed(stream_id, flags, chunk)
+
+        if flags & MUX_RESET_FLAG:
+            _settle(future, exception=MuxStreamReset("The stream was reset by the circuit"))
+            return
+
+        if response is None:
+            return
+
+        if self.circuit.compression is not None:
+            try:
+                response = bytes(decompress_payload(response))
+            except ValueError:
+                _settle(future, exception=MuxStreamReset("The response is corrupted"))
+                return
+
+        _settle(future, response)
+
+    def _fail_pending_streams(self):
+        self.closed = True
+        responses = list(self._responses.values())
+        self._responses.clear()
+
+        for future in responses:
+            _settle(
+                future,
+                exception=MuxStreamReset("The multiplexed connection was closed"),
+            )
+
+
+class CircuitMux(_CircuitMuxBase):
+    """
+    A multiplexed connection of a client to the entry node of a circuit (see domain.mux): the messages sent at the
+    same time by several threads are carried by this single connection (and by a single connection between each pair
+    of nodes of the circuit), each one in its own stream, and each response is returned as soon as it is received.
+
+    Raises CircuitError if the connection cannot be opened.
+    """
+
+    def __init__(
+        self,
+        circuit: Circuit,
+        compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    ):
+        super().__init__(circuit, compression_threshold)
+        entry_node = circuit.path[0]
+        self._lock = Lock()
+
+        try:
+            self._connection = MuxConnection(
+                f"{entry_node.ip}:{entry_node.port}", self._url_path()
+            )
+        except (OSError, http.client.HTTPException) as exception:
+            raise CircuitError("The entry node of the circuit did not answer") from exception
+
+        if self._connection.status != 200:
+            raise CircuitError("The circuit is broken or not known by one of its nodes anymore")
+
+        Thread(target=self._read_responses, daemon=True, name="CircuitMux").start()
+
+    def send(self, message: bytes, timeout: Optional[float] = None) -> bytes:
+        """
+        Sends a message in a new stream and returns its response.
+
+        Raises CircuitError if the connection was closed before the message was sent, MuxStreamReset if the stream
+        was reset or the connection lost afterwards, and TimeoutError if the response did not come within timeout
+        seconds (the stream is then reset).
+        """
+        future = Future()
+
+        with self._lock:
+            if self.closed:
+                raise CircuitError("The multiplexed connection is closed")
+
+            stream_id = next(self._stream_ids)
+            self._responses[stream_id] = future
+
+        try:
+            for frame in encode_mux_message(
+                stream_id, self._compress(message), self.circuit.sym_keys
+            ):
+                self._connection.send(frame)
+
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self._reset(stream_id)
+            raise
+        except MuxStreamReset:
+            raise
+        except OSError as exception:
+            raise MuxStreamReset("The multiplexed connection was lost") from exception
+        finally:
+            with self._lock:
+                self._responses.pop(stream_id, None)
+
+    def _reset(self, stream_id: int):
+        try:
+            self._connection.send(encode_mux_frame(stream_id, MUX_RESET_FLAG))
+        except OSError:
+            pass
+
+    def _read_responses(self):
+        try:
+            for stream_id, flags, payload in self._connection.frames():
+                if not flags & MUX_RESET_FLAG:
+                    payload = decrypt_from_circuit(self.circuit, payload)
+
+                with self._lock:
+                    self._receive(stream_id, flags, payload)
+        except (OSError, http.client.HTTPException, StreamError, InvalidToken):
+            pass
+        finally:
+            self.close()
+            self._connection.close()
+
+    def close(self):
+        """
+        Closes the connection, the streams waiting for their response are reset.
+        """
+        with self._lock:
+            self._fail_pending_streams()
+
+        self._connection.end()
+        # Closed by the thread reading the responses once it sees the end of the connection
+        self._connection.shutdown()
+
+
+class AsyncCircuitMux(_CircuitMuxBase):
+    """
+    The asyncio counterpart of CircuitMux, open it with open before using it. The cryptographic operations run with
+    the given run_crypto function (e.g. in the pool of threads of the client).
+    """
+
+    def __init__(
+        self,
+        circuit: Circuit,
+        run_crypto: Callable[..., Awaitable],
+        compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    ):
+        super().__init__(circuit, compression_threshold)
+        self._run_crypto = run_crypto
+        self._connection: Optional[AsyncMuxConnection] = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def open(self, session: aiohttp.ClientSession):
+        """
+        Same as the constructor of CircuitMux.
+        """
+        entry_node = self.circuit.path[0]
+        self._connection = AsyncMuxConnection(
+            session, f"http://{entry_node.ip}:{entry_node.port}{self._url_path()}"
+        )
+
+        try:
+            status = await self._connection.open()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            self.closed = True
+            raise CircuitError("The entry node of the circuit did not answer") from exception
+
+        if status != 200:
+            self.closed = True
+            raise CircuitError("The circuit is broken or not known by one of its nodes anymore")
+
+        self._reader = asyncio.create_task(self._read_responses())
+
+    async def send(self, message: bytes, timeout: Optional[float] = None) -> bytes:
+        """
+        Same as CircuitMux.send.
+        """
+        if self.closed:
+            raise CircuitError("The multiplexed connection is closed")
+
+        stream_id = next(self._stream_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._responses[stream_id] = future
+
+        try:
+            frames = await self._run_crypto(
+                encode_mux_message,
+                stream_id,
+                self._compress(message),
+                self.circuit.sym_keys,
+            )
+
+            for frame in frames:
+                await self._connection.send(frame)
+
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            await self._reset(stream_id)
+            raise
+        except MuxStreamReset:
+            raise
+        except OSError as exception:
+            raise MuxStreamReset("The multiplexed connection was lost") from exception
+        finally:
+            self._responses.pop(stream_id, None)
+
+    async def _reset(self, stream_id: int):
+        try:
+            await self._connection.send(encode_mux_frame(stream_id, MUX_RESET_FLAG))
+        except OSError:
+            pass
+
+    async def _read_responses(self):
+        try:
+            async for stream_id, flags, payload in self._connection.frames():
+                if not flags & MUX_RESET_FLAG:
+                    payload = await self._run_crypto(
+                        decrypt_from_circuit, self.circuit, payload
+                    )
+
+                self._receive(stream_id, flags, payload)
+        except (OSError, EOFError, aiohttp.ClientError, StreamError, InvalidToken):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Same as CircuitMux.close.
+        """
+        self._fail_pending_streams()
+
+        if self._connection is not None:
+            self._connection.close()
+
+        if self._reader is not None and self._reader is not asyncio.current_task():
+            self._reader.cancel()
@@ -0,0 +1,421 @@
+import asyncio
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set
+
+from domain import CircuitError
+from models import Circuit
+
+__all__ = (
+    "CircuitPool",
+    "AsyncCircuitPool",
+    "ROUND_ROBIN",
+    "LEAST_LOADED",
+    "DEFAULT_CIRCUIT_POOL_SIZE",
+    "CIRCUIT_RENEW_MARGIN",
+)
+
+# The ways a circuit is picked from the pool: in turn, or the one with the fewest requests in flight
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+# The number of circuits kept ready by a client
+DEFAULT_CIRCUIT_POOL_SIZE = 3
+
+# A replacement is built for a circuit this long (in seconds) before it expires, the circuit is used until the
+# replacement is ready
+CIRCUIT_RENEW_MARGIN = 60
+
+# The time (in seconds) a request waits for a circuit when none is ready (e.g. right after the client started)
+CIRCUIT_WAIT_TIMEOUT = 30
+
+
+class _CircuitPoolBase:
+    """
+    The bookkeeping shared by CircuitPool and AsyncCircuitPool, the methods starting with an underscore must be
+    called with the lock of the pool held.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        strategy: str,
+        renew_margin: float,
+        max_requests_per_circuit: int,
+    ):
+        if size < 1:
+            raise ValueError("A circuit pool must hold at least one circuit")
+
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"Unknown circuit selection strategy: {strategy}")
+
+        self.size = size
+        self.strategy = strategy
+        self.renew_margin = renew_margin
+        self.max_requests_per_circuit = max_requests_per_circuit
+
+        self._circuits: List[Circuit] = []
+        # The requests in flight on each circuit (in or out of the pool), by entry circuit id
+        self._load: Dict[str, int] = {}
+        self._building = 0
+        self._next_index = 0
+        self._closed = False
+
+        self.built_circuits = 0
+        self.failed_builds = 0
+        self.replaced_circuits = 0
+
+    def __len__(self):
+        return len(self._circuits)
+
+    def _available_circuits(self) -> List[Circuit]:
+        if not self.max_requests_per_circuit:
+            return self._circuits
+
+        return [
+            circuit
+            for circuit in self._circuits
+            if self._load[circuit.circuit_ids[0]] < self.max_requests_per_circuit
+        ]
+
+    def _can_acquire(self) -> bool:
+        # A request stops waiting when a circuit is free or when no circuit will ever be ready
+        return bool(self._available_circuits()) or self._closed or not (
+            self._circuits or self._building
+        )
+
+    def _pick(self) -> Circuit:
+        circuits = self._available_circuits()
+
+        if not circuits:
+            raise CircuitError("No circuit could be built")
+
+        if self.strategy == LEAST_LOADED:
+            circuit = min(circuits, key=lambda c: self._load[c.circuit_ids[0]])
+        else:
+            self._next_index = (self._next_index + 1) % len(circuits)
+            circuit = circuits[self._next_index]
+
+        self._load[circuit.circuit_ids[0]] += 1
+        return circuit
+
+    def _missing_circuits(self) -> int:
+        # Returns the number of circuits to start building (and counts them as being built)
+        if self._closed:
+            return 0
+
+        renewing = sum(1 for circuit in self._circuits if self._must_renew(circuit))
+        missing = max(self.size + renewing - len(self._circuits) - self._building, 0)
+        self._building += missing
+        return missing
+
+    def _must_renew(self, circuit: Circuit) -> bool:
+        return circuit.expires_at - self.renew_margin <= time.time()
+
+    def _drop_expired_circuits(self) -> List[Circuit]:
+        # Returns the circuits to tear down
+        return [
+            circuit
+            for circuit in list(self._circuits)
+            if circuit.is_expired() and self._retire(circuit)
+        ]
+
+    def _add(self, circuit: Optional[Circuit]) -> List[Circuit]:
+        # Adds a circuit once built (None if its build failed), returns the circuits to tear down
+        self._building -= 1
+
+        if circuit is None:
+            self.failed_builds += 1
+            return []
+
+        if self._closed:
+            return [circuit]
+
+        self.built_circuits += 1
+        self._circuits.append(circuit)
+        self._load[circuit.circuit_ids[0]] = 0
+
+        # The replacement is ready, the circuit closest to its expiration can leave the pool
+        renewing = [c for c in self._circuits if self._must_renew(c)]
+
+        if renewing and len(self._circuits) > self.size:
+            self.replaced_circuits += 1
+            replaced_circuit = min(renewing, key=lambda c: c.expires_at)
+
+            if self._retire(replaced_circuit):
+                return [replaced_circuit]
+
+        return []
+
+    def _release(self, circuit: Circuit, failed: bool) -> List[Circuit]:
+        # Returns the circuits to tear down
+        circuit_id = circuit.circuit_ids[0]
+        self._load[circuit_id] -= 1
+
+        if failed and circuit in self._circuits:
+            return [circuit] if self._retire(circuit) else []
+
+        if circuit not in self._circuits and not self._load[circuit_id]:
+            del self._load[circuit_id]
+            return [circuit]
+
+        return []
+
+    def _retire_all(self) -> List[Circuit]:
+        return [circuit for circuit in list(self._circuits) if self._retire(circuit)]
+
+    def _retire(self, circuit: Circuit) -> bool:
+        # Removes the circuit from the pool, returns whether it can be torn down (it is once its last request is done)
+        self._circuits.remove(circuit)
+        circuit_id = circuit.circuit_ids[0]
+
+        if self._load[circuit_id]:
+            return False
+
+        del self._load[circuit_id]
+        return True
+
+
+class CircuitPool(_CircuitPoolBase):
+    """
+    Keeps size circuits ready to be used, so that a request never waits for a circuit to be built.
+
+    The circuits are built in the background with build_circuit (each one along its own path) and handed out in
+    turn or to balance the requests in flight (see ROUND_ROBIN and LEAST_LOADED). A circuit about to expire is
+    replaced in the background, a circuit that failed is dropped and replaced at once. A circuit out of the pool
+    is torn down with destroy_circuit once its last request is done.
+
+    If max_requests_per_circuit is set, a request waits for a circuit to have less than that many requests in
+    flight (0 means no limit).
+    """
+
+    def __init__(
+        self,
+        build_circuit: Callable[[], Circuit],
+        destroy_circuit: Callable[[Circuit], None],
+        size: int = DEFAULT_CIRCUIT_POOL_SIZE,
+        strategy: str = ROUND_ROBIN,
+        renew_margin: float = CIRCUIT_RENEW_MARGIN,
+        max_requests_per_circuit: int = 0,
+    ):
+        super().__init__(size, strategy, renew_margin, max_requests_per_circuit)
+        self.build_circuit = build_circuit
+        self.destroy_circuit = destroy_circuit
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="CircuitPool")
+
+    def warm(self):
+        """
+        Starts building the missing circuits in the background.
+        """
+        with self._condition:
+            self._fill()
+
+    def acquire(self, timeout: float = CIRCUIT_WAIT_TIMEOUT) -> Circuit:
+        """
+        Returns a circuit of the pool, to give back with release once the request is done. Waits for a circuit to
+        be built (or to be free) if none is ready and raises a CircuitError if none could be built.
+        """
+        with self._condition:
+            self._destroy(self._drop_expired_circuits())
+            self._fill()
+            self._condition.wait_for(self._can_acquire, timeout)
+            return self._pick()
+
+    def release(self, circuit: Circuit, failed: bool = False):
+        """
+        Gives back a circuit returned by acquire. A failed circuit is dropped from the pool and replaced.
+        """
+        with self._condition:
+            self._destroy(self._release(circuit, failed))
+            self._fill()
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def use(self) -> Iterator[Circuit]:
+        """
+        Context manager acquiring a circuit and releasing it, as failed if a CircuitError is raised.
+        """
+        circuit = self.acquire()
+
+        try:
+            yield circuit
+        except CircuitError:
+            self.release(circuit, failed=True)
+            raise
+        except BaseException:
+            self.release(circuit)
+            raise
+        else:
+            self.release(circuit)
+
+    def clear(self):
+        """
+        Replaces all the circuits of the pool (e.g. once the list of nodes changed).
+        """
+        with self._condition:
+            self._destroy(self._retire_all())
+            self._fill()
+
+    def close(self):
+        """
+        Tears down the circuits of the pool and stops building new ones.
+        """
+        with self._condition:
+            self._closed = True
+            self._destroy(self._retire_all())
+            self._condition.notify_all()
+
+        self._executor.shutdown(wait=True)
+
+    def _fill(self):
+        for _ in range(self._missing_circuits()):
+            self._submit(self._build)
+
+    def _build(self):
+        try:
+            circuit = self.build_circuit()
+        except Exception:
+            circuit = None
+
+        with self._condition:
+            self._destroy(self._add(circuit))
+            self._condition.notify_all()
+
+    def _destroy(self, circuits: List[Circuit]):
+        for circuit in circuits:
+            self._submit(self.destroy_circuit, circuit)
+
+    def _submit(self, function, *args):
+        try:
+            self._executor.submit(function, *args)
+        except RuntimeError:
+            # The pool is closed
+            pass
+
+
+class AsyncCircuitPool(_CircuitPoolBase):
+    """
+    The asyncio counterpart of CircuitPool, build_circuit and destroy_circuit are coroutine functions. It must be
+    used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        build_circuit: Callable[[], Awaitable[Circuit]],
+        destroy_circuit: Callable[[Circuit], Awaitable[None]],
+        size: int = DEFAULT_CIRCUIT_POOL_SIZE,
+        strategy: str = ROUND_ROBIN,
+        renew_margin: float = CIRCUIT_RENEW_MARGIN,
+        max_requests_per_circuit: int = 0,
+    ):
+        super().__init__(size, strategy, renew_margin, max_requests_per_circuit)
+        self.build_circuit = build_circuit
+        self.destroy_circuit = destroy_circuit
+        self._condition: Optional[asyncio.Condition] = None
+        # The event loop only keeps weak references to the tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def warm(self):
+        """
+        Starts building the missing circuits in the background.
+        """
+        async with self._get_condition():
+            self._fill()
+
+    async def acquire(self, timeout: float = CIRCUIT_WAIT_TIMEOUT) -> Circuit:
+        """
+        Same as CircuitPool.acquire.
+        """
+        async with self._get_condition():
+            self._destroy(self._drop_expired_circuits())
+            self._fill()
+
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(self._can_acquire), timeout
+                )
+            except asyncio.TimeoutError:
+                # The lock is held again once the wait is cancelled
+                pass
+
+            return self._pick()
+
+    async def release(self, circuit: Circuit, failed: bool = False):
+        """
+        Same as CircuitPool.release.
+        """
+        async with self._get_condition():
+            self._destroy(self._release(circuit, failed))
+            self._fill()
+            self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def use(self) -> AsyncIterator[Circuit]:
+        """
+        Same as CircuitPool.use.
+        """
+        circuit = await self.acquire()
+
+        try:
+            yield circuit
+        except CircuitError:
+            await self.release(circuit, failed=True)
+            raise
+        except BaseException:
+            await self.release(circuit)
+            raise
+        else:
+            await self.release(circuit)
+
+    async def clear(self):
+        """
+        Same as CircuitPool.clear.
+        """
+        async with self._get_condition():
+            self._destroy(self._retire_all())
+            self._fill()
+
+    async def close(self):
+        """
+        Same as CircuitPool.close.
+        """
+        async with self._get_condition():
+            self._closed = True
+            self._destroy(self._retire_all())
+            self._condition.notify_all()
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so that it belongs to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        return self._condition
+
+    def _fill(self):
+        for _ in range(self._missing_circuits()):
+            self._start(self._build())
+
+    async def _build(self):
+        try:
+            circuit = await self.build_circuit()
+        except Exception:
+            circuit = None
+
+        async with self._condition:
+            self._destroy(self._add(circuit))
+            self._condition.notify_all()
+
+    def _destroy(self, circuits: List[Circuit]):
+        for circuit in circuits:
+            self._start(self.destroy_circuit(circuit))
+
+    def _start(self, coroutine: Awaitable):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -1,13 +1,55 @@
-import random
-from typing import List, Tuple
+import concurrent.futures
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock, Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 import requests
-from cryptography.fernet import Fernet
 
-from domain.tor_message import create_onion_message, peel_response
-from models import TorNode
-
-cheat = {}
+from clients.circuit_mux import CircuitMux, MuxStreamReset
+from clients.circuit_pool import CircuitPool, DEFAULT_CIRCUIT_POOL_SIZE, ROUND_ROBIN
+from domain.circuit import (
+    CIRCUIT_CREATED,
+    CircuitError,
+    CircuitTimeoutError,
+    create_circuit_handshake_message,
+    create_circuit_relay_message,
+    decrypt_from_circuit,
+    encrypt_for_circuit,
+    peel_circuit_response,
+    raise_for_relay_status,
+)
+from domain.compression import (
+    DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    DEFAULT_PAYLOAD_COMPRESSIONS,
+)
+from domain.crypto import DEFAULT_CIPHER_SUITES
+from domain.directory import (
+    DIRECTORY_DELTA_HEADER,
+    DIRECTORY_VERSION_HEADER,
+    DirectoryCache,
+    update_known_nodes,
+)
+from domain.http_message import (
+    HEDGEABLE_HTTP_METHODS,
+    IDEMPOTENT_HTTP_METHODS,
+    decode_raw_http_message,
+    get_http_method,
+    is_connection_failure,
+)
+from domain.latency import LatencyWindow
+from domain.path_selection import DEFAULT_MAX_NODE_SHARE, select_path
+from domain.stream import (
+    decode_stream_chunks,
+    encode_stream_chunks,
+    encode_stream_record,
+    read_stream_records,
+    split_into_chunks,
+    split_raw_http_message,
+)
+from domain.tor_message import TOR_MESSAGE_CONTENT_TYPE
+from models import Circuit, TorNode
 
 
 # noinspection HttpUrlsUsage
@@ -16,58 +58,433 @@ class TorClient:
     This class is responsible for sending messages through the Tor network.
     It uses the registry to retrieve the list of nodes and then builds a path of nodes to send the message through.
     It also encrypts the message using the onion encryption method (layer by layer encryption).
+
+    Paths are used as circuits: a handshake is made once with every node of a path to share a session key
+    with each of them, then the messages are only encrypted using those session keys until the circuit expires.
+    The client keeps a pool of circuits (see CircuitPool) built and replaced in the background, so a message
+    never waits for a circuit to be built.
+
+    If a directory cache path is given, the directory retrieved from the registry is kept in that file. A client
+    starting again then builds its circuits from the cached directory at once (even if the registry is down)
+    and revalidates it in the background.
+
+    The nodes of a path are picked according to the capacity they report and the latency measured by the
+    registry (see select_path), no node taking more than max_node_share of the total weight.
+
+    If multiplex is set, the messages sent through a circuit share a single long-lived connection to its entry node
+    (see CircuitMux), each one in its own stream, instead of a request each.
     """
 
-    def __init__(self, registry_address: Tuple[str, int]):
-        self.path = None
-        self.sym_key = None
+    def __init__(
+        self,
+        registry_address: Tuple[str, int],
+        circuit_pool_size: int = DEFAULT_CIRCUIT_POOL_SIZE,
+        circuit_strategy: str = ROUND_ROBIN,
+        max_requests_per_circuit: int = 0,
+        cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+        directory_cache_path: Optional[str] = None,
+        max_node_share: float = DEFAULT_MAX_NODE_SHARE,
+        hedge_after: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        compressions: Sequence[str] = DEFAULT_PAYLOAD_COMPRESSIONS,
+        compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+        multiplex: bool = False,
+    ):
+        """
+        :param hedge_after: The time (in seconds) after which a GET or HEAD request still waiting for its response
+        is sent again through another circuit, the first response is used (None to never do it)
+        :param hedge_percentile: The percentile (e.g. 95) of the recent response times of the circuits after which a
+        GET or HEAD request is hedged instead, hedge_after is used until enough response times are known (see
+        LatencyWindow)
+        :param compressions: The compressions of the messages and responses exchanged with the exit node of a
+        circuit, by order of preference (the first one supported by the exit node is used, empty to never compress
+        them), see domain.compression
+        :param compression_threshold: The size (in bytes) from which a message is compressed
+        :param multiplex: Whether the messages sent through a circuit are multiplexed over a single connection to
+        its entry node (the streamed messages never are)
+        """
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        # The response times of the last messages sent through a circuit
+        self.latencies = LatencyWindow()
+        self.hedged_requests = 0
+        # The hedged requests answered through the second circuit first
+        self.won_hedges = 0
+        self._hedge_lock = Lock()
+        self._hedge_executor = (
+            ThreadPoolExecutor(thread_name_prefix="TorClientHedge")
+            if hedge_after is not None or hedge_percentile is not None
+            else None
+        )
+        self.max_node_share = max_node_share
+        self.cipher_suites = cipher_suites
+        self.compressions = compressions
+        self.compression_threshold = compression_threshold
+        self.multiplex = multiplex
+        # The multiplexed connections, by id of circuit (at the entry node)
+        self._muxes: Dict[str, CircuitMux] = {}
+        self._muxes_lock = Lock()
         self.known_nodes = []
+        # The version of the directory of the registry the known nodes come from
+        self.directory_version = None
         self.registry_address = registry_address
-        # Instantiates path and crypto
-        self.refresh()
+        self.directory_cache = (
+            DirectoryCache(directory_cache_path, registry_address)
+            if directory_cache_path
+            else None
+        )
+        self.circuits = CircuitPool(
+            self.build_circuit,
+            self.destroy_circuit,
+            size=circuit_pool_size,
+            strategy=circuit_strategy,
+            max_requests_per_circuit=max_requests_per_circuit,
+        )
+
+        if self._load_cached_directory():
+            self._renew_path()
+            Thread(target=self._revalidate_directory, daemon=True).start()
+        else:
+            self.refresh()
 
     def refresh(self, path_length=3):
         """
-        Refreshes the path and the crypto key used to encrypt the message.
+        Retrieves the nodes of the directory, then replaces the circuits (built in the background along new paths).
 
         :param path_length:  The length of the path to build. Should probably be 3 all the time (more than 3 is not
         recommended since it should not result in more security).
         """
 
-        # retrieve nodes from registry
-        nodes_data = requests.get(
-            f"http://{self.registry_address[0]}:{self.registry_address[1]}", timeout=1
-        ).json()
+        self.update_known_nodes()
+        self._renew_path(path_length)
+
+    def update_known_nodes(self) -> bool:
+        """
+        Retrieves the changes made to the directory of the registry since it was last retrieved (the whole
+        directory the first time). Returns whether the known nodes changed.
+        """
+        params = {}
+        headers = {}
+
+        if self.directory_version is not None:
+            params["since"] = self.directory_version
+            headers["If-None-Match"] = f'"{self.directory_version}"'
+
+        response = requests.get(
+            f"http://{self.registry_address[0]}:{self.registry_address[1]}",
+            params=params,
+            headers=headers,
+            timeout=1,
+        )
+
+        if response.status_code == 304:
+            return False
+
+        self.known_nodes = update_known_nodes(
+            self.known_nodes,
+            response.json(),
+            DIRECTORY_DELTA_HEADER in response.headers,
+        )
+        self.directory_version = response.headers.get(DIRECTORY_VERSION_HEADER)
+
+        if self.directory_cache is not None:
+            self.directory_cache.save(self.directory_version, self.known_nodes)
+
+        return True
+
+    def close(self):
+        """
+        Tears down the circuits of the client.
+        """
+        self.circuits.close()
+
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+
+    def _renew_path(self, path_length=3):
+        self.path_length = path_length
+        self.circuits.clear()
+
+    def _load_cached_directory(self) -> bool:
+        if self.directory_cache is None:
+            return False
 
-        # extract nodes from nodes_data
-        self.known_nodes = [
-            TorNode(*address.split(":"), public_key)
-            for address, public_key in nodes_data.items()
-        ]
+        cached_directory = self.directory_cache.load()
 
-        self.sym_key = Fernet.generate_key()
-        self.path = self._generate_path(path_length=path_length)
+        # Paths cannot be built from a directory with too few nodes
+        if cached_directory is None or len(cached_directory.nodes) < 3:
+            return False
+
+        self.known_nodes = cached_directory.nodes
+        self.directory_version = cached_directory.version
+        return True
+
+    def _revalidate_directory(self):
+        if self._try_update_known_nodes():
+            self._renew_path(self.path_length)
+
+    def _try_update_known_nodes(self) -> bool:
+        try:
+            return self.update_known_nodes()
+        except requests.exceptions.RequestException:
+            # The registry is down, the known nodes are used until the next refresh
+            return False
 
     def _generate_path(self, path_length=3) -> List[TorNode]:
-        return random.sample(self.known_nodes, k=path_length)
+        return select_path(self.known_nodes, path_length, self.max_node_share)
+
+    def build_circuit(self, path: Optional[List[TorNode]] = None) -> Circuit:
+        """
+        Builds a new circuit along the given path (a new random path by default). This is the only moment where
+        the public keys of the nodes are used.
+        """
+        if path is None:
+            path = self._generate_path(path_length=self.path_length)
+
+        circuit, handshake_message = create_circuit_handshake_message(
+            path, self.cipher_suites, self.compressions
+        )
+        try:
+            request = requests.post(
+                f"http://{path[0].ip}:{path[0].port}/circuit",
+                handshake_message,
+                headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+                timeout=15,
+            )
+        except requests.exceptions.RequestException:
+            request = None
 
-    def _build_message(self, http_message: str) -> tuple[str, list[bytes]]:
+        if (
+            request is None
+            or request.status_code != 200
+            or peel_circuit_response(circuit, request.content) != CIRCUIT_CREATED
+        ):
+            # A node of the path may have left the network, the registry has removed it from the directory if
+            # so and the next circuits are built without it
+            self._try_update_known_nodes()
+            raise CircuitError("The circuit could not be built")
+
+        return circuit
+
+    def destroy_circuit(self, circuit: Circuit):
         """
-        Builds the message to send through the Tor network.
+        Tears down the given circuit (and closes its multiplexed connection). The nodes would forget it anyway once
+        expired.
         """
-        sym_keys, tor_message = create_onion_message(self.path, http_message)
+        with self._muxes_lock:
+            mux = self._muxes.pop(circuit.circuit_ids[0], None)
+
+        if mux is not None:
+            mux.close()
 
-        return tor_message, sym_keys
+        if circuit.is_expired():
+            return
 
-    def send_http_message(self, message: str) -> str:
+        entry_node = circuit.path[0]
+
+        try:
+            requests.delete(
+                f"http://{entry_node.ip}:{entry_node.port}/circuit/{circuit.circuit_ids[0]}",
+                data=create_circuit_relay_message(circuit, b""),
+                headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+                timeout=2,
+            )
+        except requests.exceptions.RequestException:
+            pass
+
+    def send_http_message(self, message: Union[str, bytes]) -> Union[str, bytes]:
         """
         Sends a message through the Tor network, receives the response and returns it (peeled).
+
+        The message goes through one of the circuits of the pool. If one of the nodes does not know that circuit
+        anymore or the next hop of one of them cannot be reached, the circuit is replaced and the message is sent
+        again through another one. A message whose response did not come back (e.g. timed out) may have reached
+        the target server: it is only sent again if the request is idempotent, CircuitTimeoutError is raised
+        otherwise.
+
+        See hedge_delay for the GET and HEAD requests.
+
+        :param message: The raw HTTP message. The response is returned as is (bytes) for a message given as bytes,
+        and decoded (see decode_raw_http_message) for a message given as text.
         """
-        tor_message, sym_keys = self._build_message(message)
+        raw_message = message.encode("utf-8") if isinstance(message, str) else message
+        hedge_delay = (
+            self.hedge_delay()
+            if get_http_method(raw_message) in HEDGEABLE_HTTP_METHODS
+            else None
+        )
+
+        if hedge_delay is None:
+            response = self._send_with_failover(raw_message)
+        else:
+            response = self._send_hedged(raw_message, hedge_delay)
+
+        return decode_raw_http_message(response) if isinstance(message, str) else response
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Returns the time (in seconds) after which a GET or HEAD request still waiting for its response is sent
+        again through another circuit: the hedge_percentile of the recent response times once enough of them are
+        known, hedge_after otherwise (None to not hedge it).
+        """
+        if self.hedge_percentile is not None:
+            delay = self.latencies.percentile(self.hedge_percentile)
+
+            if delay is not None:
+                return delay
+
+        return self.hedge_after
+
+    def _send_with_failover(self, message: bytes) -> bytes:
+        # Every circuit of the pool may be broken (e.g. after a node restarted), the last attempt then goes through
+        # a new circuit
+        attempts = self.circuits.size + 1
+
+        for attempt in range(attempts):
+            try:
+                with self.circuits.use() as circuit:
+                    start = time.monotonic()
+                    response = self._send_through_circuit(circuit, message)
+                    self.latencies.add(time.monotonic() - start)
+                    return response
+            except CircuitError:
+                if attempt == attempts - 1:
+                    raise
+
+    def _send_hedged(self, message: bytes, hedge_delay: float) -> bytes:
+        first_attempt = self._hedge_executor.submit(self._send_with_failover, message)
+
+        if wait([first_attempt], timeout=hedge_delay).done:
+            return first_attempt.result()
+
+        with self._hedge_lock:
+            self.hedged_requests += 1
+
+        second_attempt = self._hedge_executor.submit(self._send_with_failover, message)
+        attempts = {first_attempt, second_attempt}
+
+        # The first successful response is used, the other attempt ends in the background
+        while attempts:
+            done, attempts = wait(attempts, return_when=FIRST_COMPLETED)
+
+            for attempt in done:
+                if attempt.exception() is None:
+                    if attempt is second_attempt:
+                        with self._hedge_lock:
+                            self.won_hedges += 1
+
+                    return attempt.result()
+
+        return first_attempt.result()
+
+    def _send_through_circuit(self, circuit: Circuit, message: bytes) -> bytes:
+        if self.multiplex:
+            return self._send_through_circuit_mux(circuit, message)
+
+        entry_node = circuit.path[0]
+
+        try:
+            request = requests.post(
+                f"http://{entry_node.ip}:{entry_node.port}/circuit/{circuit.circuit_ids[0]}",
+                create_circuit_relay_message(
+                    circuit, message, self.compression_threshold
+                ),
+                headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+                timeout=15,
+            )
+        except requests.exceptions.RequestException as exception:
+            # A request that was not sent, or an idempotent one, can be sent again through another circuit
+            if (
+                is_connection_failure(exception)
+                or get_http_method(message) in IDEMPOTENT_HTTP_METHODS
+            ):
+                raise CircuitError("The entry node of the circuit did not answer") from exception
+
+            raise CircuitTimeoutError("The response did not come back through the circuit") from exception
+
+        raise_for_relay_status(request.status_code, message)
+
+        return peel_circuit_response(circuit, request.content)
+
+    def _send_through_circuit_mux(self, circuit: Circuit, message: bytes) -> bytes:
+        try:
+            return self._circuit_mux(circuit).send(message, timeout=15)
+        except (MuxStreamReset, concurrent.futures.TimeoutError) as exception:
+            # Same as a request: an idempotent one can be sent again through another circuit
+            if get_http_method(message) in IDEMPOTENT_HTTP_METHODS:
+                raise CircuitError("The multiplexed stream of the circuit failed") from exception
+
+            raise CircuitTimeoutError("The multiplexed stream of the circuit failed") from exception
+
+    def _circuit_mux(self, circuit: Circuit) -> CircuitMux:
+        with self._muxes_lock:
+            mux = self._muxes.get(circuit.circuit_ids[0])
+
+        if mux is not None and not mux.closed:
+            return mux
+
+        # Opened outside of the lock, the messages sent through the other circuits do not wait for it
+        new_mux = CircuitMux(circuit, self.compression_threshold)
+
+        with self._muxes_lock:
+            mux = self._muxes.get(circuit.circuit_ids[0])
+
+            if mux is None or mux.closed:
+                self._muxes[circuit.circuit_ids[0]] = mux = new_mux
+
+        if mux is not new_mux:
+            new_mux.close()
+
+        return mux
+
+    def stream_http_message(
+        self, message: Union[str, bytes], body: Optional[Iterable[bytes]] = None
+    ) -> Iterator[bytes]:
+        """
+        Streams a message through the Tor network: the message is sent in chunks (encrypted one by one) and the
+        response is yielded while it is received, first its head (status line and headers) then the chunks of
+        its body. The memory used does not depend on the size of the message or of the response.
+
+        :param message: The raw HTTP message, or only its head if the body is given separately
+        :param body: The chunks of the body of the message, if not part of the message
+        """
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+
+        head, message_body = split_raw_http_message(message)
+        # The head must be the first chunk, it is not split
+        chunks = itertools.chain(
+            (head,), split_into_chunks(itertools.chain((message_body,), body or ()))
+        )
+
+        with self.circuits.use() as circuit:
+            yield from self._stream_through_circuit(circuit, chunks)
+
+    @staticmethod
+    def _stream_through_circuit(
+        circuit: Circuit, chunks: Iterable[bytes]
+    ) -> Iterator[bytes]:
+        entry_node = circuit.path[0]
+
         request = requests.post(
-            f"http://{self.path[0].ip}:{self.path[0].port}", tor_message, timeout=15
+            f"http://{entry_node.ip}:{entry_node.port}/circuit/{circuit.circuit_ids[0]}/stream",
+            data=(
+                encode_stream_record(encrypt_for_circuit(circuit, chunk))
+                for chunk in encode_stream_chunks(chunks)
+            ),
+            headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+            timeout=15,
+            stream=True,
         )
-        response = request.text
 
-        response = peel_response(response, sym_keys)
-        return response
+        with request:
+            if request.status_code != 200:
+                raise CircuitError(
+                    "The circuit is broken or not known by one of its nodes anymore"
+                )
+
+            yield from decode_stream_chunks(
+                decrypt_from_circuit(circuit, record)
+                for record in read_stream_records(request.raw.read)
+            )
+
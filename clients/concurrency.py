@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+__all__ = (
+    "BoundedThreadPoolMixIn",
+    "DEFAULT_MAX_WORKERS",
+    "DEFAULT_MAX_IN_FLIGHT",
+    "DEFAULT_MAX_DETACHED_REQUESTS",
+)
+
+# The number of threads handling the requests of a server
+DEFAULT_MAX_WORKERS = 32
+
+# The number of requests a server accepts at the same time (being handled or waiting for a thread)
+DEFAULT_MAX_IN_FLIGHT = 128
+
+# The number of long-lived requests a server handles outside of its pool of threads at the same time (see
+# BoundedThreadPoolMixIn.detach_request)
+DEFAULT_MAX_DETACHED_REQUESTS = 256
+
+# The response sent (without even reading the request) when a server has too many requests in flight
+SERVICE_UNAVAILABLE_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+
+class BoundedThreadPoolMixIn:
+    """
+    A socketserver mixin (to put before the server class, e.g. HTTPServer) that handles the requests
+    concurrently in a pool of max_workers threads.
+
+    At most max_in_flight requests are accepted at the same time (being handled or waiting for a
+    thread), the following connections are answered with a 503 until a request is done. This bounds
+    the memory used by a server under load instead of queuing requests forever.
+
+    A long-lived request (e.g. a connection held open for minutes) can be detached from the pool so that it does
+    not hold a worker, at most max_detached_requests at the same time (see detach_request).
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        max_detached_requests: int = DEFAULT_MAX_DETACHED_REQUESTS,
+        **kwargs,
+    ):
+        if max_workers < 1 or max_in_flight < max_workers:
+            raise ValueError(
+                "max_workers must be positive and max_in_flight at least max_workers"
+            )
+
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.max_detached_requests = max_detached_requests
+        # The listen backlog (5 by default) would otherwise drop the connections of a burst of requests
+        self.request_queue_size = max_in_flight
+        self.in_flight_requests = 0
+        self.rejected_requests = 0
+        self._in_flight_lock = Lock()
+        self._detached_requests = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix=type(self).__name__
+        )
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self._in_flight_lock:
+            accepted = self.in_flight_requests < self.max_in_flight
+
+            if accepted:
+                self.in_flight_requests += 1
+            else:
+                self.rejected_requests += 1
+
+        if not accepted:
+            self._reject_request(request)
+            return
+
+        self._executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        # Same as socketserver.ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._in_flight_lock:
+                detached = request in self._detached_requests
+                self.in_flight_requests -= 1
+
+            if not detached:
+                self.shutdown_request(request)
+
+    @property
+    def detached_requests(self) -> int:
+        return len(self._detached_requests)
+
+    def detach_request(self, request) -> bool:
+        """
+        Takes a request out of the pool: the worker handling it is freed (and the request not counted in
+        max_in_flight anymore) as soon as its handler returns, without the request being shut down. The handler
+        must go on in a thread of its own and call release_detached_request once done.
+
+        Returns False if max_detached_requests requests are already detached, the request should then be refused.
+        """
+        with self._in_flight_lock:
+            if len(self._detached_requests) >= self.max_detached_requests:
+                self.rejected_requests += 1
+                return False
+
+            self._detached_requests.add(request)
+            return True
+
+    def release_detached_request(self, request):
+        """
+        Shuts down a request detached with detach_request.
+        """
+        with self._in_flight_lock:
+            self._detached_requests.discard(request)
+
+        self.shutdown_request(request)
+
+    def _reject_request(self, request):
+        try:
+            request.sendall(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,225 @@
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from threading import Event, Lock, Thread
+from typing import Deque, Dict, Optional, Tuple
+
+import requests
+
+from domain import NodeTable
+from models import TorNode
+
+__all__ = (
+    "HealthChecker",
+    "NodeHealth",
+    "DEFAULT_HEALTH_CHECK_INTERVAL",
+    "DEFAULT_HEALTH_CHECK_TIMEOUT",
+    "DEFAULT_MAX_FAILURES",
+    "quantize_latency",
+)
+
+# How often (in seconds) the registry probes every node
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+
+# The time (in seconds) a node has to answer a probe
+DEFAULT_HEALTH_CHECK_TIMEOUT = 2
+
+# The number of probes in a row a node must fail to be removed from the registry
+DEFAULT_MAX_FAILURES = 3
+
+# The number of probes kept in the history of a node
+HEALTH_HISTORY_SIZE = 20
+
+# The weight of the last probe in the latency of a node (exponential moving average)
+LATENCY_SMOOTHING = 0.3
+
+# The number of nodes probed at the same time
+DEFAULT_HEALTH_CHECK_WORKERS = 32
+
+
+@dataclass
+class NodeHealth:
+    """
+    The result of the probes of a node. The history holds the latency (in seconds) of the last probes, None for
+    a failed probe.
+    """
+
+    latency: Optional[float] = None
+    checks: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_check: Optional[float] = None
+    history: Deque[Optional[float]] = field(
+        default_factory=lambda: deque(maxlen=HEALTH_HISTORY_SIZE)
+    )
+
+    def as_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "checks": self.checks,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_check": self.last_check,
+            "history": list(self.history),
+        }
+
+
+class HealthChecker:
+    """
+    Probes the nodes of a NodeTable (GET /key) every interval seconds, all of them at the same time, and records
+    their latency and failures. A node failing max_failures probes in a row is removed from the table, so it
+    leaves the directory and the clients stop building circuits through it. A node answering with other keys
+    (e.g. it restarted without its key store) is updated in the table.
+
+    The latency of each node is published in the directory, rounded (see quantize_latency) so that the table
+    only changes when the latency of a node changes noticeably.
+
+    Each probe opens a new connection: a node that stopped accepting connections could still answer on a
+    connection kept alive, and the latency then includes the connection setup paid by the clients.
+    """
+
+    def __init__(
+        self,
+        nodes: NodeTable,
+        interval: float = DEFAULT_HEALTH_CHECK_INTERVAL,
+        timeout: float = DEFAULT_HEALTH_CHECK_TIMEOUT,
+        max_failures: int = DEFAULT_MAX_FAILURES,
+        workers: int = DEFAULT_HEALTH_CHECK_WORKERS,
+    ):
+        self.nodes = nodes
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.evicted_nodes = 0
+        self._health: Dict[Tuple[str, int], NodeHealth] = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="HealthChecker")
+
+    def start(self):
+        """
+        Starts probing the nodes in the background.
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self._executor.shutdown(wait=True)
+
+    def check_all(self):
+        """
+        Probes every node of the table at the same time, returns once all of them answered or timed out.
+        """
+        nodes = list(self.nodes)
+
+        for node, alive in zip(nodes, self._executor.map(self.check, nodes)):
+            if not alive and self._must_evict(node):
+                self.evict(node)
+
+        with self._lock:
+            # Forget the nodes that left the table
+            for address in [a for a in self._health if a not in self.nodes]:
+                del self._health[address]
+
+    def check(self, node: TorNode) -> bool:
+        """
+        Probes a node and records the result, returns whether it answered.
+        """
+        started_at = time.monotonic()
+
+        try:
+            response = requests.get(
+                f"http://{node.ip}:{node.port}/key",
+                headers={"Connection": "close"},
+                timeout=self.timeout,
+            )
+            alive = response.status_code == 200
+        except requests.exceptions.RequestException:
+            alive = False
+
+        latency = self._record(node, time.monotonic() - started_at if alive else None)
+        current_node = self.nodes.get(node.ip, node.port)
+
+        # The node may have left the table in the meantime
+        if alive and current_node is not None:
+            self.nodes.add(
+                replace(
+                    current_node,
+                    public_key=response.text,
+                    latency=quantize_latency(latency),
+                )
+            )
+
+        return alive
+
+    def evict(self, node: TorNode):
+        if self.nodes.remove(node.ip, node.port) is not None:
+            self.evicted_nodes += 1
+
+    def health(self, ip: str, port: int) -> Optional[NodeHealth]:
+        return self._health.get((ip, int(port)))
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the health of every node, by address.
+        """
+        with self._lock:
+            return {
+                f"{ip}:{port}": health.as_dict()
+                for (ip, port), health in self._health.items()
+            }
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check_all()
+            except RuntimeError:
+                # The interpreter is shutting down the pools of threads
+                return
+
+    def _record(self, node: TorNode, latency: Optional[float]) -> Optional[float]:
+        # Returns the latency of the node (moving average)
+        with self._lock:
+            health = self._health.setdefault((node.ip, int(node.port)), NodeHealth())
+            health.checks += 1
+            health.last_check = time.time()
+            health.history.append(latency)
+
+            if latency is None:
+                health.failures += 1
+                health.consecutive_failures += 1
+            else:
+                health.consecutive_failures = 0
+                health.latency = (
+                    latency
+                    if health.latency is None
+                    else LATENCY_SMOOTHING * latency
+                    + (1 - LATENCY_SMOOTHING) * health.latency
+                )
+
+            return health.latency
+
+    def _must_evict(self, node: TorNode) -> bool:
+        health = self.health(node.ip, node.port)
+        return health is not None and health.consecutive_failures >= self.max_failures
+
+
+def quantize_latency(latency: float) -> float:
+    """
+    Rounds a latency (in seconds) up to the next value of the 1, 2, 5, 10, 20, 50... milliseconds series.
+    """
+    milliseconds = max(latency * 1000, 1)
+    magnitude = 10 ** math.floor(math.log10(milliseconds))
+
+    for step in (1, 2, 5, 10):
+        if milliseconds <= step * magnitude:
+            return step * magnitude / 1000
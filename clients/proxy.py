@@ -1,58 +1,81 @@
 import asyncio
-import sys
+import logging
 
 from mitmproxy import http, options
 from mitmproxy.net.http.http1 import assemble_request
 from mitmproxy.tools import dump
 
-from client import TorClient
+from clients.async_client import AsyncTorClient, DEFAULT_MAX_REQUESTS_PER_CIRCUIT
+from clients.circuit_pool import DEFAULT_CIRCUIT_POOL_SIZE
 from domain.http_message import extract_data_from_http_raw_response
 
-client = None
+# The number of requests the proxy sends through the tor network at the same time, the next ones wait
+DEFAULT_MAX_CONCURRENT_REQUESTS = 64
+
+logger = logging.getLogger(__name__)
 
 
 class RequestLogger:
-    def __init__(self, tor_client):
+    """
+    A mitmproxy addon sending the requests through the tor network. The hook is asynchronous, the proxy keeps
+    handling the other requests (e.g. the subresources of a page) while one goes through the network.
+    """
+
+    def __init__(
+        self,
+        tor_client: AsyncTorClient,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    ):
         self.tor_client = tor_client
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-    def request(self, flow):
+    async def request(self, flow):
         try:
-            assemble = assemble_request(flow.request).decode("utf-8")
+            # The request and the response are relayed as bytes, the binary ones (images, uploads...) are not
+            # altered
+            assemble = assemble_request(flow.request)
 
-            resp = self.tor_client.send_http_message(assemble)
+            async with self._semaphore:
+                resp = await self.tor_client.send(assemble)
             raw_http = extract_data_from_http_raw_response(resp)
             headers = {}
 
             for header_line in raw_http.headers.splitlines():
-                if ": " in header_line:
-                    header_name, header_value = header_line.split(": ")
-                    headers[header_name] = header_value
+                header_name, _, header_value = header_line.partition(": ")
+                headers[header_name] = header_value
 
             flow.response = http.Response.make(
                 raw_http.status_code,  # (optional) status code
-                raw_http.body.encode("utf-8"),  # (optional) content
+                bytes(raw_http.body),  # (optional) content
                 headers,  # (optional) headers
             )
-        except Exception as s:
-            print("NOT WORKING")
-            flow.response = http.Response.make(
-                404,  # (optional) status code
-            )
-        else:
-            print("RESPONDED")
-
+        except Exception:
+            # mitmproxy shows the standard logging records in its event log
+            logger.exception("Could not send %s through the tor network", flow.request.url)
+            flow.response = http.Response.make(502)
 
-async def start_proxy(host, port, tor_registry_address):
-    tor_client = TorClient(tor_registry_address)
 
-    opts = options.Options(listen_host=host, listen_port=port)
+async def start_proxy(
+    host,
+    port,
+    tor_registry_address,
+    max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+    circuit_pool_size=DEFAULT_CIRCUIT_POOL_SIZE,
+    max_requests_per_circuit=DEFAULT_MAX_REQUESTS_PER_CIRCUIT,
+):
+    async with AsyncTorClient(
+        tor_registry_address,
+        circuit_pool_size=circuit_pool_size,
+        max_requests_per_circuit=max_requests_per_circuit,
+    ) as tor_client:
+        opts = options.Options(listen_host=host, listen_port=port)
 
-    master = dump.DumpMaster(
-        opts,
-        with_termlog=False,
-        with_dumper=False,
-    )
-    master.addons.add(RequestLogger(tor_client))
+        master = dump.DumpMaster(
+            opts,
+            with_termlog=False,
+            with_dumper=False,
+        )
+        master.addons.add(RequestLogger(tor_client, max_concurrent_requests))
 
-    await master.run()
-    return master
+        await master.run()
+        return master
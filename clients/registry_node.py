@@ -2,37 +2,61 @@ import json
 import socketserver
 import sys
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import List
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
 
 import requests
 
-from domain import CryptoContainer
+from clients.concurrency import (
+    BoundedThreadPoolMixIn,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_MAX_WORKERS,
+)
+from clients.health_checker import (
+    DEFAULT_HEALTH_CHECK_INTERVAL,
+    DEFAULT_MAX_FAILURES,
+    HealthChecker,
+)
+from domain import KeyStore, NodeTable, load_crypto_container
+from domain import (
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DIRECTORY_DELTA_HEADER,
+    DIRECTORY_VERSION_HEADER,
+    RegistryDirectory,
+)
 from models import TorNode
 
 MAX_NODE_PUBLIC_KEY_ATTEMPT = 2
 
 
 # noinspection HttpUrlsUsage
-class RegistryNodeHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandler):
+class RegistryNodeHTTPHandler(BaseHTTPRequestHandler):
     """
     A simple http handler that acts as a node registry for the tor network. It is quite
     primitive as it is not able to sink itself wit other registires (making the network
     centralized, but it is a good start).
 
-    It has four endpoints:
+    It has six endpoints:
 
         - GET /: returns a json object containing the ip and port of all the nodes in the
-        network and their public key.
+        network and their public key. The response carries the version of the directory (also its ETag), a
+        client sending it back in If-None-Match gets a 304 if nothing changed.
 
-        - POST /add/<port>: adds a node to the list of nodes based on a request from that given node
-        (only the node can be specified in the request, the ip used will be the one used to send the request).
-        The idea behind this is to prevent one ip from registering multiple nodes without even having to change ip.
+        - GET /?since=<version>: same, but only returns the changes made since the given version (see
+        RegistryDirectory.delta), or the whole directory if they are not known anymore.
+
+        - POST /add/<port>[?capacity=<capacity>]: adds a node to the list of nodes based on a request from that
+        given node (only the node can be specified in the request, the ip used will be the one used to send the
+        request). The idea behind this is to prevent one ip from registering multiple nodes without even having to
+        change ip. The node can report its capacity (the number of requests it handles at the same time).
 
         - GET /remove/<port>: removes a node from the list of nodes based on a request from that given node
 
-        - GET /check/<ip>:<port>: checks if a node is still alive and removes it from the list of nodes if it is not.
-        If it is not, it will also remove the node from the list of nodes. This method can be called by anyone
-        contrary to the previous two.
+        - GET /check/<ip>:<port>: checks if a node is still alive and removes it from the list of nodes if it is not
+        (answers with a 404 then). This method can be called by anyone contrary to the previous two.
+
+        - GET /health: returns a json object containing the result of the last probes of each node (see
+        HealthChecker), the nodes are probed in the background.
     """
 
     def __init__(
@@ -40,88 +64,177 @@ class RegistryNodeHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandle
         request: bytes,
         client_address: tuple[str, int],
         server: socketserver.BaseServer,
-        nodes: List[TorNode],
+        nodes: NodeTable,
+        directory: RegistryDirectory,
+        health_checker: HealthChecker,
     ):
         self.nodes = nodes
+        self.directory = directory
+        self.health_checker = health_checker
         super().__init__(request, client_address, server)
 
     def do_GET(self):
-        if self.path == "/":
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-
-            nodes_data = {}
+        url = urlsplit(self.path)
 
-            for node in self.nodes:
-                nodes_data[f"{node.ip}:{node.port}"] = node.public_key
-
-            self.wfile.write(json.dumps(nodes_data).encode("utf-8"))
+        if url.path == "/":
+            self._send_directory(parse_qs(url.query).get("since", [None])[0])
         elif self.path[:8] == "/remove/":
             # extract ip and port from request
             ip = self.client_address[0]
             port = int(self.path[8:])
 
-            # remove node from list
-            self.nodes = [
-                node for node in self.nodes if node.ip != ip and node.port != port
-            ]
+            self.nodes.remove(ip, port)
             self.send_response(200)
             self.end_headers()
-        elif self.path[:6] == "/check/":
+        elif self.path[:7] == "/check/":
             # extract ip and port from request path
-            ip, port = self.path[6:].split(":")
-            node_public_key = self._retrieve_public_key_from_node(ip, port)
-
-            if not node_public_key:
-                # remove node from nodes
-                self.nodes = [
-                    node for node in self.nodes if node.ip != ip and node.port != port
-                ]
+            ip, port = self.path[7:].split(":")
+            node = self.nodes.get(ip, port)
+            alive = node is not None and self.health_checker.check(node)
+
+            if node is not None and not alive:
+                self.health_checker.evict(node)
+
+            self.send_response(200 if alive else 404)
+            self.end_headers()
+        elif self.path == "/health":
+            body = json.dumps(self.health_checker.stats()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self.send_response(404)
             self.end_headers()
 
     def do_POST(self):
         # adds a node to the list of node based on a request from that given node
-        if self.path[:5] == "/add/":
+        url = urlsplit(self.path)
+
+        if url.path[:5] == "/add/":
             # extract ip and port from request
             ip = self.client_address[0]
-            port = int(self.path[5:])
+            capacity = parse_qs(url.query).get("capacity", [None])[0]
+
+            try:
+                port = int(url.path[5:])
+                capacity = int(capacity) if capacity else None
+            except ValueError:
+                port = None
+
+            # The clients pick the nodes in proportion to their capacity, it must be positive
+            if port is None or (capacity is not None and capacity <= 0):
+                self.send_response(400)
+                self.end_headers()
+                return
+
             # retrieve public key from node
             public_key = self._retrieve_public_key_from_node(ip, port)
 
             if public_key:
-                # add node to list
-                self.nodes.append(TorNode(ip, port, public_key))
+                previous_node = self.nodes.get(ip, port)
+                # add node to the table, replacing its previous registration if any (the latency measured by the
+                # health checker is kept)
+                self.nodes.add(
+                    TorNode(
+                        ip,
+                        port,
+                        public_key,
+                        capacity=capacity,
+                        latency=previous_node.latency if previous_node else None,
+                    )
+                )
                 self.send_response(200)
                 self.end_headers()
         else:
             self.send_response(404)
             self.end_headers()
 
+    def _send_directory(self, since: Optional[str]):
+        snapshot = self.directory.snapshot()
+
+        if self.headers.get("If-None-Match") == snapshot.etag or since == snapshot.version:
+            self.send_response(304)
+            self.send_header("ETag", snapshot.etag)
+            self.send_header(DIRECTORY_VERSION_HEADER, snapshot.version)
+            self.end_headers()
+            return
+
+        document = (since and self.directory.delta(since)) or snapshot
+        body = document.body
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header(DIRECTORY_VERSION_HEADER, document.version)
+
+        if document.since is None:
+            self.send_header("ETag", document.etag)
+        else:
+            self.send_header(DIRECTORY_DELTA_HEADER, document.since)
+
+        if document.compressed_body is not None and "gzip" in self.headers.get(
+            "Accept-Encoding", ""
+        ):
+            body = document.compressed_body
+            self.send_header("Content-Encoding", "gzip")
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def _retrieve_public_key_from_node(self, ip, port, n=0):
         try:
             public_key = requests.get(f"http://{ip}:{port}/key", timeout=2).text
         except requests.exceptions.ConnectionError:
             if n < MAX_NODE_PUBLIC_KEY_ATTEMPT:
-                self._retrieve_public_key_from_node(ip, port, n + 1)
+                return self._retrieve_public_key_from_node(ip, port, n + 1)
             public_key = None
         return public_key
 
 
-class RegistryNode(HTTPServer):
+class RegistryNode(BoundedThreadPoolMixIn, HTTPServer):
     def __init__(
         self,
         server_address: tuple[str, int],
         private_key_path=None,
         public_key_path=None,
+        max_workers=DEFAULT_MAX_WORKERS,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        key_store: Optional[KeyStore] = None,
+        compression_threshold: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD,
+        health_check_interval: Optional[float] = DEFAULT_HEALTH_CHECK_INTERVAL,
+        max_failures: int = DEFAULT_MAX_FAILURES,
     ):
-        super().__init__(server_address, RegistryNodeHTTPHandler)
+        """
+        :param compression_threshold: The size (in bytes) from which the directory is sent gzip-compressed to the
+        clients accepting it (None to never compress it)
+        :param health_check_interval: How often (in seconds) the nodes are probed in the background (None to only
+        probe them on /check/)
+        :param max_failures: The number of probes in a row a node must fail to be removed
+        """
+        super().__init__(
+            server_address,
+            RegistryNodeHTTPHandler,
+            max_workers=max_workers,
+            max_in_flight=max_in_flight,
+        )
 
-        self.crypto = CryptoContainer(private_key_path, public_key_path)
+        self.crypto = load_crypto_container(
+            f"registry-{server_address[0]}-{server_address[1]}",
+            key_store,
+            public_key_path=public_key_path,
+            private_key_path=private_key_path,
+        )
         self.http_handler = RegistryNodeHTTPHandler
-        self.nodes: List[TorNode] = []
+        self.nodes = NodeTable()
+        self.directory = RegistryDirectory(self.nodes, compression_threshold)
+        self.health_check_interval = health_check_interval
+        self.health_checker = HealthChecker(
+            self.nodes,
+            interval=health_check_interval or DEFAULT_HEALTH_CHECK_INTERVAL,
+            max_failures=max_failures,
+        )
 
     def get_request(self):
         return super().get_request()
@@ -130,5 +243,22 @@ class RegistryNode(HTTPServer):
         super().handle_request()
 
     def finish_request(self, request, client_address):
-        self.http_handler(request, client_address, self, self.nodes)
+        self.http_handler(
+            request,
+            client_address,
+            self,
+            self.nodes,
+            self.directory,
+            self.health_checker,
+        )
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.health_check_interval is not None:
+            self.health_checker.start()
+
+        super().serve_forever(poll_interval)
+
+    def server_close(self):
+        super().server_close()
+        self.health_checker.stop()
 
@@ -1,23 +1,88 @@
+import http.client
+import io
+import itertools
+import socket
 import socketserver
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+from threading import Lock, Thread
+from typing import Iterator, Optional, Tuple
 
 import requests
-from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
 
-from domain import CryptoContainer
-from domain import send_http_request_from_raw_http_message
+from clients.concurrency import (
+    BoundedThreadPoolMixIn,
+    DEFAULT_MAX_DETACHED_REQUESTS,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_MAX_WORKERS,
+)
+from domain import decrypt_using_symmetric_key, encrypt_using_symmetric_key
+from domain import KeyStore, load_crypto_container
+from domain import CryptoWorkerPool
+from domain import (
+    ConnectionPool,
+    DEFAULT_DNS_TTL,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_MAX_CONNECTIONS_PER_ORIGIN,
+    DnsCache,
+)
+from domain import HttpCache, HttpParseError, send_http_request_from_raw_http_message
+from domain import compress_payload, decompress_payload
 from domain import (
+    decode_final_node_compression,
     decode_tor_message_for_final_node,
     decode_tor_message_for_intermediate_node,
     is_final_node,
+    TOR_MESSAGE_CONTENT_TYPE,
+)
+from domain import (
+    CIRCUIT_CREATED,
+    NOT_FORWARDED_STATUSES,
+    CircuitTable,
+    decode_circuit_handshake_message,
+    relay_failure_status,
 )
+from domain import (
+    ChunkedReader,
+    StreamError,
+    decode_stream_chunks,
+    encode_stream_chunks,
+    encode_stream_record,
+    read_stream_records,
+    send_http_request_stream,
+    write_http_chunk,
+)
+from domain import (
+    MUX_IDLE_TIMEOUT,
+    MUX_RESET_FLAG,
+    MuxConnection,
+    MuxStreamAssembler,
+    encode_mux_frame,
+    encode_mux_message,
+    read_mux_frames,
+)
+from models import CircuitHop
+
+# The time (in seconds) a node keeps an idle connection open (by default), as long as the connection pools of the
+# other nodes reuse it (see DEFAULT_IDLE_TIMEOUT): an idle connection does not hold a worker any longer
+KEEP_ALIVE_TIMEOUT = DEFAULT_IDLE_TIMEOUT
+
+# The time (in seconds) a node waits for the response of the next node
+NEXT_NODE_TIMEOUT = 15
+
+# The errors ending a multiplexed connection (closed, malformed or not encrypted with the session key of the circuit)
+MUX_CONNECTION_ERRORS = (OSError, http.client.HTTPException, StreamError, ValueError, InvalidToken)
+
+# The errors raised by a malformed stream (truncated, out of order or not encrypted with the session key of the
+# circuit), answered with a 400
+MALFORMED_STREAM_ERRORS = (StreamError, InvalidToken)
 
 
 # noinspection HttpUrlsUsage
-class ServerNodeHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandler):
+class ServerNodeHTTPHandler(BaseHTTPRequestHandler):
     """
     A tor node http handler that handles the http requests from the client and the intermediate nodes.
     It decrypts the message, sends it to the next node and encrypts the response.
@@ -28,68 +93,668 @@ class ServerNodeHTTPHandler(socketserver.ThreadingMixIn, BaseHTTPRequestHandler)
 
     - /key: returns the public key of the node
     - (POST) /: handles the http request from the client or the intermediate node
+    - (POST) /circuit: handles a circuit handshake, the node stores the session key and the next hop
+    of the circuit, then forwards the rest of the handshake to the next node
+    - (POST) /circuit/<circuit_id>: handles a message sent through an existing circuit, the message is
+    only encrypted with the session key of the circuit
+    - (POST) /circuit/<circuit_id>/stream: same as above but the message and the response are streamed (with the
+    chunked transfer encoding) as a sequence of records, each record being one chunk of the message encrypted with
+    the session key of the circuit (see domain.stream)
+    - (POST) /circuit/<circuit_id>/mux: a long-lived multiplexed connection for the circuit, the body and the response
+    are sequences of frames (see domain.mux) sent with the chunked transfer encoding at the same time. The node keeps a
+    multiplexed connection to the next node for as long as this one is open, so many messages of the circuit are in
+    flight at the same time on the same connections and each response comes back as soon as it is ready. The
+    connection is handled by a thread of its own instead of a worker of the node (see
+    BoundedThreadPoolMixIn.detach_request), the node answers 503 beyond max_mux_connections
+    - (DELETE) /circuit/<circuit_id>: tears down the circuit on this node and on the next ones
 
+    As exit node, the messages and the responses are compressed when the client asked for it in the layer of the
+    node (see encode_tor_message_for_final_node), the streamed ones are not.
+
+    The connections are kept alive (HTTP/1.1) so that the previous node can reuse them, a connection
+    idle for more than keep_alive_timeout seconds (the idle timeout of the connection pools of the node, which
+    the other nodes are expected to share) is closed to free its thread.
     """
 
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # The headers and the body are written separately, Nagle's algorithm would delay the body on a kept alive
+    # connection
+    disable_nagle_algorithm = True
+
     def __init__(
         self,
         request: bytes,
         client_address: tuple[str, int],
         server: socketserver.BaseServer,
-        crypto: CryptoContainer,
+        crypto_pool: CryptoWorkerPool,
+        circuits: CircuitTable,
+        next_node_pool: ConnectionPool,
+        exit_pool: ConnectionPool,
+        exit_cache: Optional[HttpCache],
+        mux_stream_executor: ThreadPoolExecutor,
+        keep_alive_timeout: float = KEEP_ALIVE_TIMEOUT,
     ):
-        self.crypto = crypto
+        self.timeout = keep_alive_timeout
+        self.crypto_pool = crypto_pool
+        self.circuits = circuits
+        self.next_node_pool = next_node_pool
+        self.exit_pool = exit_pool
+        self.exit_cache = exit_cache
+        self.mux_stream_executor = mux_stream_executor
+        # The circuit of the multiplexed connection handed over to a thread of its own once the request is handled
+        self._mux_circuit: Optional[Tuple[str, CircuitHop]] = None
         super().__init__(request, client_address, server)
 
+    def finish(self):
+        if self._mux_circuit is None:
+            super().finish()
+            return
+
+        # The worker is freed, the connection is finished by the thread of the multiplexed connection
+        Thread(
+            target=self._run_mux_connection, daemon=True, name="ServerNodeMux"
+        ).start()
+
     def do_GET(self):
         # check if path is public key
         if self.path == "/key":
+            public_key = self.crypto_pool.crypto.get_advertised_keys()
             self.send_response(200)
             self.send_header("Content-type", "application/x-pem-file")
+            self.send_header("Content-length", str(len(public_key)))
             self.end_headers()
-            self.wfile.write(self.crypto.get_public_key_bytes())
+            self.wfile.write(public_key)
         elif self.path == "":
-            self.send_response(200)
+            self._send_empty_response(200)
+        else:
+            self._send_empty_response(404)
 
     def do_POST(self):
-        # Retrieve body in string
+        if self.path == "/":
+            self._relay_onion_message()
+        elif self.path == "/circuit":
+            self._create_circuit()
+        elif self.path[:9] == "/circuit/":
+            circuit_id, _, action = self.path[9:].partition("/")
+
+            if not action:
+                self._relay_circuit_message(circuit_id)
+            elif action == "stream":
+                self._relay_circuit_stream(circuit_id)
+            elif action == "mux":
+                self._relay_circuit_mux(circuit_id)
+            else:
+                self._send_empty_response(404)
+        else:
+            self._send_empty_response(404)
+
+    def do_DELETE(self):
+        if self.path[:9] == "/circuit/":
+            self._destroy_circuit(self.path[9:])
+        else:
+            self._send_empty_response(404)
+
+    def _read_body(self) -> bytes:
         content_length = int(self.headers["Content-Length"])
-        body = self.rfile.read(content_length).decode("utf-8")
+        return self.rfile.read(content_length)
 
-        # Decrypt body
-        decrypted_body, sym_key = self.crypto.decrypt(body)
+    def _decrypt(self, message: bytes, sym_key: bytes) -> bytes:
+        return self.crypto_pool.submit(
+            decrypt_using_symmetric_key, message, sym_key
+        ).result()
 
+    def _send_encrypted_response(self, response: bytes, sym_key: bytes):
+        encrypted_response = self.crypto_pool.submit(
+            encrypt_using_symmetric_key, response, sym_key
+        ).result()
         self.send_response(200)
+        self.send_header("Content-type", TOR_MESSAGE_CONTENT_TYPE)
+        self.send_header("Content-length", str(len(encrypted_response)))
+        self.end_headers()
+        self.wfile.write(encrypted_response)
+
+    def _send_encrypted_stream(self, chunks, sym_key: bytes):
+        self.send_response(200)
+        self.send_header("Content-type", TOR_MESSAGE_CONTENT_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        for chunk in chunks:
+            write_http_chunk(
+                self.wfile,
+                encode_stream_record(
+                    self.crypto_pool.submit(
+                        encrypt_using_symmetric_key, chunk, sym_key
+                    ).result()
+                ),
+            )
+
+        write_http_chunk(self.wfile, b"")
+
+    def _send_empty_response(self, status_code: int):
+        self.send_response(status_code)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+    def _send_to_next_node(self, url: str, message: bytes, method="POST"):
+        return self.next_node_pool.request(
+            method,
+            url,
+            data=message,
+            headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+            timeout=NEXT_NODE_TIMEOUT,
+        )
+
+    def _send_to_target_server(self, message: bytes) -> Optional[bytes]:
+        # As exit node, returns None once the failure was answered: 502 if the target server could not be
+        # connected to (the client can send the message again through another circuit), 504 if it may have
+        # received the request (see NOT_FORWARDED_STATUSES)
+        try:
+            return send_http_request_from_raw_http_message(
+                message, self.exit_pool, self.exit_cache
+            )
+        except HttpParseError:
+            self._send_empty_response(400)
+        except requests.exceptions.RequestException as exception:
+            self._send_empty_response(relay_failure_status(exception))
+
+        return None
+
+    def _relay_onion_message(self):
+        # Retrieve body in bytes
+        body = self._read_body()
+
+        # Decrypt body
+        decrypted_body, sym_key = self.crypto_pool.decrypt(body).result()
 
         if is_final_node(decrypted_body):
-            http_message = decode_tor_message_for_final_node(decrypted_body)
+            try:
+                http_message = decode_tor_message_for_final_node(decrypted_body)
+                compression = decode_final_node_compression(decrypted_body)
+            except ValueError:
+                self._send_empty_response(400)
+                return
+
             # Send http message to server
-            response = send_http_request_from_raw_http_message(http_message)
+            response = self._send_to_target_server(http_message)
+
+            if response is None:
+                return
+
+            # The response is compressed before its first encryption, ciphertext does not compress
+            if compression is not None:
+                response = compress_payload(response, compression)
             # Encrypt response using extracted public key
         else:
-            next_node, http_message = decode_tor_message_for_intermediate_node(
+            next_node, tor_message = decode_tor_message_for_intermediate_node(
                 decrypted_body
             )
-            response = requests.post(f"http://{next_node}", http_message).text
-        encrypted_response = Fernet(sym_key).encrypt(response.encode("utf-8"))
-        self.send_header("Content-length", str(len(encrypted_response)))
+            try:
+                next_response = self._send_to_next_node(
+                    f"http://{next_node}", tor_message
+                )
+            except requests.exceptions.RequestException as exception:
+                self._send_empty_response(relay_failure_status(exception))
+                return
+
+            # The status of the next node is forwarded, its (empty) body is not encrypted
+            if next_response.status_code != 200:
+                self._send_empty_response(next_response.status_code)
+                return
+
+            response = next_response.content
+        self._send_encrypted_response(response, sym_key)
+
+    def _create_circuit(self):
+        try:
+            decrypted_body, sym_key = self.crypto_pool.decrypt(
+                self._read_body()
+            ).result()
+            circuit_id, next_circuit_id, tor_message = (
+                decode_circuit_handshake_message(decrypted_body)
+            )
+            final_node = is_final_node(tor_message)
+
+            if final_node:
+                compression = decode_final_node_compression(tor_message)
+            else:
+                next_node, handshake_message = (
+                    decode_tor_message_for_intermediate_node(tor_message)
+                )
+        except (InvalidToken, ValueError):
+            self._send_empty_response(400)
+            return
+
+        if final_node:
+
+            self.circuits.add(circuit_id, sym_key, compression=compression)
+            response = (
+                compress_payload(CIRCUIT_CREATED, compression)
+                if compression is not None
+                else CIRCUIT_CREATED
+            )
+        else:
+            try:
+                next_response = self._send_to_next_node(
+                    f"http://{next_node}/circuit", handshake_message
+                )
+            except requests.exceptions.RequestException:
+                next_response = None
+
+            if next_response is None or next_response.status_code != 200:
+                self._send_empty_response(502)
+                return
+
+            self.circuits.add(circuit_id, sym_key, next_node, next_circuit_id)
+            response = next_response.content
+
+        self._send_encrypted_response(response, sym_key)
+
+    def _relay_circuit_message(self, circuit_id: str):
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            self._send_empty_response(404)
+            return
+
+        try:
+            message = self._decrypt(self._read_body(), circuit.sym_key)
+        except InvalidToken:
+            self._send_empty_response(400)
+            return
+
+        if circuit.next_node is None:
+            if circuit.compression is not None:
+                try:
+                    message = decompress_payload(message)
+                except ValueError:
+                    self._send_empty_response(400)
+                    return
+
+            response = self._send_to_target_server(message)
+
+            if response is None:
+                return
+
+            if circuit.compression is not None:
+                response = compress_payload(response, circuit.compression)
+        else:
+            try:
+                next_response = self._send_to_next_node(
+                    f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}",
+                    message,
+                )
+                status = next_response.status_code
+            except requests.exceptions.RequestException as exception:
+                # The next node is down (the client sends the message again through another circuit) or did not
+                # answer in time
+                status = relay_failure_status(exception)
+
+            if status != 200:
+                if status in NOT_FORWARDED_STATUSES:
+                    # The rest of the circuit is broken, so is this part
+                    self.circuits.remove(circuit_id)
+
+                self._send_empty_response(status)
+                return
+
+            response = next_response.content
+
+        self._send_encrypted_response(response, circuit.sym_key)
+
+    def _relay_circuit_stream(self, circuit_id: str):
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            self._send_empty_response(404)
+            return
+
+        # The records are forwarded while they are received, the end of the body may not have been read once
+        # the response is sent so the connection cannot be reused
+        self.close_connection = True
+
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            body = ChunkedReader(self.rfile)
+        else:
+            body = io.BytesIO(self._read_body())
+
+        messages = (
+            self._decrypt(record, circuit.sym_key)
+            for record in read_stream_records(body.read)
+        )
+
+        if circuit.next_node is None:
+            response_chunks = send_http_request_stream(
+                decode_stream_chunks(messages), self.exit_pool
+            )
+
+            # The status is only sent once the target server answered (the first chunk is the head of its
+            # response), so that a failure is answered as for the other messages (see _send_to_target_server)
+            try:
+                response_head = next(response_chunks)
+            except (HttpParseError, *MALFORMED_STREAM_ERRORS):
+                self._send_empty_response(400)
+                return
+            except requests.exceptions.RequestException as exception:
+                self._send_empty_response(relay_failure_status(exception))
+                return
+
+            self._send_encrypted_stream(
+                encode_stream_chunks(itertools.chain((response_head,), response_chunks)),
+                circuit.sym_key,
+            )
+            return
+
+        try:
+            next_response = self.next_node_pool.request(
+                "POST",
+                f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}/stream",
+                data=(encode_stream_record(message) for message in messages),
+                headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+                # The whole stream may take long to be received, only the time between two reads is limited
+                timeout=(NEXT_NODE_TIMEOUT, NEXT_NODE_TIMEOUT),
+                stream=True,
+            )
+        except MALFORMED_STREAM_ERRORS:
+            self._send_empty_response(400)
+            return
+        except requests.exceptions.RequestException as exception:
+            # Same as _relay_circuit_message
+            next_response = None
+            status = relay_failure_status(exception)
+        else:
+            status = next_response.status_code
+
+        if status != 200:
+            if next_response is not None:
+                next_response.close()
+
+            if status in NOT_FORWARDED_STATUSES:
+                # The rest of the circuit is broken, so is this part
+                self.circuits.remove(circuit_id)
+
+            self._send_empty_response(status)
+            return
+
+        with next_response:
+            self._send_encrypted_stream(
+                read_stream_records(next_response.raw.read), circuit.sym_key
+            )
+
+    def _relay_circuit_mux(self, circuit_id: str):
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            self._send_empty_response(404)
+            return
+
+        if "chunked" not in self.headers.get("Transfer-Encoding", ""):
+            self._send_empty_response(400)
+            return
+
+        # The connection is held until the previous node ends it and is idle between two messages, it does not
+        # hold a worker (see finish)
+        if not self.server.detach_request(self.request):
+            self._send_empty_response(503)
+            return
+
+        self.close_connection = True
+        self._mux_circuit = (circuit_id, circuit)
+
+    def _run_mux_connection(self):
+        circuit_id, circuit = self._mux_circuit
+
+        try:
+            self.connection.settimeout(MUX_IDLE_TIMEOUT)
+            self._mux_lock = Lock()
+            frames = read_mux_frames(ChunkedReader(self.rfile).read)
+
+            if circuit.next_node is None:
+                self._answer_mux_streams(circuit, frames)
+            else:
+                self._relay_mux_frames(circuit_id, circuit, frames)
+        except Exception:
+            self.server.handle_error(self.request, self.client_address)
+        finally:
+            super().finish()
+            self.server.release_detached_request(self.request)
+
+    def _send_mux_head(self):
+        self.send_response(200)
+        self.send_header("Content-type", TOR_MESSAGE_CONTENT_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
-        self.wfile.write(encrypted_response)
 
+    def _send_mux_frame(self, frame: bytes):
+        # The frames are sent by several threads, each one is written whole
+        with self._mux_lock:
+            write_http_chunk(self.wfile, frame)
+
+    def _answer_mux_streams(
+        self, circuit: CircuitHop, frames: Iterator[Tuple[int, int, bytes]]
+    ):
+        self._send_mux_head()
+        assembler = MuxStreamAssembler()
+        streams = set()
+
+        # The messages are sent to the target servers at the same time (in the threads shared by the multiplexed
+        # connections of the node), a slow one does not delay the others
+        try:
+            for stream_id, flags, payload in frames:
+                if not flags & MUX_RESET_FLAG:
+                    payload = self._decrypt(payload, circuit.sym_key)
+
+                message = assembler.feed(stream_id, flags, payload)
+
+                if message is not None:
+                    stream = self.mux_stream_executor.submit(
+                        self._answer_mux_stream, circuit, stream_id, message
+                    )
+                    streams.add(stream)
+                    stream.add_done_callback(streams.discard)
+        except MUX_CONNECTION_ERRORS:
+            pass
+
+        # The previous node ended the connection, the responses of its last messages are sent first
+        wait(list(streams))
+
+        try:
+            self._send_mux_frame(b"")
+        except OSError:
+            pass
+
+    def _answer_mux_stream(self, circuit: CircuitHop, stream_id: int, message: bytes):
+        try:
+            if circuit.compression is not None:
+                message = decompress_payload(message)
 
-class ServerNode(HTTPServer):
+            response = send_http_request_from_raw_http_message(
+                message, self.exit_pool, self.exit_cache
+            )
+
+            if circuit.compression is not None:
+                response = compress_payload(response, circuit.compression)
+
+            frames = self.crypto_pool.submit(
+                encode_mux_message, stream_id, response, [circuit.sym_key]
+            ).result()
+        except Exception:
+            # The client handles a reset stream as a message that could not be relayed
+            frames = [encode_mux_frame(stream_id, MUX_RESET_FLAG)]
+
+        try:
+            for frame in frames:
+                self._send_mux_frame(frame)
+        except OSError:
+            # The previous node is gone
+            pass
+
+    def _relay_mux_frames(
+        self,
+        circuit_id: str,
+        circuit: CircuitHop,
+        frames: Iterator[Tuple[int, int, bytes]],
+    ):
+        try:
+            next_connection = MuxConnection(
+                circuit.next_node, f"/circuit/{circuit.next_circuit_id}/mux"
+            )
+        except (OSError, http.client.HTTPException):
+            next_connection = None
+
+        if next_connection is None or next_connection.status != 200:
+            # The rest of the circuit is broken, so is this part
+            self.circuits.remove(circuit_id)
+            self._send_empty_response(
+                next_connection.status if next_connection is not None else 502
+            )
+            return
+
+        self._send_mux_head()
+        responses = Thread(
+            target=self._relay_mux_responses,
+            args=(circuit_id, circuit, next_connection),
+            daemon=True,
+        )
+        responses.start()
+
+        try:
+            for stream_id, flags, payload in frames:
+                if not flags & MUX_RESET_FLAG:
+                    payload = self._decrypt(payload, circuit.sym_key)
+
+                next_connection.send(encode_mux_frame(stream_id, flags, payload))
+        except MUX_CONNECTION_ERRORS:
+            pass
+        finally:
+            next_connection.end()
+            responses.join()
+            next_connection.close()
+
+    def _relay_mux_responses(
+        self, circuit_id: str, circuit: CircuitHop, next_connection: MuxConnection
+    ):
+        try:
+            for stream_id, flags, payload in next_connection.frames():
+                if not flags & MUX_RESET_FLAG:
+                    payload = self.crypto_pool.submit(
+                        encrypt_using_symmetric_key, payload, circuit.sym_key
+                    ).result()
+
+                self._send_mux_frame(encode_mux_frame(stream_id, flags, payload))
+        except MUX_CONNECTION_ERRORS:
+            # The next node is down, the client sends its messages again through another circuit
+            self.circuits.remove(circuit_id)
+
+        try:
+            self._send_mux_frame(b"")
+            # The connection ends on both sides, the frames still sent by the previous node are not read
+            self.connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def _destroy_circuit(self, circuit_id: str):
+        circuit = self.circuits.get(circuit_id)
+
+        if circuit is None:
+            self._send_empty_response(404)
+            return
+
+        try:
+            # Only the client knows the session key, this proves the request comes from it
+            message = self._decrypt(self._read_body(), circuit.sym_key)
+        except InvalidToken:
+            self._send_empty_response(400)
+            return
+
+        self.circuits.remove(circuit_id)
+
+        if circuit.next_node is not None:
+            try:
+                self._send_to_next_node(
+                    f"http://{circuit.next_node}/circuit/{circuit.next_circuit_id}",
+                    message,
+                    method="DELETE",
+                )
+            except requests.exceptions.RequestException:
+                # The next nodes forget the circuit once expired anyway
+                pass
+
+        self._send_empty_response(200)
+
+
+class ServerNode(BoundedThreadPoolMixIn, HTTPServer):
     def __init__(
         self,
         server_address: tuple[str, int],
         registry_address: tuple[str, int],
         private_key_path=None,
         public_key_path=None,
+        max_workers=DEFAULT_MAX_WORKERS,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        pool_size=DEFAULT_MAX_CONNECTIONS_PER_ORIGIN,
+        pool_idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        crypto_processes=0,
+        key_store: Optional[KeyStore] = None,
+        capacity: Optional[int] = None,
+        exit_cache: Optional[HttpCache] = None,
+        dns_cache_ttl: float = DEFAULT_DNS_TTL,
+        prewarm_origins: int = 0,
+        max_mux_connections: int = DEFAULT_MAX_DETACHED_REQUESTS,
     ):
-        super().__init__(server_address, ServerNodeHTTPHandler)
+        """
+        :param pool_size: The number of connections kept alive to each next node and to each target server
+        :param pool_idle_timeout: The time (in seconds) after which an idle connection is not reused, the node
+        also closes the connections of the other nodes idle for as long
+        :param crypto_processes: The number of processes running the cryptographic operations (0 to run them in
+        the threads handling the requests), see CryptoWorkerPool
+        :param key_store: Where the keys of the node are kept between two runs (unless key paths are given)
+        :param capacity: The capacity reported to the registry, the clients pick the nodes with a larger capacity
+        more often (max_workers by default)
+        :param exit_cache: The cache of the responses to the GET requests sent as exit node, if any
+        :param dns_cache_ttl: The time (in seconds) the addresses of the target servers are kept (0 to resolve them
+        before each new connection), see DnsCache
+        :param prewarm_origins: The number of target servers most requested recently to which a connection is kept
+        ready
+        :param max_mux_connections: The number of multiplexed connections relayed at the same time, each one in a
+        thread of its own (they do not hold the workers), the next ones are answered with a 503. The messages of
+        the multiplexed connections are sent to the target servers in a pool of max_workers threads.
+        """
+        super().__init__(
+            server_address,
+            ServerNodeHTTPHandler,
+            max_workers=max_workers,
+            max_in_flight=max_in_flight,
+            max_detached_requests=max_mux_connections,
+        )
 
-        self.crypto = CryptoContainer(private_key_path, public_key_path)
+        self.crypto = load_crypto_container(
+            f"node-{server_address[0]}-{server_address[1]}",
+            key_store,
+            public_key_path=public_key_path,
+            private_key_path=private_key_path,
+        )
+        self.crypto_pool = CryptoWorkerPool(self.crypto, crypto_processes)
         self.http_handler = ServerNodeHTTPHandler
+        self.circuits = CircuitTable()
+        self.next_node_pool = ConnectionPool(
+            max_connections_per_origin=pool_size, idle_timeout=pool_idle_timeout
+        )
+        self.exit_pool = ConnectionPool(
+            max_connections_per_origin=pool_size,
+            idle_timeout=pool_idle_timeout,
+            dns_cache=DnsCache(dns_cache_ttl) if dns_cache_ttl else None,
+            prewarm_origins=prewarm_origins,
+        )
+        self.exit_cache = exit_cache
+        self.pool_idle_timeout = pool_idle_timeout
+        self.mux_stream_executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="ServerNodeMuxStream"
+        )
         self.registry_address = registry_address
+        self.capacity = capacity or max_workers
 
         # make a request asynchronously to the registry to register the node
         Thread(target=self.register_node).start()
@@ -97,9 +762,41 @@ class ServerNode(HTTPServer):
     def register_node(self):
         time.sleep(1)
         requests.post(
-            f"http://{self.registry_address[0]}:{self.registry_address[1]}/add/{self.server_address[1]}"
+            f"http://{self.registry_address[0]}:{self.registry_address[1]}/add/{self.server_address[1]}",
+            params={"capacity": self.capacity},
         )
 
+    def connection_stats(self) -> dict:
+        """
+        Returns the usage of the pools of connections to the next nodes and to the target servers.
+        """
+        return {
+            "next_node": self.next_node_pool.stats.as_dict(),
+            "exit": self.exit_pool.stats.as_dict(),
+        }
+
+    def crypto_stats(self) -> dict:
+        """
+        Returns the usage of the pool running the cryptographic operations.
+        """
+        return self.crypto_pool.stats()
+
+    def dns_stats(self) -> dict:
+        """
+        Returns the usage of the cache of the addresses of the target servers (see DnsCache.stats) and of the
+        connections opened to them ahead of the requests.
+        """
+        return {
+            "dns_cache": self.exit_pool.dns_stats(),
+            "prewarm": self.exit_pool.prewarm_stats(),
+        }
+
+    def cache_stats(self) -> dict:
+        """
+        Returns the usage of the cache of the responses of the target servers, if any (see HttpCache.stats).
+        """
+        return self.exit_cache.stats() if self.exit_cache is not None else {}
+
     def get_request(self):
         return super().get_request()
 
@@ -107,7 +804,25 @@ class ServerNode(HTTPServer):
         super().handle_request()
 
     def finish_request(self, request, client_address):
-        self.http_handler(request, client_address, self, self.crypto)
+        self.http_handler(
+            request,
+            client_address,
+            self,
+            self.crypto_pool,
+            self.circuits,
+            self.next_node_pool,
+            self.exit_pool,
+            self.exit_cache,
+            self.mux_stream_executor,
+            self.pool_idle_timeout,
+        )
+
+    def server_close(self):
+        super().server_close()
+        self.mux_stream_executor.shutdown(wait=False)
+        self.next_node_pool.close()
+        self.exit_pool.close()
+        self.crypto_pool.shutdown()
 
     def log_message(self, format, *args):
         # TODO: treat log properly
@@ -15,7 +15,7 @@ import time
 
 from clients.auth_server import AuthServerNode
 from clients.client import TorClient
-from domain import extract_data_from_http_raw_response
+from domain import KeyStore, extract_data_from_http_raw_response
 from clients.registry_node import RegistryNode
 from clients.server_node import ServerNode
 
@@ -58,10 +58,14 @@ Host: {domain}
 if __name__ == "__main__":
     registry_port = 8424
     auth_server_port = 7075
+    # The keys are generated on the first run only
+    key_store = KeyStore()
 
     server_nodes = [
         ServerNode(
-            ("localhost", 8080 + i), registry_address=("localhost", registry_port)
+            ("localhost", 8080 + i),
+            registry_address=("localhost", registry_port),
+            key_store=key_store,
         )
         for i in range(10)
     ]
@@ -76,8 +80,8 @@ if __name__ == "__main__":
         def run(self):
             self.server_node.serve_forever()
 
-    registry = RegistryNode(("localhost", registry_port))
-    auth_server = AuthServerNode(("localhost", auth_server_port))
+    registry = RegistryNode(("localhost", registry_port), key_store=key_store)
+    auth_server = AuthServerNode(("localhost", auth_server_port), key_store=key_store)
 
     threads = [Thread(registry), Thread(auth_server)]
     time.sleep(2)
@@ -1,3 +1,17 @@
 from .tor_message import *
+from .http_parser import *
+from .http_cache import *
 from .http_message import *
+from .compression import *
 from .crypto import *
+from .crypto_pool import *
+from .key_store import *
+from .circuit import *
+from .node_table import *
+from .directory import *
+from .path_selection import *
+from .latency import *
+from .dns_cache import *
+from .connection_pool import *
+from .stream import *
+from .mux import *
@@ -0,0 +1,322 @@
+import secrets
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from domain.compression import (
+    DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    DEFAULT_PAYLOAD_COMPRESSIONS,
+    compress_payload,
+    decompress_payload,
+    select_compression,
+)
+from domain.crypto import (
+    DEFAULT_CIPHER_SUITES,
+    decrypt_using_symmetric_key,
+    encrypt_message_using_public_key,
+    encrypt_using_symmetric_key,
+    public_key_cache,
+)
+from domain.http_message import (
+    IDEMPOTENT_HTTP_METHODS,
+    get_http_method,
+    is_connection_failure,
+)
+from domain.tor_message import (
+    encode_tor_message_for_final_node,
+    encode_tor_message_for_intermediate_node,
+)
+from models import Circuit, CircuitHop, TorNode
+
+__all__ = (
+    "CIRCUIT_LIFETIME",
+    "CIRCUIT_CREATED",
+    "NEXT_HOP_UNREACHABLE",
+    "NEXT_HOP_TIMEOUT",
+    "NOT_FORWARDED_STATUSES",
+    "CircuitError",
+    "CircuitTimeoutError",
+    "relay_failure_status",
+    "raise_for_relay_status",
+    "CircuitTable",
+    "create_circuit_handshake_message",
+    "decode_circuit_handshake_message",
+    "create_circuit_relay_message",
+    "peel_circuit_response",
+    "encrypt_for_circuit",
+    "decrypt_from_circuit",
+)
+
+# How long (in seconds) a client uses a circuit before building a new one. Nodes forget a
+# circuit after it has been idle for that long, so a circuit never expires on the node side
+# before it expires on the client side.
+CIRCUIT_LIFETIME = 600
+
+# The message sent back (encrypted by every hop) by the exit node once the circuit is built.
+CIRCUIT_CREATED = b"CREATED"
+
+# The length (in bytes) of a circuit id, circuit ids are written in hex in the urls
+CIRCUIT_ID_LENGTH = 16
+
+# How often (in seconds) a node sweeps its circuit table to drop the expired circuits.
+CIRCUIT_SWEEP_INTERVAL = 60
+
+
+# The status answered by a node when the next node (or the target server, for the exit node) cannot be connected
+# to: the message was not forwarded
+NEXT_HOP_UNREACHABLE = 502
+
+# The status answered by a node when the message was forwarded but its response did not come back (timed out or
+# the connection was lost): the target server may have received it
+NEXT_HOP_TIMEOUT = 504
+
+# The statuses answered when a message was not forwarded by a node: it cannot decrypt it (400), does not know the
+# circuit (404), cannot reach the next hop (502) or is overloaded (503). The message can be sent again through
+# another circuit, after any other error it is only sent again if it is idempotent.
+NOT_FORWARDED_STATUSES = (400, 404, NEXT_HOP_UNREACHABLE, 503)
+
+
+class CircuitError(Exception):
+    """
+    Raised when a circuit could not be built or is not known anymore by one of its hops.
+    """
+
+
+class CircuitTimeoutError(TimeoutError):
+    """
+    Raised when a message was forwarded through a circuit but its response did not come back. The target server
+    may have received it, so unlike after a CircuitError it is not sent again through another circuit.
+    """
+
+
+def relay_failure_status(exception: Exception) -> int:
+    """
+    Returns the status a node answers when sending a message to the next node or to the target server failed with
+    the given exception (see is_connection_failure).
+    """
+    return NEXT_HOP_UNREACHABLE if is_connection_failure(exception) else NEXT_HOP_TIMEOUT
+
+
+def raise_for_relay_status(status: int, message: bytes):
+    """
+    Raises the error matching the status answered by the entry node of a circuit for a message: a CircuitError if
+    the message can be sent again through another circuit (it was not forwarded, or it is idempotent), a
+    CircuitTimeoutError otherwise.
+    """
+    if status == 200:
+        return
+
+    if (
+        status not in NOT_FORWARDED_STATUSES
+        and get_http_method(message) not in IDEMPOTENT_HTTP_METHODS
+    ):
+        raise CircuitTimeoutError("The response did not come back through the circuit")
+
+    raise CircuitError("The circuit is broken or not known by one of its nodes anymore")
+
+
+class CircuitTable:
+    """
+    The table of the circuits going through a node, indexed by circuit id.
+
+    A circuit is forgotten once it has not been used for CIRCUIT_LIFETIME seconds or when
+    the client tears it down.
+    """
+
+    def __init__(self, lifetime: float = CIRCUIT_LIFETIME):
+        self.lifetime = lifetime
+        self._circuits: Dict[str, CircuitHop] = {}
+        self._lock = Lock()
+        self._last_sweep = time.time()
+
+    def add(
+        self,
+        circuit_id: str,
+        sym_key: bytes,
+        next_node: Optional[str] = None,
+        next_circuit_id: Optional[str] = None,
+        compression: Optional[str] = None,
+    ) -> CircuitHop:
+        hop = CircuitHop(
+            circuit_id,
+            sym_key,
+            next_node,
+            next_circuit_id,
+            time.time() + self.lifetime,
+            compression,
+        )
+
+        with self._lock:
+            self._sweep()
+            self._circuits[circuit_id] = hop
+
+        return hop
+
+    def get(self, circuit_id: str) -> Optional[CircuitHop]:
+        """
+        Returns the circuit with the given id (extending its lifetime) or None if it is unknown
+        or expired.
+        """
+        now = time.time()
+
+        with self._lock:
+            hop = self._circuits.get(circuit_id)
+
+            if hop is None:
+                return None
+
+            if hop.expires_at <= now:
+                del self._circuits[circuit_id]
+                return None
+
+            hop.expires_at = now + self.lifetime
+            return hop
+
+    def remove(self, circuit_id: str) -> Optional[CircuitHop]:
+        with self._lock:
+            return self._circuits.pop(circuit_id, None)
+
+    def __len__(self):
+        return len(self._circuits)
+
+    def _sweep(self):
+        # Must be called with the lock held
+        now = time.time()
+
+        if now - self._last_sweep < CIRCUIT_SWEEP_INTERVAL:
+            return
+
+        self._last_sweep = now
+        self._circuits = {
+            circuit_id: hop
+            for circuit_id, hop in self._circuits.items()
+            if hop.expires_at > now
+        }
+
+
+def _generate_circuit_id() -> str:
+    return secrets.token_hex(CIRCUIT_ID_LENGTH)
+
+
+def _encode_circuit_ids(circuit_id: str, next_circuit_id: Optional[str]) -> bytes:
+    # The exit node has no next circuit, its next circuit id is only made of zeros
+    return bytes.fromhex(circuit_id) + (
+        bytes.fromhex(next_circuit_id) if next_circuit_id else bytes(CIRCUIT_ID_LENGTH)
+    )
+
+
+def create_circuit_handshake_message(
+    path: List[TorNode],
+    cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+    compressions: Sequence[str] = DEFAULT_PAYLOAD_COMPRESSIONS,
+) -> Tuple[Circuit, bytes]:
+    """
+    Creates the message used to build a circuit along the given path.
+
+    It is an onion message (see create_onion_message) where the layer of each node also holds
+    the id of the circuit for that node and the id of the circuit for the next node (both on
+    CIRCUIT_ID_LENGTH bytes) before the usual tor message. The symmetric key of each layer
+    becomes the session key shared by the client and that node, so the public key of the nodes
+    is only used once per circuit.
+
+    Each layer uses the first of the given cipher suites supported by its node, see encrypt_message_using_public_key.
+    The payloads exchanged with the exit node are compressed with the first of the given compressions it supports
+    (see create_circuit_relay_message), the layer of the exit node tells it which one.
+    """
+    circuit_ids = [_generate_circuit_id() for _ in path]
+    exit_node_keys = public_key_cache.get(path[-1])
+    compression = select_compression(compressions, exit_node_keys.compressions)
+
+    tor_message = _encode_circuit_ids(
+        circuit_ids[-1], None
+    ) + encode_tor_message_for_final_node(b"", compression)
+    tor_message, sym_key = encrypt_message_using_public_key(
+        tor_message, exit_node_keys, cipher_suites
+    )
+    sym_keys = [sym_key]
+
+    for index in range(len(path) - 2, -1, -1):
+        tor_message = _encode_circuit_ids(
+            circuit_ids[index], circuit_ids[index + 1]
+        ) + encode_tor_message_for_intermediate_node(tor_message, path[index + 1])
+        tor_message, sym_key = encrypt_message_using_public_key(
+            tor_message, public_key_cache.get(path[index]), cipher_suites
+        )
+        sym_keys.insert(0, sym_key)
+
+    circuit = Circuit(
+        path, circuit_ids, sym_keys, time.time() + CIRCUIT_LIFETIME, compression
+    )
+
+    return circuit, tor_message
+
+
+def decode_circuit_handshake_message(message: bytes) -> Tuple[str, str, memoryview]:
+    """
+    Decodes the (decrypted) layer of a circuit handshake message.
+
+    :return: The circuit id for this node, the circuit id for the next node (meaningless for the
+    exit node) and the tor message (see is_final_node and decode_tor_message_for_intermediate_node).
+    Raises a ValueError if the message is truncated.
+    """
+    message = memoryview(message)
+    if len(message) <= 2 * CIRCUIT_ID_LENGTH:
+        raise ValueError("The circuit handshake message is truncated")
+
+    circuit_id = message[:CIRCUIT_ID_LENGTH].hex()
+    next_circuit_id = message[CIRCUIT_ID_LENGTH : 2 * CIRCUIT_ID_LENGTH].hex()
+
+    return circuit_id, next_circuit_id, message[2 * CIRCUIT_ID_LENGTH :]
+
+
+def encrypt_for_circuit(circuit: Circuit, message: bytes) -> bytes:
+    """
+    Encrypts the given message with the session key of every hop of the circuit (exit node
+    first), only symmetric encryption is involved.
+    """
+    for sym_key in circuit.sym_keys[::-1]:
+        message = encrypt_using_symmetric_key(message, sym_key)
+
+    return message
+
+
+def decrypt_from_circuit(circuit: Circuit, message: bytes) -> bytes:
+    """
+    Decrypts a message received through the given circuit (entry node layer first).
+    """
+    for sym_key in circuit.sym_keys:
+        message = decrypt_using_symmetric_key(message, sym_key)
+
+    return message
+
+
+def create_circuit_relay_message(
+    circuit: Circuit,
+    message: Union[str, bytes],
+    compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+) -> bytes:
+    """
+    Builds the message to send through the given circuit, see encrypt_for_circuit. The message is compressed first
+    if the circuit has a compression (see compress_payload).
+    """
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+
+    if circuit.compression is not None:
+        message = compress_payload(message, circuit.compression, compression_threshold)
+
+    return encrypt_for_circuit(circuit, message)
+
+
+def peel_circuit_response(circuit: Circuit, response: bytes) -> bytes:
+    """
+    Peels a response received through the given circuit (entry node layer first), then decompresses it if the
+    circuit has a compression.
+    """
+    response = decrypt_from_circuit(circuit, response)
+
+    if circuit.compression is not None:
+        # A response sent as is is a view of the decrypted response, bytes are returned to the client
+        return bytes(decompress_payload(response))
+
+    return response
@@ -0,0 +1,168 @@
+import zlib
+from typing import Optional, Sequence, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = (
+    "PAYLOAD_COMPRESSION_ZLIB",
+    "PAYLOAD_COMPRESSION_ZSTD",
+    "SUPPORTED_PAYLOAD_COMPRESSIONS",
+    "DEFAULT_PAYLOAD_COMPRESSIONS",
+    "DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD",
+    "MAX_DECOMPRESSED_PAYLOAD_SIZE",
+    "compress_payload",
+    "decompress_payload",
+    "encode_compression",
+    "decode_compression",
+    "select_compression",
+)
+
+# The compressions of the payloads exchanged by a client and the exit node of a circuit. A node advertises the
+# compressions it supports with its public keys, the client uses the first compression of its preference supported
+# by the exit node (zstd is only supported when the zstandard package is installed).
+PAYLOAD_COMPRESSION_ZLIB = "zlib"
+PAYLOAD_COMPRESSION_ZSTD = "zstd"
+
+# zstd first, it compresses about as well as zlib several times faster
+DEFAULT_PAYLOAD_COMPRESSIONS = (PAYLOAD_COMPRESSION_ZSTD, PAYLOAD_COMPRESSION_ZLIB)
+
+SUPPORTED_PAYLOAD_COMPRESSIONS = tuple(
+    compression
+    for compression in DEFAULT_PAYLOAD_COMPRESSIONS
+    if compression != PAYLOAD_COMPRESSION_ZSTD or zstandard is not None
+)
+
+# The size (in bytes) from which a payload is compressed, a smaller one is sent as is (compressing it would save
+# a few bytes at best)
+DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD = 1024
+
+# The size (in bytes) a payload is not decompressed beyond, so that a few bytes cannot fill the memory of a node
+MAX_DECOMPRESSED_PAYLOAD_SIZE = 256 * 1024 * 1024
+
+# The compression of a payload is identified by its first byte (0 when it is not compressed)
+_UNCOMPRESSED_ID = 0
+_COMPRESSION_IDS = {PAYLOAD_COMPRESSION_ZLIB: 1, PAYLOAD_COMPRESSION_ZSTD: 2}
+_COMPRESSION_NAMES = {
+    compression_id: compression
+    for compression, compression_id in _COMPRESSION_IDS.items()
+}
+
+# Fast levels, the payloads are compressed on the path of every request
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+
+def encode_compression(compression: Optional[str]) -> int:
+    """
+    Returns the byte identifying the given compression (0 for None).
+    """
+    return _COMPRESSION_IDS[compression] if compression is not None else _UNCOMPRESSED_ID
+
+
+def decode_compression(compression_id: int) -> Optional[str]:
+    """
+    Returns the compression identified by the given byte (None for 0), raises ValueError if it is not supported.
+    """
+    if compression_id == _UNCOMPRESSED_ID:
+        return None
+
+    compression = _COMPRESSION_NAMES.get(compression_id)
+
+    if compression not in SUPPORTED_PAYLOAD_COMPRESSIONS:
+        raise ValueError(f"Unsupported payload compression: {compression_id}")
+
+    return compression
+
+
+def select_compression(
+    compressions: Sequence[str], supported_compressions: Sequence[str]
+) -> Optional[str]:
+    """
+    Returns the first of the given compressions supported by both the node (see parse_advertised_keys) and this
+    process, None if there is none.
+    """
+    return next(
+        (
+            compression
+            for compression in compressions
+            if compression in supported_compressions
+            and compression in SUPPORTED_PAYLOAD_COMPRESSIONS
+        ),
+        None,
+    )
+
+
+def compress_payload(
+    payload: bytes,
+    compression: Optional[str],
+    threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+) -> bytes:
+    """
+    Compresses a payload with the given compression, prefixed by the byte identifying it. A payload smaller than
+    threshold (or that would not be smaller once compressed) is sent as is, prefixed by 0.
+    """
+    if compression is not None and len(payload) >= threshold:
+        if compression == PAYLOAD_COMPRESSION_ZSTD:
+            compressed_payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+                payload
+            )
+        else:
+            compressed_payload = zlib.compress(payload, ZLIB_LEVEL)
+
+        if len(compressed_payload) < len(payload):
+            return bytes((_COMPRESSION_IDS[compression],)) + compressed_payload
+
+    return bytes((_UNCOMPRESSED_ID,)) + payload
+
+
+def decompress_payload(payload: bytes) -> Union[bytes, memoryview]:
+    """
+    Decompresses a payload compressed with compress_payload (a view of the payload when it was sent as is). Raises
+    ValueError if it is corrupted or larger than MAX_DECOMPRESSED_PAYLOAD_SIZE once decompressed.
+    """
+    payload = memoryview(payload)
+
+    if not payload:
+        raise ValueError("Empty payload")
+
+    compression = decode_compression(payload[0])
+
+    if compression is None:
+        return payload[1:]
+
+    if compression == PAYLOAD_COMPRESSION_ZSTD:
+        return _decompress_zstd(payload[1:])
+
+    return _decompress_zlib(payload[1:])
+
+
+def _decompress_zlib(payload: memoryview) -> bytes:
+    decompressor = zlib.decompressobj()
+
+    try:
+        decompressed_payload = decompressor.decompress(
+            payload, MAX_DECOMPRESSED_PAYLOAD_SIZE
+        )
+    except zlib.error as exception:
+        raise ValueError("Corrupted payload") from exception
+
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Truncated payload or larger than MAX_DECOMPRESSED_PAYLOAD_SIZE")
+
+    return decompressed_payload
+
+
+def _decompress_zstd(payload: memoryview) -> bytes:
+    try:
+        # The compressor writes the size of the payload in the frame, it is checked before any memory is allocated
+        if zstandard.frame_content_size(payload) > MAX_DECOMPRESSED_PAYLOAD_SIZE:
+            raise ValueError("Payload larger than MAX_DECOMPRESSED_PAYLOAD_SIZE")
+
+        return zstandard.ZstdDecompressor().decompress(
+            payload, max_output_size=MAX_DECOMPRESSED_PAYLOAD_SIZE
+        )
+    except zstandard.ZstdError as exception:
+        raise ValueError("Corrupted payload") from exception
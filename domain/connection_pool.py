@@ -0,0 +1,610 @@
+import asyncio
+import socket
+import time
+from collections import defaultdict
+from http.cookiejar import DefaultCookiePolicy
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, PoolManager
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, HTTPError
+from urllib3.util import parse_url
+
+from domain.dns_cache import DnsCache, is_ip_address
+
+__all__ = (
+    "ConnectionPool",
+    "AsyncConnectionPool",
+    "ConnectionPoolStats",
+    "OriginTracker",
+    "DEFAULT_MAX_ORIGINS",
+    "DEFAULT_MAX_CONNECTIONS_PER_ORIGIN",
+    "DEFAULT_IDLE_TIMEOUT",
+    "DEFAULT_PREWARM_INTERVAL",
+    "IDLE_REUSE_MARGIN",
+    "reuse_timeout",
+)
+
+# The number of origins (scheme, host and port) for which connections are kept alive
+DEFAULT_MAX_ORIGINS = 64
+
+# The number of connections kept alive for each origin
+DEFAULT_MAX_CONNECTIONS_PER_ORIGIN = 16
+
+# The time (in seconds) after which an idle connection is closed instead of being reused. The nodes close their
+# idle connections after as long (see ServerNodeHTTPHandler.timeout), so a worker of a node is not held by a
+# connection the other nodes do not reuse anymore.
+DEFAULT_IDLE_TIMEOUT = 4
+
+# The time (in seconds) before its idle timeout from which a connection is not reused anymore, the server may be
+# closing it at that very moment
+IDLE_REUSE_MARGIN = 0.5
+
+# How often (in seconds) a pool opens a connection to each of the origins most requested recently if it has no idle
+# one, it must be lower than the idle timeout for a connection to always be ready
+DEFAULT_PREWARM_INTERVAL = 2
+
+# The time (in seconds) after which a request sent to an origin counts half, so that the origins most requested
+# recently are prewarmed (rather than the ones most requested since the pool was created)
+ORIGIN_COUNT_HALF_LIFE = 60
+
+# The number of requests under which an origin is forgotten
+MIN_ORIGIN_COUNT = 0.1
+
+# The default ports of the schemes of the origins
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# An origin: its scheme, host and port
+Origin = Tuple[str, str, int]
+
+
+def reuse_timeout(idle_timeout: float) -> float:
+    """
+    Returns the time (in seconds) after which an idle connection is not reused anymore, IDLE_REUSE_MARGIN before
+    the server closes it after idle_timeout seconds.
+    """
+    return max(idle_timeout - IDLE_REUSE_MARGIN, 0)
+
+
+class ConnectionPoolStats:
+    """
+    Counts, for each origin, the connections created, the connections reused and the idle connections closed
+    because they expired.
+    """
+
+    EVENTS = ("created", "reused", "expired")
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: dict.fromkeys(self.EVENTS, 0)
+        )
+
+    def record(self, origin: str, event: str):
+        with self._lock:
+            self._counters[origin][event] += 1
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {origin: dict(counters) for origin, counters in self._counters.items()}
+
+
+class OriginTracker:
+    """
+    Counts the requests sent to each origin to find the ones most requested recently: the counts are halved every
+    ORIGIN_COUNT_HALF_LIFE seconds (see decay), so the past requests weigh less and less.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts: Dict[Origin, float] = {}
+
+    def record(self, url: str):
+        parsed_url = parse_url(str(url))
+        scheme = parsed_url.scheme or "http"
+        origin = (scheme, parsed_url.host, parsed_url.port or DEFAULT_PORTS.get(scheme, 80))
+
+        with self._lock:
+            self._counts[origin] = self._counts.get(origin, 0) + 1
+
+    def top(self, count: int) -> List[Origin]:
+        with self._lock:
+            return sorted(self._counts, key=self._counts.get, reverse=True)[:count]
+
+    def decay(self, elapsed: float):
+        """
+        Makes the requests counted weigh less, elapsed seconds after the last call.
+        """
+        factor = 0.5 ** (elapsed / ORIGIN_COUNT_HALF_LIFE)
+
+        with self._lock:
+            self._counts = {
+                origin: requests_count * factor
+                for origin, requests_count in self._counts.items()
+                if requests_count * factor >= MIN_ORIGIN_COUNT
+            }
+
+
+class _DnsCacheConnectionMixIn:
+    """
+    A urllib3 connection resolving its host with a DnsCache (if set), and trying its addresses in turn.
+    """
+
+    dns_cache: Optional[DnsCache] = None
+
+    def _new_conn(self):
+        host = self._dns_host
+
+        if self.dns_cache is None or is_ip_address(host):
+            return super()._new_conn()
+
+        try:
+            addresses = self.dns_cache.resolve(host, self.port)
+        except OSError:
+            # urllib3 resolves it again to report the failure
+            return super()._new_conn()
+
+        try:
+            for index, (_, address) in enumerate(addresses):
+                self._dns_host = address
+
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError:
+                    if index == len(addresses) - 1:
+                        # The host may have moved to other addresses
+                        self.dns_cache.forget(host)
+                        raise
+        finally:
+            self._dns_host = host
+
+
+class _HTTPConnection(_DnsCacheConnectionMixIn, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_DnsCacheConnectionMixIn, HTTPSConnection):
+    pass
+
+
+class _IdleTimeoutPoolMixIn:
+    """
+    A urllib3 connection pool closing the connections idle for too long and recording its usage.
+    """
+
+    pool_stats: ConnectionPoolStats
+    idle_timeout: float
+    dns_cache: Optional[DnsCache]
+
+    def has_idle_connection(self) -> bool:
+        """
+        Returns whether a connection open and not idle for too long is waiting to be used.
+        """
+        now = time.monotonic()
+
+        return any(
+            conn is not None
+            and conn.sock is not None
+            and now - getattr(conn, "last_used", 0) <= reuse_timeout(self.idle_timeout)
+            for conn in list(self.pool.queue)
+        )
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.dns_cache = self.dns_cache
+        return conn
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        origin = f"{self.scheme}://{self.host}:{self.port}"
+
+        if (
+            conn.sock is not None
+            and time.monotonic() - getattr(conn, "last_used", 0)
+            > reuse_timeout(self.idle_timeout)
+        ):
+            # The connection is reopened when used
+            conn.close()
+            self.pool_stats.record(origin, "expired")
+
+        self.pool_stats.record(origin, "created" if conn.sock is None else "reused")
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.last_used = time.monotonic()
+
+        super()._put_conn(conn)
+
+
+class _HTTPConnectionPool(_IdleTimeoutPoolMixIn, HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(_IdleTimeoutPoolMixIn, HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _PoolManager(PoolManager):
+    def __init__(
+        self,
+        *args,
+        pool_stats: ConnectionPoolStats,
+        idle_timeout,
+        dns_cache: Optional[DnsCache],
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+        self.pool_stats = pool_stats
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache
+        # The last pool created for each origin (the pools are also keyed by their TLS settings)
+        self.origin_pools: Dict[Origin, _IdleTimeoutPoolMixIn] = {}
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.pool_stats = self.pool_stats
+        pool.idle_timeout = self.idle_timeout
+        pool.dns_cache = self.dns_cache
+        self.origin_pools[(scheme, host, port)] = pool
+
+        if len(self.origin_pools) > 2 * len(self.pools):
+            # Forget the pools closed by the pool manager
+            self.origin_pools = {
+                origin: origin_pool
+                for origin, origin_pool in self.origin_pools.items()
+                if origin_pool.pool is not None
+            }
+
+        return pool
+
+
+class _PooledHTTPAdapter(HTTPAdapter):
+    def __init__(
+        self,
+        pool_stats: ConnectionPoolStats,
+        idle_timeout,
+        dns_cache: Optional[DnsCache],
+        **kwargs,
+    ):
+        self.pool_stats = pool_stats
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = _PoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            pool_stats=self.pool_stats,
+            idle_timeout=self.idle_timeout,
+            dns_cache=self.dns_cache,
+            **pool_kwargs,
+        )
+
+
+class _ConnectionPrewarmer:
+    """
+    Opens a connection (DNS resolution, TCP and TLS handshakes) to each of the origins most requested recently
+    every interval seconds, unless an idle connection to it is already open, so that the next request to one of
+    those origins does not wait for the connection to be set up. Their addresses are also resolved again before
+    they expire from the DNS cache.
+    """
+
+    def __init__(
+        self,
+        pool_manager: _PoolManager,
+        origins: OriginTracker,
+        size: int,
+        interval: float,
+    ):
+        self.pool_manager = pool_manager
+        self.origins = origins
+        self.size = size
+        self.interval = interval
+        self.rounds = 0
+        self.opened_connections = 0
+        self.failures = 0
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def prewarm(self):
+        """
+        Opens the connections to the origins most requested recently (see the class docstring).
+        """
+        dns_cache = self.pool_manager.dns_cache
+
+        for scheme, host, port in self.origins.top(self.size):
+            try:
+                if (
+                    dns_cache is not None
+                    and not is_ip_address(host)
+                    and dns_cache.expires_in(host) < 2 * self.interval
+                ):
+                    dns_cache.resolve(host, port, refresh=True)
+
+                pool = self.pool_manager.origin_pools.get((scheme, host, port))
+
+                # The pool is closed once it is dropped by the pool manager
+                if (
+                    pool is not None
+                    and pool.pool is not None
+                    and not pool.has_idle_connection()
+                ):
+                    self._open_connection(pool)
+            except (OSError, HTTPError):
+                self.failures += 1
+
+        self.origins.decay(self.interval)
+        self.rounds += 1
+
+    def stats(self) -> dict:
+        return {
+            "rounds": self.rounds,
+            "opened_connections": self.opened_connections,
+            "failures": self.failures,
+            "origins": [f"{s}://{h}:{p}" for s, h, p in self.origins.top(self.size)],
+        }
+
+    def _open_connection(self, pool: _IdleTimeoutPoolMixIn):
+        conn = pool._get_conn()
+
+        try:
+            if conn.sock is None:
+                conn.connect()
+                self.opened_connections += 1
+        except (OSError, HTTPError):
+            conn.close()
+            raise
+        finally:
+            pool._put_conn(conn)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.prewarm()
+
+
+class ConnectionPool:
+    """
+    Keeps the connections alive between requests: one pool of at most max_connections_per_origin
+    connections for each of the max_origins most recently used origins (scheme, host and port).
+    More connections are opened if needed but they are not kept. A connection idle for more than
+    idle_timeout seconds (minus IDLE_REUSE_MARGIN) is closed instead of being reused.
+
+    It can be shared by several threads. Cookies are never stored, since the requests going through a
+    pool may come from different clients.
+
+    With a dns_cache, the hosts are resolved once per TTL instead of before each new connection. With
+    prewarm_origins, a connection to each of the prewarm_origins origins most requested recently is kept ready,
+    see _ConnectionPrewarmer.
+    """
+
+    def __init__(
+        self,
+        max_origins: int = DEFAULT_MAX_ORIGINS,
+        max_connections_per_origin: int = DEFAULT_MAX_CONNECTIONS_PER_ORIGIN,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        dns_cache: Optional[DnsCache] = None,
+        prewarm_origins: int = 0,
+        prewarm_interval: float = DEFAULT_PREWARM_INTERVAL,
+    ):
+        self.stats = ConnectionPoolStats()
+        self.dns_cache = dns_cache
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        adapter = _PooledHTTPAdapter(
+            self.stats,
+            idle_timeout,
+            dns_cache,
+            pool_connections=max_origins,
+            pool_maxsize=max_connections_per_origin,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.origins = OriginTracker() if prewarm_origins else None
+        self.prewarmer = (
+            _ConnectionPrewarmer(
+                adapter.poolmanager, self.origins, prewarm_origins, prewarm_interval
+            )
+            if prewarm_origins
+            else None
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        if self.origins is not None:
+            self.origins.record(url)
+
+        return self.session.request(method, url, **kwargs)
+
+    def dns_stats(self) -> dict:
+        """
+        Returns the usage of the DNS cache, if any (see DnsCache.stats).
+        """
+        return self.dns_cache.stats() if self.dns_cache is not None else {}
+
+    def prewarm_stats(self) -> dict:
+        """
+        Returns the number of connections opened ahead of the requests and the origins they were opened to.
+        """
+        return self.prewarmer.stats() if self.prewarmer is not None else {}
+
+    def close(self):
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+
+        self.session.close()
+
+
+class _DnsCacheResolver(aiohttp.ThreadedResolver):
+    """
+    An aiohttp resolver keeping the addresses it resolves in a DnsCache.
+    """
+
+    def __init__(self, dns_cache: DnsCache):
+        super().__init__()
+        self.dns_cache = dns_cache
+
+    async def resolve(self, host: str, port: int = 0, family=socket.AF_INET):
+        addresses = self.dns_cache.get(host, family)
+
+        if addresses is None:
+            results = await super().resolve(host, port, family)
+            self.dns_cache.put(
+                host, [(result["family"], result["host"]) for result in results], family
+            )
+            return results
+
+        return [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": address_family,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+            for address_family, address in addresses
+        ]
+
+
+class AsyncConnectionPool:
+    """
+    The asyncio counterpart of ConnectionPool, to use as an async context manager. Here at most
+    max_connections_per_origin connections are open at the same time for an origin, the next requests
+    wait for a connection to be free (0 means no limit).
+
+    aiohttp cannot open a connection without sending a request on it, so with prewarm_origins only the
+    addresses of the origins most requested recently are resolved again before they expire from the dns_cache.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_origin: int = 0,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        dns_cache: Optional[DnsCache] = None,
+        prewarm_origins: int = 0,
+        prewarm_interval: float = DEFAULT_PREWARM_INTERVAL,
+    ):
+        self.max_connections_per_origin = max_connections_per_origin
+        self.idle_timeout = idle_timeout
+        self.dns_cache = dns_cache
+        self.prewarm_origins = prewarm_origins
+        self.prewarm_interval = prewarm_interval
+        self.prewarm_rounds = 0
+        self.prewarm_failures = 0
+        self.stats = ConnectionPoolStats()
+        self.origins = OriginTracker() if prewarm_origins else None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._prewarm_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.max_connections_per_origin,
+                keepalive_timeout=reuse_timeout(self.idle_timeout),
+                # The addresses are kept by the DNS cache instead, if any
+                use_dns_cache=self.dns_cache is None,
+                resolver=_DnsCacheResolver(self.dns_cache)
+                if self.dns_cache is not None
+                else None,
+            ),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=[trace_config],
+        )
+
+        if self.origins is not None and self.dns_cache is not None:
+            self._prewarm_task = asyncio.create_task(self._prewarm())
+
+        return self
+
+    async def __aexit__(self, *_):
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+
+        await self.session.close()
+
+    def dns_stats(self) -> dict:
+        """
+        Returns the usage of the DNS cache, if any (see DnsCache.stats).
+        """
+        return self.dns_cache.stats() if self.dns_cache is not None else {}
+
+    def prewarm_stats(self) -> dict:
+        """
+        Returns the number of prewarming rounds and the origins whose addresses are kept resolved.
+        """
+        if self.origins is None:
+            return {}
+
+        return {
+            "rounds": self.prewarm_rounds,
+            "failures": self.prewarm_failures,
+            "origins": [
+                f"{s}://{h}:{p}" for s, h, p in self.origins.top(self.prewarm_origins)
+            ],
+        }
+
+    async def _prewarm(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.prewarm_interval)
+
+            for _, host, port in self.origins.top(self.prewarm_origins):
+                if (
+                    is_ip_address(host)
+                    or self.dns_cache.expires_in(host) >= 2 * self.prewarm_interval
+                ):
+                    continue
+
+                try:
+                    # The system resolver blocks
+                    await loop.run_in_executor(
+                        None, self.dns_cache.resolve, host, port, socket.AF_UNSPEC, True
+                    )
+                except OSError:
+                    self.prewarm_failures += 1
+
+            self.origins.decay(self.prewarm_interval)
+            self.prewarm_rounds += 1
+
+    def request(self, method: str, url: str, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    async def _on_request_start(self, _, context, params: aiohttp.TraceRequestStartParams):
+        context.origin = f"{params.url.scheme}://{params.url.host}:{params.url.port}"
+
+        if self.origins is not None:
+            self.origins.record(params.url)
+
+    async def _on_connection_created(self, _, context, __):
+        self.stats.record(context.origin, "created")
+
+    async def _on_connection_reused(self, _, context, __):
+        self.stats.record(context.origin, "reused")
@@ -1,18 +1,89 @@
-from typing import Tuple
+import base64
+import os
+import re
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional, Sequence, Tuple, Union
 
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from domain.compression import SUPPORTED_PAYLOAD_COMPRESSIONS
+from models import TorNode
+
+# The encrypted symmetric key of a message is prefixed by its length on 2 bytes
+ENCRYPTED_SYM_KEY_LENGTH_FORMAT = "!H"
+ENCRYPTED_SYM_KEY_LENGTH_SIZE = struct.calcsize(ENCRYPTED_SYM_KEY_LENGTH_FORMAT)
 
-ENCRYPTED_SYM_KEY_LENGTH_HEX = 512
+# The number of parsed public keys kept by a PublicKeyCache
+DEFAULT_PUBLIC_KEY_CACHE_SIZE = 1024
+
+# The cipher suites used to encrypt a layer and the messages of a circuit:
+#   - RSA-OAEP to encrypt a Fernet key (AES-128-CBC and HMAC-SHA256)
+#   - an ephemeral X25519 key agreement then ChaCha20-Poly1305 or AES-256-GCM
+# A node advertises the suites it supports with its public keys, the client uses the first suite of its
+# preference supported by a node.
+CIPHER_SUITE_RSA_FERNET = "rsa-oaep-fernet"
+CIPHER_SUITE_X25519_CHACHA20_POLY1305 = "x25519-chacha20poly1305"
+CIPHER_SUITE_X25519_AES_256_GCM = "x25519-aes256gcm"
+
+# AES-GCM first, it is the fastest on the CPUs with AES instructions
+DEFAULT_CIPHER_SUITES = (
+    CIPHER_SUITE_X25519_AES_256_GCM,
+    CIPHER_SUITE_X25519_CHACHA20_POLY1305,
+    CIPHER_SUITE_RSA_FERNET,
+)
+
+# The AEAD suites are identified by one byte in the messages and at the start of their session keys (a Fernet
+# key is base64 encoded, so it never starts with those bytes)
+_AEAD_CIPHER_SUITE_IDS = {
+    CIPHER_SUITE_X25519_CHACHA20_POLY1305: 1,
+    CIPHER_SUITE_X25519_AES_256_GCM: 2,
+}
+_AEAD_CIPHERS = {1: ChaCha20Poly1305, 2: AESGCM}
+AEAD_KEY_SIZE = 32
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+X25519_PUBLIC_KEY_SIZE = 32
+
+# Whether the AEAD ciphers can encrypt into a given buffer (recent versions of cryptography)
+_AEAD_ENCRYPT_INTO = hasattr(AESGCM, "encrypt_into")
+
+# The line listing the suites supported by a node, after its public keys
+CIPHER_SUITES_LINE_PREFIX = "Cipher-Suites:"
+# The line listing the payload compressions supported by a node (see domain.compression)
+COMPRESSIONS_LINE_PREFIX = "Compressions:"
+PEM_PUBLIC_KEY_REGEX = re.compile(
+    r"-----BEGIN PUBLIC KEY-----.+?-----END PUBLIC KEY-----", re.DOTALL
+)
 
 __all__ = (
     "CryptoContainer",
+    "NodePublicKeys",
+    "PublicKeyCache",
+    "public_key_cache",
+    "parse_advertised_keys",
+    "CIPHER_SUITE_RSA_FERNET",
+    "CIPHER_SUITE_X25519_CHACHA20_POLY1305",
+    "CIPHER_SUITE_X25519_AES_256_GCM",
+    "DEFAULT_CIPHER_SUITES",
     "generate_symmetric_key",
     "decrypt_message_using_sha256",
     "encrypt_message_using_public_key",
+    "encrypt_using_symmetric_key",
+    "decrypt_using_symmetric_key",
 )
 
 
@@ -21,10 +92,13 @@ class CryptoContainer:
     A class to help with encryption and decryption of messages using private and public keys pair.
     """
 
-    def __init__(self, public_key_path=None, private_key_path=None):
+    def __init__(
+        self, public_key_path=None, private_key_path=None, x25519_private_key_path=None
+    ):
         """
         Creates a new CryptoContainer object.
         If public_key_path and private_key_path are not provided, a new key pair will be generated.
+        If x25519_private_key_path is not provided, a new X25519 key will be generated.
         """
 
         if public_key_path and private_key_path:
@@ -42,6 +116,57 @@ class CryptoContainer:
         self.public_key = serialization.load_pem_public_key(
             public_key_bytes, backend=default_backend()
         )
+        # Used by the X25519 cipher suites
+        if x25519_private_key_path:
+            self.x25519_private_key = serialization.load_pem_private_key(
+                open(x25519_private_key_path, "rb").read(), password=None
+            )
+        else:
+            self.x25519_private_key = X25519PrivateKey.generate()
+
+    def save(self, public_key_path, private_key_path, x25519_private_key_path):
+        """
+        Writes the keys of this CryptoContainer in PEM format, the private keys are only readable by their owner.
+        """
+        _write_file(public_key_path, self.get_public_key_bytes())
+
+        for path, private_key in (
+            (private_key_path, self.private_key),
+            (x25519_private_key_path, self.x25519_private_key),
+        ):
+            _write_file(
+                path,
+                private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.PKCS8,
+                    encryption_algorithm=serialization.NoEncryption(),
+                ),
+                mode=0o600,
+            )
+
+    def __getstate__(self):
+        # The key objects cannot be pickled (e.g. to be sent to a worker process), their bytes are
+        return {
+            "private_key": self.private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption(),
+            ),
+            "x25519_private_key": self.x25519_private_key.private_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PrivateFormat.Raw,
+                encryption_algorithm=serialization.NoEncryption(),
+            ),
+        }
+
+    def __setstate__(self, state):
+        self.private_key = serialization.load_pem_private_key(
+            state["private_key"], password=None, backend=default_backend()
+        )
+        self.public_key = self.private_key.public_key()
+        self.x25519_private_key = X25519PrivateKey.from_private_bytes(
+            state["x25519_private_key"]
+        )
 
     def get_public_key_bytes(self) -> bytes:
         """
@@ -52,38 +177,320 @@ class CryptoContainer:
             format=serialization.PublicFormat.SubjectPublicKeyInfo,
         )
 
+    def get_advertised_keys(self) -> bytes:
+        """
+        Returns the public keys of this CryptoContainer (RSA then X25519, in PEM format) followed by the
+        cipher suites and the payload compressions it supports, see parse_advertised_keys.
+        """
+        x25519_public_key = self.x25519_private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        cipher_suites = f"{CIPHER_SUITES_LINE_PREFIX} {' '.join(DEFAULT_CIPHER_SUITES)}\n"
+        compressions = (
+            f"{COMPRESSIONS_LINE_PREFIX} {' '.join(SUPPORTED_PAYLOAD_COMPRESSIONS)}\n"
+        )
+
+        return (
+            self.get_public_key_bytes()
+            + x25519_public_key
+            + (cipher_suites + compressions).encode("utf-8")
+        )
+
     def encrypt(self, message):
         """
         Encrypts the given message using the public key of this CryptoContainer.
         """
         return _encrypt_message_using_sha256(message, self.public_key)
 
-    def decrypt(self, message) -> Tuple[str, str]:
+    def decrypt(self, message) -> Tuple[bytes, bytes]:
+        """
+        Decrypts a message encrypted with encrypt_message_using_public_key (whatever its cipher suite).
+        Raises a ValueError or an InvalidToken if the message is truncated or was not encrypted for this node.
+        :return: The message and the session key
+        """
+        # The layers are peeled off views of the message, so its ciphertext is not copied
+        message = memoryview(message)
+        if len(message) <= struct.calcsize(ENCRYPTED_SYM_KEY_LENGTH_FORMAT):
+            raise ValueError("The message is truncated")
+
+        (encrypted_sym_key_length,) = struct.unpack_from(
+            ENCRYPTED_SYM_KEY_LENGTH_FORMAT, message
+        )
+
+        if encrypted_sym_key_length == 0:
+            return _decrypt_message_using_x25519(message, self.x25519_private_key)
+
         return decrypt_message_using_sha256(message, self.private_key)
 
 
+@dataclass
+class NodePublicKeys:
+    """
+    The public keys of a node and the cipher suites and payload compressions it supports, see
+    parse_advertised_keys.
+    """
+
+    rsa_public_key: RSAPublicKey
+    x25519_public_key: Optional[X25519PublicKey]
+    cipher_suites: Tuple[str, ...]
+    compressions: Tuple[str, ...] = ()
+
+
+def parse_advertised_keys(advertised_keys: str) -> NodePublicKeys:
+    """
+    Parses the public keys advertised by a node (see CryptoContainer.get_advertised_keys). The nodes advertising
+    a single RSA public key only support CIPHER_SUITE_RSA_FERNET, the nodes not advertising their payload
+    compressions do not support any.
+    """
+    rsa_public_key = x25519_public_key = None
+
+    for pem_key in PEM_PUBLIC_KEY_REGEX.findall(advertised_keys):
+        public_key = serialization.load_pem_public_key(
+            pem_key.encode("utf-8"), backend=default_backend()
+        )
+
+        if isinstance(public_key, RSAPublicKey):
+            rsa_public_key = public_key
+        elif isinstance(public_key, X25519PublicKey):
+            x25519_public_key = public_key
+
+    if rsa_public_key is None:
+        raise ValueError("The node does not advertise an RSA public key")
+
+    cipher_suites = (CIPHER_SUITE_RSA_FERNET,)
+    compressions = ()
+
+    for line in advertised_keys.splitlines():
+        if line.startswith(CIPHER_SUITES_LINE_PREFIX):
+            cipher_suites = tuple(line[len(CIPHER_SUITES_LINE_PREFIX) :].split())
+        elif line.startswith(COMPRESSIONS_LINE_PREFIX):
+            compressions = tuple(line[len(COMPRESSIONS_LINE_PREFIX) :].split())
+
+    if x25519_public_key is None:
+        cipher_suites = tuple(
+            suite for suite in cipher_suites if suite not in _AEAD_CIPHER_SUITE_IDS
+        )
+
+    return NodePublicKeys(
+        rsa_public_key, x25519_public_key, cipher_suites, compressions
+    )
+
+
+class PublicKeyCache:
+    """
+    Keeps the public keys of the nodes parsed, so that a PEM key is only parsed the first time it is used.
+
+    The keys (see parse_advertised_keys) are indexed by the address of the node and its PEM key (the hash of a string is computed once, so a
+    lookup does not hash the key again), a node that changed its key gets a new entry. At most max_size keys are
+    kept, the least recently used ones are dropped first. It can be shared by several threads.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_PUBLIC_KEY_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys: "OrderedDict[Tuple[str, str], NodePublicKeys]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, node: TorNode) -> NodePublicKeys:
+        """
+        Returns the parsed public keys of the given node.
+        """
+        cache_key = (f"{node.ip}:{node.port}", node.public_key)
+
+        with self._lock:
+            public_key = self._keys.get(cache_key)
+
+            if public_key is not None:
+                self.hits += 1
+                self._keys.move_to_end(cache_key)
+                return public_key
+
+            self.misses += 1
+
+        public_key = parse_advertised_keys(node.public_key)
+
+        with self._lock:
+            self._keys[cache_key] = public_key
+
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+        return public_key
+
+
+# The cache used to build the messages sent to the nodes
+public_key_cache = PublicKeyCache()
+
+
 def encrypt_message_using_public_key(
-    message: str, public_key: bytes
-) -> Tuple[str, bytes]:
-    # load public key from pem format key
+    message: bytes,
+    public_key: Union[bytes, RSAPublicKey, NodePublicKeys],
+    cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+) -> Tuple[bytes, bytes]:
+    """
+    Encrypts the given message for the owner of the given public keys (parsed, or as advertised by the node), using
+    the first of the given cipher suites the node supports (an RSA public key only supports CIPHER_SUITE_RSA_FERNET).
+    :return: The encrypted message and the session key (see encrypt_using_symmetric_key)
+    """
+    if isinstance(public_key, bytes):
+        public_key = parse_advertised_keys(public_key.decode("utf-8"))
+    elif isinstance(public_key, RSAPublicKey):
+        public_key = NodePublicKeys(public_key, None, (CIPHER_SUITE_RSA_FERNET,))
 
-    public_key_rsa = serialization.load_pem_public_key(
-        public_key, backend=default_backend()
+    cipher_suite = next(
+        (suite for suite in cipher_suites if suite in public_key.cipher_suites), None
     )
 
-    return _encrypt_message_using_sha256(message, public_key_rsa)
+    if cipher_suite is None:
+        raise ValueError("The node does not support any of the given cipher suites")
+
+    if cipher_suite == CIPHER_SUITE_RSA_FERNET:
+        return _encrypt_message_using_sha256(message, public_key.rsa_public_key)
+
+    return _encrypt_message_using_x25519(
+        message, public_key.x25519_public_key, cipher_suite
+    )
 
 
 def generate_symmetric_key():
     return Fernet.generate_key()
 
 
+def encrypt_using_symmetric_key(message: bytes, sym_key: bytes) -> bytes:
+    """
+    Encrypts the given message using the given session key, a Fernet key or the key of an AEAD cipher suite
+    (prefixed by the id of its suite).
+
+    A Fernet token is returned in binary, and not base64 encoded, so that encrypting an already
+    encrypted message only adds a constant overhead. An AEAD message is the nonce followed by the
+    ciphertext (and its tag), encrypted in place after the nonce (a bytearray is then returned).
+    """
+    aead = _get_aead_cipher(sym_key)
+
+    if aead is not None:
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+
+        if not _AEAD_ENCRYPT_INTO:
+            return nonce + aead.encrypt(nonce, message, None)
+
+        encrypted_message = bytearray(AEAD_NONCE_SIZE + len(message) + AEAD_TAG_SIZE)
+        encrypted_message[:AEAD_NONCE_SIZE] = nonce
+        aead.encrypt_into(
+            nonce, message, None, memoryview(encrypted_message)[AEAD_NONCE_SIZE:]
+        )
+        return encrypted_message
+
+    # Fernet only encrypts bytes (not the bytearray of an AEAD layer)
+    return base64.urlsafe_b64decode(Fernet(sym_key).encrypt(bytes(message)))
+
+
+def decrypt_using_symmetric_key(message: bytes, sym_key: bytes) -> bytes:
+    """
+    Decrypts a message encrypted with encrypt_using_symmetric_key.
+    Raises cryptography.fernet.InvalidToken if the message was not encrypted using this key.
+    """
+    aead = _get_aead_cipher(sym_key)
+
+    if aead is not None:
+        # Views of the message, the ciphertext is not copied before being decrypted
+        message = memoryview(message)
+
+        try:
+            return aead.decrypt(
+                message[:AEAD_NONCE_SIZE], message[AEAD_NONCE_SIZE:], None
+            )
+        except InvalidTag:
+            raise InvalidToken
+
+    return Fernet(sym_key).decrypt(base64.urlsafe_b64encode(message))
+
+
+def _get_aead_cipher(sym_key: bytes):
+    if len(sym_key) == AEAD_KEY_SIZE + 1 and sym_key[0] in _AEAD_CIPHERS:
+        return _AEAD_CIPHERS[sym_key[0]](sym_key[1:])
+
+    return None
+
+
+def _derive_aead_session_key(
+    shared_key: bytes, ephemeral_public_key: bytes, cipher_suite_id: int
+) -> bytes:
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=AEAD_KEY_SIZE,
+        salt=None,
+        info=b"tor_python session key" + bytes([cipher_suite_id]) + ephemeral_public_key,
+    ).derive(shared_key)
+
+    return bytes([cipher_suite_id]) + key
+
+
+def _encrypt_message_using_x25519(
+    message: bytes, public_key: X25519PublicKey, cipher_suite: str
+) -> Tuple[bytes, bytes]:
+    """
+    Agrees on a session key with the owner of the public key using an ephemeral X25519 key, then encrypts the
+    message using the session key.
+
+    The result is a null length on 2 bytes (it marks the X25519 messages, an encrypted symmetric key is never
+    empty), the id of the cipher suite (1 byte), the ephemeral public key (32 bytes) and the encrypted message.
+    """
+    cipher_suite_id = _AEAD_CIPHER_SUITE_IDS[cipher_suite]
+    ephemeral_private_key = X25519PrivateKey.generate()
+    ephemeral_public_key = ephemeral_private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+    sym_key = _derive_aead_session_key(
+        ephemeral_private_key.exchange(public_key), ephemeral_public_key, cipher_suite_id
+    )
+
+    return (
+        struct.pack(ENCRYPTED_SYM_KEY_LENGTH_FORMAT, 0)
+        + bytes([cipher_suite_id])
+        + ephemeral_public_key
+        + encrypt_using_symmetric_key(message, sym_key),
+        sym_key,
+    )
+
+
+def _decrypt_message_using_x25519(
+    message: bytes, private_key: X25519PrivateKey
+) -> Tuple[bytes, bytes]:
+    cipher_suite_id = message[ENCRYPTED_SYM_KEY_LENGTH_SIZE]
+
+    if cipher_suite_id not in _AEAD_CIPHERS:
+        raise InvalidToken
+
+    public_key_start = ENCRYPTED_SYM_KEY_LENGTH_SIZE + 1
+    encrypted_message_start = public_key_start + X25519_PUBLIC_KEY_SIZE
+    ephemeral_public_key = bytes(message[public_key_start:encrypted_message_start])
+
+    sym_key = _derive_aead_session_key(
+        private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_public_key)),
+        ephemeral_public_key,
+        cipher_suite_id,
+    )
+
+    return (
+        decrypt_using_symmetric_key(message[encrypted_message_start:], sym_key),
+        sym_key,
+    )
+
+
 def _encrypt_message_using_sha256(
-    message: str, public_key: RSAPublicKey
-) -> Tuple[str, bytes]:
+    message: bytes, public_key: RSAPublicKey
+) -> Tuple[bytes, bytes]:
     """
     Starts by generating a symmetric key, encrypts it using the public key provided
     and then encrypts the message using the symmetric key.
+
+    The result is the length of the encrypted symmetric key (2 bytes), the encrypted symmetric key
+    and the encrypted message.
     """
     sym_key = generate_symmetric_key()
 
@@ -96,17 +503,28 @@ def _encrypt_message_using_sha256(
         ),
     )
 
-    encrypted_message = Fernet(sym_key).encrypt(bytes(message, "utf-8"))
+    encrypted_message = encrypt_using_symmetric_key(message, sym_key)
 
-    return sym_key_message_part.hex() + encrypted_message.decode("utf-8"), sym_key
+    return (
+        struct.pack(ENCRYPTED_SYM_KEY_LENGTH_FORMAT, len(sym_key_message_part))
+        + sym_key_message_part
+        + encrypted_message,
+        sym_key,
+    )
 
 
-def decrypt_message_using_sha256(message: str, private_key) -> Tuple[str, str]:
+def decrypt_message_using_sha256(message: bytes, private_key) -> Tuple[bytes, bytes]:
     """
     Decrypts the given message using the given private key.
     It first decrypts the symmetric key and then decrypts the message using the symmetric key.
     """
-    encrypted_sym_key = bytes.fromhex(message[:ENCRYPTED_SYM_KEY_LENGTH_HEX])
+    (encrypted_sym_key_length,) = struct.unpack_from(
+        ENCRYPTED_SYM_KEY_LENGTH_FORMAT, message
+    )
+    encrypted_message_start = ENCRYPTED_SYM_KEY_LENGTH_SIZE + encrypted_sym_key_length
+    encrypted_sym_key = bytes(
+        message[ENCRYPTED_SYM_KEY_LENGTH_SIZE:encrypted_message_start]
+    )
 
     sym_key = private_key.decrypt(
         encrypted_sym_key,
@@ -118,13 +536,16 @@ def decrypt_message_using_sha256(message: str, private_key) -> Tuple[str, str]:
     )
 
     return (
-        Fernet(sym_key)
-        .decrypt(message[ENCRYPTED_SYM_KEY_LENGTH_HEX:].encode())
-        .decode("utf-8"),
+        decrypt_using_symmetric_key(message[encrypted_message_start:], sym_key),
         sym_key,
     )
 
 
+def _write_file(path, content: bytes, mode=0o644):
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "wb") as file:
+        file.write(content)
+
+
 def _generate_public_and_private_key_pair(bits=2048):
     """
     Generates a new public and private key pair.
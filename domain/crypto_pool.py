@@ -0,0 +1,107 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+from domain.crypto import CryptoContainer
+
+__all__ = ("CryptoWorkerPool",)
+
+# The keys of the node, loaded once by each worker process
+_worker_crypto: Optional[CryptoContainer] = None
+
+
+def _load_worker_crypto(crypto: CryptoContainer):
+    global _worker_crypto
+    _worker_crypto = crypto
+
+
+def _decrypt_in_worker(message: bytes) -> Tuple[bytes, bytes]:
+    return _worker_crypto.decrypt(message)
+
+
+class CryptoWorkerPool:
+    """
+    Runs the cryptographic operations of a node in a pool of worker processes, so that a busy node uses all the
+    cores instead of one (the operations of the threads of a single process are serialized by the GIL). Each
+    worker loads the keys of the node once, when it starts. With 0 workers, the operations run in the calling
+    thread.
+
+    The operations return a concurrent.futures.Future. The number of operations submitted and not done yet
+    (queue_depth) and its peak are recorded, see stats.
+    """
+
+    def __init__(self, crypto: CryptoContainer, workers: int = 0):
+        self.crypto = crypto
+        self.workers = workers
+        self._executor = (
+            ProcessPoolExecutor(
+                workers, initializer=_load_worker_crypto, initargs=(crypto,)
+            )
+            if workers
+            else None
+        )
+        self._lock = Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.completed_jobs = 0
+
+    def decrypt(self, message: bytes) -> "Future[Tuple[bytes, bytes]]":
+        """
+        Decrypts a message with the keys of the node, see CryptoContainer.decrypt.
+        """
+        if self._executor is None:
+            return self._run_inline(self.crypto.decrypt, message)
+
+        return self._submit(_decrypt_in_worker, message)
+
+    def submit(self, function: Callable, *args) -> Future:
+        """
+        Runs a function (not using the keys of the node, e.g. encrypt_using_symmetric_key) in the pool. It must be
+        defined at the top level of a module, so that it can be sent to the workers.
+        """
+        if self._executor is None:
+            return self._run_inline(function, *args)
+
+        return self._submit(function, *args)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "completed_jobs": self.completed_jobs,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, function: Callable, *args) -> Future:
+        self._job_started()
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _run_inline(self, function: Callable, *args) -> Future:
+        future = Future()
+        self._job_started()
+
+        try:
+            future.set_result(function(*args))
+        except Exception as exception:
+            future.set_exception(exception)
+        finally:
+            self._job_done(future)
+
+        return future
+
+    def _job_started(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def _job_done(self, _: Future):
+        with self._lock:
+            self.queue_depth -= 1
+            self.completed_jobs += 1
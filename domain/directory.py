@@ -0,0 +1,270 @@
+import gzip
+import json
+import os
+import secrets
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+
+from domain.node_table import NodeTable
+from models import TorNode
+
+__all__ = (
+    "DirectorySnapshot",
+    "CachedDirectory",
+    "DirectoryCache",
+    "RegistryDirectory",
+    "DIRECTORY_VERSION_HEADER",
+    "DIRECTORY_DELTA_HEADER",
+    "DEFAULT_COMPRESSION_THRESHOLD",
+    "update_known_nodes",
+)
+
+# The version of the directory sent back by the registry (also its ETag), to send back in ?since= to only get
+# the changes made since then
+DIRECTORY_VERSION_HEADER = "Directory-Version"
+
+# Set (to the version the changes start from) when the registry only sends the changes made since a version
+DIRECTORY_DELTA_HEADER = "Directory-Delta"
+
+# The size (in bytes) from which a directory document is also kept gzip-compressed
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+
+@dataclass
+class DirectorySnapshot:
+    """
+    A serialized directory document, ready to be sent as is.
+    """
+
+    version: str
+    body: bytes
+    compressed_body: Optional[bytes] = None
+    # The version the changes start from, if the document only holds the changes made since then
+    since: Optional[str] = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+
+class RegistryDirectory:
+    """
+    The directory served by a registry: the address and the public key of every node of a NodeTable.
+
+    The document is serialized (and compressed if large) only once per version of the table, as are the
+    documents holding the changes made since a given version (see delta), so serving many clients polling the
+    directory costs almost nothing.
+
+    A version is made of a random epoch (drawn when the registry starts) and of the version of the table, so the
+    versions of a registry that restarted are never mistaken for the versions of the previous one.
+    """
+
+    def __init__(
+        self,
+        nodes: NodeTable,
+        compression_threshold: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD,
+    ):
+        """
+        :param compression_threshold: The size (in bytes) from which a document is also kept compressed (None to
+        never compress them)
+        """
+        self.nodes = nodes
+        self.compression_threshold = compression_threshold
+        self.epoch = secrets.token_hex(4)
+        self._lock = Lock()
+        self._snapshot: Optional[DirectorySnapshot] = None
+        # The documents holding the changes made since a version, for the current version only
+        self._deltas: Dict[str, DirectorySnapshot] = {}
+
+    @property
+    def version(self) -> str:
+        return self._format_version(self.nodes.version)
+
+    def snapshot(self) -> DirectorySnapshot:
+        """
+        Returns the whole directory, a JSON object mapping the address of each node to its public key (or to an
+        object with its public key, capacity and latency if they are known).
+        """
+        snapshot = self._snapshot
+
+        if snapshot is not None and snapshot.version == self.version:
+            return snapshot
+
+        with self._lock:
+            version, nodes = self.nodes.snapshot()
+            snapshot = self._snapshot
+
+            if snapshot is None or snapshot.version != self._format_version(version):
+                snapshot = self._serialize(
+                    version,
+                    _encode_nodes(nodes),
+                )
+                self._snapshot = snapshot
+
+            return snapshot
+
+    def delta(self, since: str) -> Optional[DirectorySnapshot]:
+        """
+        Returns the changes made to the directory since the given version: a JSON object with the nodes added
+        or replaced ("nodes", like the whole directory) and the addresses of the nodes removed ("removed").
+        Returns None if those changes are not known, the whole directory must then be sent.
+        """
+        epoch, _, table_version = since.partition("-")
+
+        if epoch != self.epoch or not table_version.isdigit():
+            return None
+
+        with self._lock:
+            delta = self._deltas.get(since)
+
+            if delta is not None and delta.version == self.version:
+                return delta
+
+            changes = self.nodes.changes_since(int(table_version))
+
+            if changes is None:
+                return None
+
+            version, added_nodes, removed_addresses = changes
+            delta = self._serialize(
+                version,
+                {
+                    "nodes": _encode_nodes(added_nodes),
+                    "removed": [f"{ip}:{port}" for ip, port in removed_addresses],
+                },
+                since=since,
+            )
+
+            if any(d.version != delta.version for d in self._deltas.values()):
+                self._deltas.clear()
+
+            self._deltas[since] = delta
+            return delta
+
+    def _serialize(
+        self, table_version: int, document: dict, since: Optional[str] = None
+    ) -> DirectorySnapshot:
+        body = json.dumps(document).encode("utf-8")
+        compressed_body = None
+
+        if (
+            self.compression_threshold is not None
+            and len(body) >= self.compression_threshold
+        ):
+            compressed_body = gzip.compress(body)
+
+        return DirectorySnapshot(
+            self._format_version(table_version), body, compressed_body, since
+        )
+
+    def _format_version(self, table_version: int) -> str:
+        return f"{self.epoch}-{table_version}"
+
+
+def update_known_nodes(
+    known_nodes: List[TorNode], document: dict, delta: bool
+) -> List[TorNode]:
+    """
+    Returns the nodes known by a client once it received a directory document from the registry, the whole
+    directory or only its changes (see RegistryDirectory).
+    """
+    if not delta:
+        return [_decode_node(address, entry) for address, entry in document.items()]
+
+    nodes = {f"{node.ip}:{node.port}": node for node in known_nodes}
+
+    for address in document["removed"]:
+        nodes.pop(address, None)
+
+    for address, entry in document["nodes"].items():
+        nodes[address] = _decode_node(address, entry)
+
+    return list(nodes.values())
+
+
+def _encode_nodes(nodes: List[TorNode]) -> dict:
+    # A node is described by its public key, and by an object if its capacity or latency is known
+    return {
+        f"{node.ip}:{node.port}": (
+            node.public_key
+            if node.capacity is None and node.latency is None
+            else {
+                "public_key": node.public_key,
+                "capacity": node.capacity,
+                "latency": node.latency,
+            }
+        )
+        for node in nodes
+    }
+
+
+def _decode_node(address: str, entry: Union[str, dict]) -> TorNode:
+    if isinstance(entry, str):
+        return TorNode(*address.split(":"), entry)
+
+    return TorNode(
+        *address.split(":"),
+        entry["public_key"],
+        capacity=entry.get("capacity"),
+        latency=entry.get("latency"),
+    )
+
+
+@dataclass
+class CachedDirectory:
+    """
+    The directory last retrieved by a client, see DirectoryCache.
+    """
+
+    version: Optional[str]
+    fetched_at: float
+    nodes: List[TorNode]
+
+
+class DirectoryCache:
+    """
+    Keeps the directory last retrieved from a registry in a file, so that a client starting again can build its
+    circuits at once (and while the registry is down) and revalidate the directory in the background.
+    """
+
+    def __init__(self, path: str, registry_address: Tuple[str, int]):
+        self.path = path
+        self.registry = f"{registry_address[0]}:{registry_address[1]}"
+
+    def load(self) -> Optional[CachedDirectory]:
+        """
+        Returns the cached directory, or None if there is none (or if it comes from another registry).
+        """
+        try:
+            with open(self.path, "r") as file:
+                document = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if document.get("registry") != self.registry:
+            return None
+
+        return CachedDirectory(
+            document["version"],
+            document["fetched_at"],
+            update_known_nodes([], document["nodes"], delta=False),
+        )
+
+    def save(self, version: Optional[str], nodes: List[TorNode]):
+        """
+        Replaces the cached directory, the file is never seen half written.
+        """
+        document = {
+            "registry": self.registry,
+            "version": version,
+            "fetched_at": time.time(),
+            "nodes": _encode_nodes(nodes),
+        }
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(temporary_path, "w") as file:
+            json.dump(document, file)
+
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,149 @@
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional, Tuple
+
+__all__ = (
+    "DnsCache",
+    "DEFAULT_DNS_TTL",
+    "DEFAULT_DNS_CACHE_SIZE",
+    "is_ip_address",
+)
+
+# The time (in seconds) the addresses of a host are kept. The system resolver does not give the TTL of the records
+# it returns, this is the longest the addresses are used without asking it again (a local caching resolver, e.g.
+# systemd-resolved or nscd, then answers with the TTL of the records in mind).
+DEFAULT_DNS_TTL = 30
+
+# The number of hosts whose addresses are kept
+DEFAULT_DNS_CACHE_SIZE = 1024
+
+# An address: its family (socket.AF_INET or socket.AF_INET6) and the IP address
+Address = Tuple[int, str]
+
+
+class DnsCache:
+    """
+    Keeps the addresses of the hosts resolved by the system resolver for ttl seconds, so that a node sending many
+    requests to the same target servers does not resolve their name before each new connection.
+
+    The addresses of at most max_size hosts are kept, the least recently used ones are dropped first. The
+    failures are not kept. It can be shared by several threads.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL, max_size: int = DEFAULT_DNS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.prefetches = 0
+        self._lock = Lock()
+        # The addresses and the time they expire, by host and family
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[List[Address], float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host: str, family: int = socket.AF_UNSPEC) -> Optional[List[Address]]:
+        """
+        Returns the addresses of a host if they are known and did not expire, None otherwise.
+        """
+        key = (host.lower(), family)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, host: str, addresses: List[Address], family: int = socket.AF_UNSPEC):
+        key = (host.lower(), family)
+
+        with self._lock:
+            self._entries[key] = (addresses, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def resolve(
+        self, host: str, port: int = 0, family: int = socket.AF_UNSPEC, refresh=False
+    ) -> List[Address]:
+        """
+        Returns the addresses of a host, resolved by the system resolver if they are not known (or if refresh is
+        set, to resolve them before they expire). Raises socket.gaierror if the host cannot be resolved.
+        """
+        addresses = None if refresh else self.get(host, family)
+
+        if addresses is None:
+            addresses = _getaddrinfo(host, port, family)
+            self.put(host, addresses, family)
+
+            if refresh:
+                with self._lock:
+                    self.prefetches += 1
+
+        return addresses
+
+    def expires_in(self, host: str, family: int = socket.AF_UNSPEC) -> float:
+        """
+        Returns the time (in seconds) before the addresses of a host expire, 0 if they are not known.
+        """
+        entry = self._entries.get((host.lower(), family))
+        return max(0.0, entry[1] - time.monotonic()) if entry is not None else 0.0
+
+    def forget(self, host: str):
+        """
+        Drops the addresses of a host, e.g. when none of them can be connected to.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == host.lower()]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "prefetches": self.prefetches,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "hosts": len(self._entries),
+            }
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return True
+    except ValueError:
+        return False
+
+
+def _getaddrinfo(host: str, port: int, family: int) -> List[Address]:
+    addresses = []
+
+    for address_family, _, _, _, socket_address in socket.getaddrinfo(
+        host, port, family, socket.SOCK_STREAM
+    ):
+        address = (address_family, socket_address[0])
+
+        if address not in addresses:
+            addresses.append(address)
+
+    return addresses
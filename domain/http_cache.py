@@ -0,0 +1,607 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+
+__all__ = (
+    "HttpCache",
+    "CachedResponse",
+    "DEFAULT_HTTP_CACHE_SIZE",
+    "freshness_lifetime",
+)
+
+# The memory (in bytes) used by the responses kept by an HttpCache
+DEFAULT_HTTP_CACHE_SIZE = 64 * 1024 * 1024
+
+# The status codes a response can be stored with without an explicit lifetime (RFC 9110 section 15.1), its
+# lifetime is then guessed from its Last-Modified header
+HEURISTICALLY_CACHEABLE_STATUS_CODES = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+# The lifetime guessed for a response is this fraction of the time since it was last modified, up to a day
+HEURISTIC_FRESHNESS_FRACTION = 0.1
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+# The request headers making the response depend on the client, or on what the client already has: the requests
+# holding one of them are sent to the target server as is
+CACHE_BYPASS_REQUEST_HEADERS = (
+    "authorization",
+    "range",
+    "if-match",
+    "if-none-match",
+    "if-modified-since",
+    "if-unmodified-since",
+    "if-range",
+)
+
+# The size counted for an entry on top of its body and headers
+CACHE_ENTRY_OVERHEAD = 256
+
+# The suffix of the files of the disk tier
+CACHE_FILE_SUFFIX = ".entry"
+
+
+@dataclass
+class CachedResponse:
+    """
+    A response kept by an HttpCache, its headers as relayed (see domain.http_message).
+
+    Its age is counted from stored_at, the time it was received, and starts at initial_age (the age the target
+    server or the caches before it gave it).
+    """
+
+    status_code: int
+    reason: str
+    url: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+    stored_at: float
+    lifetime: float
+    initial_age: float = 0
+    # The names of the request headers the response depends on, and their values in the request
+    vary: Tuple[Tuple[str, str], ...] = ()
+    must_revalidate: bool = False
+
+    @property
+    def size(self) -> int:
+        return (
+            len(self.body)
+            + sum(len(name) + len(value) for name, value in self.headers)
+            + CACHE_ENTRY_OVERHEAD
+        )
+
+    def age(self, now: Optional[float] = None) -> float:
+        return self.initial_age + max(0.0, (now or time.time()) - self.stored_at)
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return not self.must_revalidate and self.age(now) < self.lifetime
+
+    def get_header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        return next((v for n, v in self.headers if n.lower() == name), None)
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Returns the headers making a request conditional on this response having changed.
+        """
+        validators = {}
+        etag = self.get_header("ETag")
+        last_modified = self.get_header("Last-Modified")
+
+        if etag is not None:
+            validators["If-None-Match"] = etag
+        if last_modified is not None:
+            validators["If-Modified-Since"] = last_modified
+
+        return validators
+
+
+class HttpCache:
+    """
+    A shared HTTP cache (RFC 9111) for the responses to the GET requests sent by an exit node, so that a resource
+    fetched by many clients through the same exit node only costs a round trip to its target server once per
+    lifetime.
+
+    A response is stored unless its Cache-Control forbids it (no-store, private) and is served while it is fresh,
+    for the lifetime given by its Cache-Control (s-maxage, max-age) or Expires header, or guessed from its
+    Last-Modified header. A stale response with an ETag or a Last-Modified header is revalidated: the request is
+    sent with If-None-Match / If-Modified-Since and a 304 answer renews it. The responses with a Vary header are
+    stored once per value of the headers they vary on.
+
+    A node relays the requests of many clients: the requests authenticating their client (or asking for a part
+    of a resource, or conditional on what their client has) are never served from the cache, the responses
+    setting a cookie are never stored, and the responses to the requests sending a cookie are only stored when
+    they are public.
+
+    The responses kept take at most max_size bytes of memory, the least recently used ones are dropped first, or
+    moved to the disk tier (a directory, holding at most max_disk_size bytes) if a path is given. It can be
+    shared by several threads.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_HTTP_CACHE_SIZE,
+        path: Optional[str] = None,
+        max_disk_size: Optional[int] = None,
+    ):
+        """
+        :param max_size: The memory (in bytes) used by the responses kept
+        :param path: The directory of the disk tier, None to only keep the responses in memory
+        :param max_disk_size: The space (in bytes) used by the disk tier (10 times max_size by default)
+        """
+        self.max_size = max_size
+        self.path = path
+        self.max_disk_size = max_disk_size if max_disk_size is not None else 10 * max_size
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self._lock = Lock()
+        self._disk_lock = Lock()
+        self._entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+        # The entries of the disk tier and their size, least recently used first
+        self._disk_entries: "OrderedDict[Tuple, int]" = OrderedDict()
+        # The names of the headers the responses to an url vary on, and the keys of the entries of the url
+        self._vary: Dict[str, Tuple[str, ...]] = {}
+        self._variants: Dict[str, Set[Tuple]] = {}
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._load_disk_entries()
+
+    def __len__(self):
+        return len(self._entries) + len(self._disk_entries)
+
+    @staticmethod
+    def is_cacheable_request(method: str, request_headers: Mapping[str, str]) -> bool:
+        """
+        Returns whether the response to a request can be looked up in the cache and stored.
+        """
+        if method != "GET":
+            return False
+
+        names = {name.lower() for name in request_headers}
+
+        if any(name in names for name in CACHE_BYPASS_REQUEST_HEADERS):
+            return False
+
+        return "no-store" not in _cache_control(
+            _get_header(request_headers, "Cache-Control")
+        )
+
+    def lookup(
+        self, url: str, request_headers: Mapping[str, str]
+    ) -> Optional[CachedResponse]:
+        """
+        Returns the response stored for a request (see is_cacheable_request), fresh or not, or None. A fresh
+        response is counted as a hit, unless the request asks for a revalidation (Cache-Control: no-cache or
+        max-age=0), the other lookups as misses.
+        """
+        with self._lock:
+            key = (url, self._vary_values(url, request_headers))
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and key in self._disk_entries:
+            entry = self._load_from_disk(key)
+
+            if entry is not None:
+                self._add(key, entry)
+
+        with self._lock:
+            if entry is not None and self.is_usable(entry, request_headers):
+                self.hits += 1
+                self.bytes_saved += len(entry.body)
+            else:
+                self.misses += 1
+
+        return entry
+
+    @staticmethod
+    def is_usable(entry: CachedResponse, request_headers: Mapping[str, str]) -> bool:
+        """
+        Returns whether a stored response can be sent without being revalidated.
+        """
+        return entry.is_fresh() and not _asks_revalidation(request_headers)
+
+    def store(
+        self,
+        url: str,
+        request_headers: Mapping[str, str],
+        response: CachedResponse,
+        response_headers: Mapping[str, str],
+    ) -> bool:
+        """
+        Stores the response to a request (see is_cacheable_request) if it can be, replacing the one stored for
+        the same request. Returns whether it was stored.
+        :param response_headers: The headers of the response as sent by the target server
+        """
+        cache_control = _cache_control(_get_header(response_headers, "Cache-Control"))
+        vary = _get_header(response_headers, "Vary")
+
+        if (
+            "no-store" in cache_control
+            or "private" in cache_control
+            or _get_header(response_headers, "Set-Cookie") is not None
+            or (vary is not None and "*" in vary)
+            or (
+                _get_header(request_headers, "Cookie") is not None
+                and "public" not in cache_control
+                and "s-maxage" not in cache_control
+            )
+        ):
+            return False
+
+        lifetime = freshness_lifetime(response.status_code, response_headers)
+        revalidable = response.get_header("ETag") or response.get_header("Last-Modified")
+
+        if lifetime <= 0 and not revalidable:
+            return False
+
+        vary_names = tuple(
+            sorted({name.strip().lower() for name in (vary or "").split(",") if name.strip()})
+        )
+        response = replace(
+            response,
+            lifetime=lifetime,
+            initial_age=_initial_age(response_headers, response.stored_at),
+            vary=tuple((name, _get_header(request_headers, name) or "") for name in vary_names),
+            must_revalidate="no-cache" in cache_control,
+        )
+
+        with self._lock:
+            if self._vary.get(url) != vary_names:
+                # The responses to the url now vary on other headers, the ones stored are not found anymore
+                self._remove_url(url)
+                self._vary[url] = vary_names
+
+            self.stores += 1
+
+        self._add((url, tuple(value for _, value in response.vary)), response)
+        return True
+
+    def revalidated(
+        self, url: str, entry: CachedResponse, response_headers: Mapping[str, str]
+    ) -> CachedResponse:
+        """
+        Renews the response stored for an url after its target server answered 304 (Not Modified) to a request made
+        conditional with its validators, returns it with the headers of the 304 response.
+        """
+        updated_headers = {name.lower(): (name, value) for name, value in response_headers.items()}
+        headers = [
+            updated_headers.pop(name.lower(), (name, value))
+            for name, value in entry.headers
+        ]
+        headers.extend(
+            header
+            for name, header in updated_headers.items()
+            if name in ("cache-control", "expires", "etag", "last-modified", "date")
+        )
+        stored_at = time.time()
+        merged_headers = dict(headers)
+        renewed_entry = replace(
+            entry,
+            headers=headers,
+            stored_at=stored_at,
+            lifetime=freshness_lifetime(entry.status_code, merged_headers),
+            initial_age=_initial_age(response_headers, stored_at),
+            must_revalidate="no-cache"
+            in _cache_control(_get_header(merged_headers, "Cache-Control")),
+        )
+
+        with self._lock:
+            # The lookup counted it as a miss
+            self.misses -= 1
+            self.revalidations += 1
+            self.bytes_saved += len(entry.body)
+
+        self._add((url, tuple(value for _, value in entry.vary)), renewed_entry)
+        return renewed_entry
+
+    def invalidate(self, url: str):
+        """
+        Drops the responses stored for an url, after a request changing the resource (e.g. POST) succeeded.
+        """
+        with self._lock:
+            self._remove_url(url)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits, misses and revalidations, the hit ratio (the revalidations are counted as hits,
+        the body was not sent again) and the bytes of body served without being sent by the target servers.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses + self.revalidations
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "hit_ratio": (self.hits + self.revalidations) / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self.size,
+                "disk_entries": len(self._disk_entries),
+                "disk_size": self.disk_size,
+            }
+
+    def _vary_values(self, url: str, request_headers: Mapping[str, str]) -> Tuple[str, ...]:
+        return tuple(
+            _get_header(request_headers, name) or "" for name in self._vary.get(url, ())
+        )
+
+    def _add(self, key: Tuple, entry: CachedResponse):
+        # The entries dropped from the memory are moved to the disk tier, if any
+        evicted_entries = []
+
+        with self._lock:
+            previous_entry = self._entries.pop(key, None)
+
+            if previous_entry is not None:
+                self.size -= previous_entry.size
+
+            self._variants.setdefault(key[0], set()).add(key)
+            self._entries[key] = entry
+            self.size += entry.size
+
+            while self.size > self.max_size:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.size -= evicted_entry.size
+                self.evictions += 1
+
+                if self.path is not None:
+                    evicted_entries.append((evicted_key, evicted_entry))
+                elif evicted_key not in self._disk_entries:
+                    self._forget_variant(evicted_key)
+
+        for evicted_key, evicted_entry in evicted_entries:
+            self._save_to_disk(evicted_key, evicted_entry)
+
+    def _remove_url(self, url: str):
+        # The lock must be held
+        for key in self._variants.pop(url, ()):
+            entry = self._entries.pop(key, None)
+
+            if entry is not None:
+                self.size -= entry.size
+
+            if key in self._disk_entries:
+                self.disk_size -= self._disk_entries.pop(key)
+                _remove_file(self._file_path(key))
+
+        self._vary.pop(url, None)
+
+    def _forget_variant(self, key: Tuple):
+        # The lock must be held
+        variants = self._variants.get(key[0])
+
+        if variants is not None:
+            variants.discard(key)
+
+            if not variants:
+                del self._variants[key[0]]
+                self._vary.pop(key[0], None)
+
+    def _file_path(self, key: Tuple) -> str:
+        name = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + CACHE_FILE_SUFFIX)
+
+    def _save_to_disk(self, key: Tuple, entry: CachedResponse):
+        # The metadata of the entry (a JSON line) then its body, the file is never seen half written
+        metadata = {
+            "key": key,
+            "vary_names": self._vary.get(key[0], ()),
+            "status_code": entry.status_code,
+            "reason": entry.reason,
+            "url": entry.url,
+            "headers": entry.headers,
+            "stored_at": entry.stored_at,
+            "lifetime": entry.lifetime,
+            "initial_age": entry.initial_age,
+            "vary": entry.vary,
+            "must_revalidate": entry.must_revalidate,
+        }
+        path = self._file_path(key)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+
+        with self._disk_lock:
+            try:
+                with open(temporary_path, "wb") as file:
+                    file.write(json.dumps(metadata).encode("utf-8") + b"\n")
+                    file.write(entry.body)
+
+                os.replace(temporary_path, path)
+            except OSError:
+                return
+
+            self._add_disk_entry(key, os.path.getsize(path))
+
+    def _add_disk_entry(self, key: Tuple, size: int):
+        removed_keys = []
+
+        with self._lock:
+            self.disk_size += size - self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = size
+            self._variants.setdefault(key[0], set()).add(key)
+
+            while self.disk_size > self.max_disk_size and self._disk_entries:
+                removed_key, removed_size = self._disk_entries.popitem(last=False)
+                self.disk_size -= removed_size
+                removed_keys.append(removed_key)
+
+                if removed_key not in self._entries:
+                    self._forget_variant(removed_key)
+
+        for removed_key in removed_keys:
+            _remove_file(self._file_path(removed_key))
+
+    def _load_from_disk(self, key: Tuple) -> Optional[CachedResponse]:
+        # The entry leaves the disk tier, it is written again if it is dropped from the memory
+        with self._disk_lock:
+            path = self._file_path(key)
+            entry = _read_entry_file(path)
+
+            with self._lock:
+                if key in self._disk_entries:
+                    self.disk_size -= self._disk_entries.pop(key)
+
+            _remove_file(path)
+
+        return entry[1] if entry is not None else None
+
+    def _load_disk_entries(self):
+        # The disk tier survives the node, the entries left by a previous run are used again
+        files = [
+            os.path.join(self.path, name)
+            for name in os.listdir(self.path)
+            if name.endswith(CACHE_FILE_SUFFIX)
+        ]
+
+        for path in sorted(files, key=os.path.getmtime):
+            metadata = _read_entry_metadata(path)
+
+            if metadata is None:
+                _remove_file(path)
+                continue
+
+            key = (metadata["key"][0], tuple(metadata["key"][1]))
+            self._vary[key[0]] = tuple(metadata["vary_names"])
+            self._add_disk_entry(key, os.path.getsize(path))
+
+
+def freshness_lifetime(status_code: int, headers: Mapping[str, str]) -> float:
+    """
+    Returns the time (in seconds) a response stays fresh once received, given its headers (RFC 9111 section 4.2.1),
+    0 if it must be revalidated before being used again.
+    """
+    cache_control = _cache_control(_get_header(headers, "Cache-Control"))
+
+    for directive in ("s-maxage", "max-age"):
+        if directive in cache_control:
+            try:
+                return max(0, int(cache_control[directive]))
+            except ValueError:
+                return 0
+
+    date = _parse_http_date(_get_header(headers, "Date")) or time.time()
+    expires = _get_header(headers, "Expires")
+
+    if expires is not None:
+        # An invalid date (e.g. 0) means the response already expired
+        expires_at = _parse_http_date(expires)
+        return max(0.0, expires_at - date) if expires_at is not None else 0
+
+    last_modified = _parse_http_date(_get_header(headers, "Last-Modified"))
+
+    if last_modified is not None and status_code in HEURISTICALLY_CACHEABLE_STATUS_CODES:
+        return min(
+            max(0.0, date - last_modified) * HEURISTIC_FRESHNESS_FRACTION,
+            MAX_HEURISTIC_FRESHNESS,
+        )
+
+    return 0
+
+
+def _initial_age(headers: Mapping[str, str], received_at: float) -> float:
+    # The age of a response when it was received (RFC 9111 section 4.2.3)
+    try:
+        age = float(_get_header(headers, "Age") or 0)
+    except ValueError:
+        age = 0
+
+    date = _parse_http_date(_get_header(headers, "Date"))
+    apparent_age = max(0.0, received_at - date) if date is not None else 0
+
+    return max(age, apparent_age)
+
+
+def _asks_revalidation(request_headers: Mapping[str, str]) -> bool:
+    cache_control = _cache_control(_get_header(request_headers, "Cache-Control"))
+
+    return (
+        "no-cache" in cache_control
+        or cache_control.get("max-age") == "0"
+        or "no-cache" in (_get_header(request_headers, "Pragma") or "")
+    )
+
+
+def _cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    # The directives of a Cache-Control header, by lowercase name
+    directives = {}
+
+    for directive in (value or "").split(","):
+        name, _, argument = directive.partition("=")
+        name = name.strip().lower()
+
+        if name:
+            directives[name] = argument.strip().strip('"') if argument else None
+
+    return directives
+
+
+def _get_header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    value = headers.get(name)
+
+    if value is not None:
+        return value
+
+    name = name.lower()
+    return next((v for n, v in headers.items() if n.lower() == name), None)
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _read_entry_metadata(path: str) -> Optional[dict]:
+    try:
+        with open(path, "rb") as file:
+            return json.loads(file.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def _read_entry_file(path: str) -> Optional[Tuple[dict, CachedResponse]]:
+    try:
+        with open(path, "rb") as file:
+            metadata = json.loads(file.readline())
+            body = file.read()
+    except (OSError, ValueError):
+        return None
+
+    return metadata, CachedResponse(
+        metadata["status_code"],
+        metadata["reason"],
+        metadata["url"],
+        [tuple(header) for header in metadata["headers"]],
+        body,
+        metadata["stored_at"],
+        metadata["lifetime"],
+        metadata["initial_age"],
+        tuple(tuple(value) for value in metadata["vary"]),
+        metadata["must_revalidate"],
+    )
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
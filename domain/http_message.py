@@ -1,7 +1,21 @@
+import itertools
 import re
+import time
+from typing import AsyncIterator, Iterator, List, Mapping, Optional, Tuple, Union
 
+import aiohttp
 import requests
+from urllib3.exceptions import ConnectTimeoutError
 
+from domain.connection_pool import ConnectionPool
+from domain.http_cache import CachedResponse, HttpCache
+from domain.http_parser import (
+    HTTP_HEAD_ENCODING,
+    HttpHead,
+    HttpMessageParser,
+    HttpParseError,
+)
+from domain.stream import STREAM_CHUNK_SIZE
 from models import RawHttpRequest, RawHttpResponse
 
 __all__ = (
@@ -9,85 +23,229 @@ __all__ = (
     "extract_data_from_http_raw_response",
     "response_object_to_raw_http_message",
     "send_http_request_from_raw_http_message",
+    "async_send_http_request_from_raw_http_message",
+    "send_http_request_stream",
+    "async_send_http_request_stream",
+    "get_http_method",
+    "is_connection_failure",
+    "decode_raw_http_message",
+    "IDEMPOTENT_HTTP_METHODS",
+    "HEDGEABLE_HTTP_METHODS",
 )
 
-# A fat regex coded by hand to parse HTTP messages (requests) (HTTP1 AND 2 !!!)
-http_message_request_regex = r"([A-Z]+)\s(\S*)\sHTTP\/([1-2](?:.[0-2])?)\s(?:(?:Host:\s(.*))\n)?((?:[\S ]*:[\S ]*\s?)*)(?:\s\s([\s\S]*))?"
+# The methods an exit node sends as is
+HTTP_METHODS = ("GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH")
 
-# Another fat regex coded by hand to parse HTTP messages (responses)
-http_message_response_regex = (
-    r"([0-9]{3}) ([a-zA-Z]*)\s(\S*)(?:\n((?:[\S ]*:[\S ]*\s?)*))(?:\s([\s\S]*))?"
-)
+# The methods of the requests a client can send again (e.g. through another circuit) without changing their
+# outcome, see RFC 9110
+IDEMPOTENT_HTTP_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+# The methods of the requests a client can send through two circuits at once, only the ones reading a resource
+HEDGEABLE_HTTP_METHODS = ("GET", "HEAD")
+
+# The time (in seconds) an exit node waits for the response of the target server
+EXIT_REQUEST_TIMEOUT = 2
+
+# The method of a message is read from its first bytes only, whatever the size of the message
+HTTP_METHOD_PREFIX_SIZE = 32
+
+# The headers describing how the body of a response was sent by the target server, not how it is relayed: the body
+# is relayed whole, and decoded if it was compressed (requests and aiohttp decode it)
+HOP_BY_HOP_RESPONSE_HEADERS = ("transfer-encoding", "content-encoding")
+
+# The methods whose successful requests change the resource, the responses stored for it are then dropped
+UNSAFE_HTTP_METHODS = ("POST", "PUT", "DELETE", "PATCH")
+
+CHARSET_REGEX = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
 
 
-def extract_data_from_http_raw_request(raw_message: str) -> RawHttpRequest:
+def get_http_method(raw_message: Union[str, bytes]) -> str:
     """
-    Extracts data from a raw HTTP request message
-    :param raw_message: The raw HTTP request message
-    :return: A RawHttpRequest object
+    Returns the method of a raw HTTP request message.
     """
-    raw_message = raw_message.replace("\r", "")
+    prefix = raw_message[:HTTP_METHOD_PREFIX_SIZE]
 
-    match = re.match(http_message_request_regex, raw_message, re.MULTILINE)
-    method = match.group(1)
-    path = match.group(2)
-    http_version = match.group(3)
-    host = match.group(4)
-    raw_headers = match.group(5)
-    body = match.group(6)
+    if not isinstance(prefix, str):
+        prefix = bytes(prefix).decode(HTTP_HEAD_ENCODING)
 
-    if http_version[0] == "2":
-        protocol, path = path.split("://")
+    return prefix.lstrip().split(" ", 1)[0].upper()
 
-        split_path = path.split("/", 0)
-        if len(split_path) == 1:
-            path = "/"
-            host = split_path[0].replace("/", "")
-        else:
-            host, path = split_path
 
-    return RawHttpRequest(host, http_version, path, method, raw_headers, body)
+def is_connection_failure(exception: Exception) -> bool:
+    """
+    Returns whether a request sent with requests or aiohttp failed because the connection could not be opened
+    (refused, unreachable, not resolved or timed out), the request was then not sent.
+    """
+    if isinstance(exception, aiohttp.ClientConnectorError):
+        return True
+
+    reason = getattr(exception.args[0], "reason", None) if exception.args else None
+    return isinstance(exception, requests.exceptions.ConnectTimeout) or isinstance(
+        reason, ConnectTimeoutError
+    )
 
 
-def extract_data_from_http_raw_response(raw_message: str) -> RawHttpResponse:
+def decode_raw_http_message(raw_message: bytes) -> str:
+    """
+    Returns a raw HTTP message as text, for the APIs dealing with text: its body is decoded with the charset of its
+    Content-Type (utf-8 by default), the bytes not valid in that charset are replaced.
+    """
+    try:
+        head, body = HttpMessageParser.parse(raw_message)
+    except HttpParseError:
+        return bytes(raw_message).decode("utf-8", errors="replace")
+
+    head_length = len(raw_message) - len(body)
+    charset_match = CHARSET_REGEX.search(head.get_header("Content-Type") or "")
+
+    try:
+        text_body = str(body, charset_match[1] if charset_match else "utf-8", "replace")
+    except LookupError:
+        # Unknown charset
+        text_body = str(body, "utf-8", "replace")
+
+    return bytes(raw_message[:head_length]).decode("utf-8", errors="replace") + text_body
+
+
+def _parse_http_message(
+    raw_message: Union[str, bytes],
+) -> Tuple[HttpHead, Union[str, memoryview]]:
+    # A text message gives a text body, a binary one gives a view of its body
+    if isinstance(raw_message, str):
+        head, body = HttpMessageParser.parse(raw_message.encode("utf-8"))
+        return head, str(body, "utf-8")
+
+    return HttpMessageParser.parse(raw_message)
+
+
+def _parse_http_request(
+    raw_message: Union[str, bytes],
+) -> Tuple[RawHttpRequest, HttpHead]:
+    head, body = _parse_http_message(raw_message)
+    parts = head.start_line.split()
+
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HttpParseError(f"Malformed request line: {head.start_line!r}")
+
+    method, path, protocol = parts
+    http_version = protocol[len("HTTP/") :]
+    host = head.get_header("Host")
+
+    # The target can be an absolute url (e.g. sent to a proxy or in HTTP/2), its authority then prevails
+    if "://" in path:
+        authority, slash, path = path.partition("://")[2].partition("/")
+        host = authority or host
+        path = slash + path
+
+    if not host:
+        raise HttpParseError("The request has no host")
+
+    return (
+        RawHttpRequest(
+            host,
+            http_version,
+            path or "/",
+            method,
+            # The host is sent in the url
+            head.format_headers(excluded=("host",)),
+            body,
+        ),
+        head,
+    )
+
+
+def extract_data_from_http_raw_request(
+    raw_message: Union[str, bytes],
+) -> RawHttpRequest:
+    """
+    Extracts data from a raw HTTP request message
+    :param raw_message: The raw HTTP request message, its body is a memoryview if it is given as bytes
+    :return: A RawHttpRequest object
+    """
+    return _parse_http_request(raw_message)[0]
+
+
+def extract_data_from_http_raw_response(
+    raw_message: Union[str, bytes],
+) -> RawHttpResponse:
     """
     Extracts data from a raw HTTP response message
-    :param raw_message: The raw HTTP response message
+    :param raw_message: The raw HTTP response message, its body is a memoryview if it is given as bytes
     :return: A RawHttpResponse object
     """
-    raw_message = raw_message.replace("\r", "")
+    head, body = _parse_http_message(raw_message)
+    # The start line is "<status code> <reason> <url>", the reason may hold spaces
+    status_code, _, rest = head.start_line.partition(" ")
+    reason, _, url = rest.rpartition(" ") if " " in rest else (rest, "", "")
+
+    if not status_code.isdigit():
+        raise HttpParseError(f"Malformed status line: {head.start_line!r}")
+
+    return RawHttpResponse(
+        int(status_code), reason, url, head.format_headers(), body
+    )
+
 
-    match = re.match(http_message_response_regex, raw_message, re.MULTILINE)
-    status_code = int(match.group(1))
-    status = match.group(2)
-    url = match.group(3)
-    raw_headers = match.group(4)
-    body = match.group(5)
+def _relayed_headers(
+    headers: Mapping[str, str], body_length: Optional[int] = None
+) -> List[Tuple[str, str]]:
+    # The headers of a response as relayed, see HOP_BY_HOP_RESPONSE_HEADERS. The Content-Length of a decoded body is
+    # its length once decoded, when known.
+    decoded = any(name.lower() == "content-encoding" for name in headers)
+    relayed_headers = [
+        (name, value)
+        for name, value in headers.items()
+        if name.lower() not in HOP_BY_HOP_RESPONSE_HEADERS
+        and not (decoded and name.lower() == "content-length")
+    ]
 
-    return RawHttpResponse(status_code, status, url, raw_headers, body)
+    if decoded and body_length is not None:
+        relayed_headers.append(("Content-Length", str(body_length)))
 
+    return relayed_headers
 
-def response_object_to_raw_http_message(response):
+
+def _format_raw_http_head(status_code, reason, url, headers) -> bytes:
+    head_lines = [f"{status_code} {reason} {url}"]
+    head_lines.extend(f"{name}: {value}" for name, value in headers)
+
+    return ("\r\n".join(head_lines) + "\r\n\r\n").encode(
+        HTTP_HEAD_ENCODING, errors="replace"
+    )
+
+
+def _format_raw_http_response(status_code, reason, url, headers, body: bytes) -> bytes:
+    return (
+        _format_raw_http_head(
+            status_code, reason, url, _relayed_headers(headers, len(body))
+        )
+        + body
+    )
+
+
+def response_object_to_raw_http_message(response) -> bytes:
     """
     Converts a requests.Response object to a raw HTTP message
     :param response: The requests.Response object
-    :return: A raw HTTP message
+    :return: A raw HTTP message, its body is the content of the response as is (binary safe)
     """
+    return _format_raw_http_response(
+        response.status_code,
+        response.reason,
+        response.url,
+        response.headers,
+        response.content,
+    )
 
-    def format_headers(d):
-        return "\r\n".join(f"{k}: {v}" for k, v in d.items())
-
-    return f"""{response.status_code} {response.reason} {response.url}\r\n{format_headers(response.headers)}\r\n\r\n{response.text}"""
 
-
-# TODO: requests does not support HTTP2
-def send_http_request_from_raw_http_message(raw_http_message: str) -> str:
+def _prepare_http_request(
+    raw_http_message: Union[str, bytes],
+) -> Tuple[str, str, dict, Optional[Union[str, memoryview]]]:
     """
-    Sends an HTTP request from a raw HTTP message
-    :param raw_http_message: The raw HTTP message
-    :return: A raw HTTP response message using the response_object_to_raw_http_message function
+    Extracts what is needed to send the request described by a raw HTTP message
+    :return: The method, the url, the headers and the body of the request
     """
-    raw_message: RawHttpRequest = extract_data_from_http_raw_request(raw_http_message)
+    raw_message, head = _parse_http_request(raw_http_message)
 
     if ":443" in raw_message.host:
         protocol = "https"
@@ -96,29 +254,299 @@ def send_http_request_from_raw_http_message(raw_http_message: str) -> str:
     else:
         protocol = "http"
 
-    if raw_message.method == "POST":
-        request_func = requests.post
-    elif raw_message.method == "PUT":
-        request_func = requests.put
-    elif raw_message.method == "DELETE":
-        request_func = requests.delete
-    elif raw_message.method == "OPTIONS":
-        request_func = requests.options
-    elif raw_message.method == "HEAD":
-        request_func = requests.head
-    elif raw_message.method == "PATCH":
-        request_func = requests.patch
+    # Unknown methods are sent as GET
+    method = raw_message.method if raw_message.method in HTTP_METHODS else "GET"
+
+    headers = {
+        name: value for name, value in head.headers if name.lower() != "host"
+    }
+
+    url = f"{protocol}://{raw_message.host}{raw_message.path}"
+
+    # An empty view would be sent as an empty chunked body
+    return method, url, headers, raw_message.body or None
+
+
+def _format_cached_response(entry: CachedResponse) -> bytes:
+    headers = [(name, value) for name, value in entry.headers if name.lower() != "age"]
+    headers.append(("Age", str(int(entry.age()))))
+
+    return (
+        _format_raw_http_head(entry.status_code, entry.reason, entry.url, headers)
+        + entry.body
+    )
+
+
+def _lookup_cache(
+    cache: Optional[HttpCache], method: str, url: str, headers: dict
+) -> Tuple[Optional[bytes], Optional[CachedResponse], dict]:
+    """
+    Looks up the response stored for a request
+    :return: The raw HTTP response message to send back if the response stored can be used as is, the response
+    stored if it must be revalidated, and the headers to send the request with (conditional on the response stored
+    having changed)
+    """
+    if cache is None or not cache.is_cacheable_request(method, headers):
+        return None, None, headers
+
+    entry = cache.lookup(url, headers)
+
+    if entry is None:
+        return None, None, headers
+
+    if cache.is_usable(entry, headers):
+        return _format_cached_response(entry), None, headers
+
+    return None, entry, {**headers, **entry.validators()}
+
+
+def _update_cache(
+    cache: Optional[HttpCache],
+    method: str,
+    url: str,
+    headers: dict,
+    entry: Optional[CachedResponse],
+    status_code: int,
+    reason: str,
+    response_url,
+    response_headers: Mapping[str, str],
+    body: bytes,
+) -> Optional[bytes]:
+    """
+    Stores the response to a request (or renews the response revalidated)
+    :return: The raw HTTP response message to send back if it is the response stored, None otherwise
+    """
+    if cache is None:
+        return None
+
+    if method in UNSAFE_HTTP_METHODS and status_code < 400:
+        cache.invalidate(url)
+    elif not cache.is_cacheable_request(method, headers):
+        return None
+    elif entry is not None and status_code == 304:
+        return _format_cached_response(cache.revalidated(url, entry, response_headers))
     else:
-        request_func = requests.get
+        cache.store(
+            url,
+            headers,
+            CachedResponse(
+                status_code,
+                reason,
+                str(response_url),
+                _relayed_headers(response_headers, len(body)),
+                body,
+                stored_at=time.time(),
+                lifetime=0,
+            ),
+            response_headers,
+        )
 
-    headers = {}
+    return None
 
-    for header_line in raw_message.headers.splitlines():
-        if ": " in header_line:
-            header_name, header_value = header_line.split(": ")
-            headers[header_name] = header_value
 
-    url = f"{protocol}://{raw_message.host}{raw_message.path}"
+# TODO: requests does not support HTTP2
+def send_http_request_from_raw_http_message(
+    raw_http_message: Union[str, bytes],
+    connection_pool: Optional[ConnectionPool] = None,
+    cache: Optional[HttpCache] = None,
+) -> bytes:
+    """
+    Sends an HTTP request from a raw HTTP message
+    :param raw_http_message: The raw HTTP message, its body is sent without being copied if it is binary
+    :param connection_pool: The pool of connections to the target servers to use, if any
+    :param cache: The cache of the responses to the GET requests to use, if any (see HttpCache)
+    :return: A raw HTTP response message using the response_object_to_raw_http_message function
+    """
+    method, url, headers, body = _prepare_http_request(raw_http_message)
+    cached_response, entry, request_headers = _lookup_cache(cache, method, url, headers)
+
+    if cached_response is not None:
+        return cached_response
+
+    send_request = connection_pool.request if connection_pool else requests.request
+
+    response = send_request(
+        method, url, headers=request_headers, data=body, timeout=EXIT_REQUEST_TIMEOUT
+    )
+    cached_response = _update_cache(
+        cache,
+        method,
+        url,
+        headers,
+        entry,
+        response.status_code,
+        response.reason,
+        response.url,
+        response.headers,
+        response.content,
+    )
+
+    return cached_response or response_object_to_raw_http_message(response)
+
+
+async def async_send_http_request_from_raw_http_message(
+    raw_http_message: Union[str, bytes],
+    session: aiohttp.ClientSession,
+    cache: Optional[HttpCache] = None,
+) -> bytes:
+    """
+    Same as send_http_request_from_raw_http_message but without blocking the event loop
+    :param raw_http_message: The raw HTTP message
+    :param session: The aiohttp session used to send the request
+    :param cache: The cache of the responses to the GET requests to use, if any (see HttpCache)
+    :return: A raw HTTP response message
+    """
+    method, url, headers, body = _prepare_http_request(raw_http_message)
+    cached_response, entry, request_headers = _lookup_cache(cache, method, url, headers)
+
+    if cached_response is not None:
+        return cached_response
+
+    async with session.request(
+        method,
+        url,
+        headers=request_headers,
+        data=body,
+        timeout=aiohttp.ClientTimeout(total=EXIT_REQUEST_TIMEOUT),
+    ) as response:
+        content = await response.read()
+        cached_response = _update_cache(
+            cache,
+            method,
+            url,
+            headers,
+            entry,
+            response.status,
+            response.reason,
+            response.url,
+            response.headers,
+            content,
+        )
+
+        return cached_response or _format_raw_http_response(
+            response.status,
+            response.reason,
+            response.url,
+            response.headers,
+            content,
+        )
+
+
+class _SizedBody:
+    """
+    The chunks of a request body whose length is known, so that requests sends it with a Content-Length
+    instead of the chunked transfer encoding.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], length: int):
+        self.chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.length
+
+
+def _get_content_length(headers: dict) -> Optional[int]:
+    for name, value in headers.items():
+        if name.lower() == "content-length":
+            return int(value)
+
+    return None
+
+
+def send_http_request_stream(
+    chunks: Iterator[bytes], connection_pool: Optional[ConnectionPool] = None
+) -> Iterator[bytes]:
+    """
+    Streaming version of send_http_request_from_raw_http_message: the request is sent while its chunks are received
+    and the response is yielded while it is received.
+    :param chunks: The head of the raw HTTP message (start line and headers) then the chunks of its body
+    :param connection_pool: The pool of connections to the target servers to use, if any
+    :return: The head of the raw HTTP response message then the chunks of its body
+    """
+    head = next(chunks, None)
+
+    if head is None:
+        raise HttpParseError("The message is empty")
+
+    method, url, headers, _ = _prepare_http_request(head)
+    send_request = connection_pool.request if connection_pool else requests.request
+
+    first_chunk = next(chunks, None)
+
+    if first_chunk is None:
+        body = None
+    else:
+        body = itertools.chain((first_chunk,), chunks)
+        content_length = _get_content_length(headers)
+
+        if content_length is not None:
+            body = _SizedBody(body, content_length)
+
+    response = send_request(
+        method,
+        url,
+        headers=headers,
+        data=body,
+        timeout=EXIT_REQUEST_TIMEOUT,
+        stream=True,
+    )
+
+    with response:
+        yield _format_raw_http_head(
+            response.status_code,
+            response.reason,
+            response.url,
+            _relayed_headers(response.headers),
+        )
+        yield from response.iter_content(STREAM_CHUNK_SIZE)
+
+
+async def async_send_http_request_stream(
+    chunks: AsyncIterator[bytes], session: aiohttp.ClientSession
+) -> AsyncIterator[bytes]:
+    """
+    Same as send_http_request_stream but without blocking the event loop
+    :param chunks: The head of the raw HTTP message (start line and headers) then the chunks of its body
+    :param session: The aiohttp session used to send the request
+    :return: The head of the raw HTTP response message then the chunks of its body
+    """
+    head = await anext(chunks, None)
+
+    if head is None:
+        raise HttpParseError("The message is empty")
+
+    method, url, headers, _ = _prepare_http_request(head)
+
+    first_chunk = await anext(chunks, None)
+
+    async def body():
+        yield first_chunk
+
+        async for chunk in chunks:
+            yield chunk
+
+    async with session.request(
+        method,
+        url,
+        headers=headers,
+        data=None if first_chunk is None else body(),
+        # The whole response may take long to be received, only the time between two reads is limited
+        timeout=aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=EXIT_REQUEST_TIMEOUT,
+            sock_read=EXIT_REQUEST_TIMEOUT,
+        ),
+    ) as response:
+        yield _format_raw_http_head(
+            response.status,
+            response.reason,
+            response.url,
+            _relayed_headers(response.headers),
+        )
 
-    response = request_func(url, headers=headers, data=raw_message.body, timeout=2)
-    return response_object_to_raw_http_message(response)
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            yield chunk
@@ -0,0 +1,262 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple, Union
+
+__all__ = (
+    "HttpParseError",
+    "HttpHead",
+    "HttpMessageParser",
+    "MAX_HTTP_HEAD_SIZE",
+    "HTTP_HEAD_ENCODING",
+)
+
+# The largest head (start line and headers) a parser accepts, so that a message without an empty line does not
+# make it buffer without end
+MAX_HTTP_HEAD_SIZE = 64 * 1024
+
+# The encoding of the start line and of the headers (RFC 9110), which maps every byte to a character, so that
+# they are sent again byte for byte (requests and aiohttp encode the headers with it)
+HTTP_HEAD_ENCODING = "latin-1"
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class HttpParseError(ValueError):
+    """
+    Raised when a raw HTTP message is malformed or its head is too large.
+    """
+
+
+@dataclass
+class HttpHead:
+    """
+    The head of an HTTP message: its start line and its headers, in the order they were received.
+    """
+
+    start_line: str
+    headers: List[Tuple[str, str]] = field(default_factory=list)
+
+    def get_header(self, name: str) -> Optional[str]:
+        """
+        Returns the value of the first header with the given name (case insensitive), or None.
+        """
+        name = name.lower()
+
+        for header_name, value in self.headers:
+            if header_name.lower() == name:
+                return value
+
+        return None
+
+    def format_headers(self, excluded: Tuple[str, ...] = ()) -> str:
+        """
+        Returns the headers, one "name: value" line each, without the given ones (lowercase names).
+        """
+        return "\r\n".join(
+            f"{name}: {value}"
+            for name, value in self.headers
+            if name.lower() not in excluded
+        )
+
+
+class HttpMessageParser:
+    """
+    Parses a raw HTTP message (its lines ending with CRLF or LF) fed in one or several pieces.
+
+    The parser only looks for the empty line ending the head, and stops there: the body is never scanned nor
+    copied, it is a memoryview of the data fed (its part after the head when it came with the head). A message
+    fed at once is therefore parsed without copying it, whatever the size of its body.
+    """
+
+    def __init__(self, max_head_size: int = MAX_HTTP_HEAD_SIZE):
+        self.max_head_size = max_head_size
+        self.head: Optional[HttpHead] = None
+        self._buffer: BytesLike = b""
+        # Where the head starts in the buffer (after the empty lines preceding it), -1 until it is known
+        self._head_start = -1
+        # Where to resume looking for the end of the head in the buffer
+        self._scan_start = 0
+        self._body_parts: List[memoryview] = []
+
+    @staticmethod
+    def parse(
+        raw_message: BytesLike, max_head_size: int = MAX_HTTP_HEAD_SIZE
+    ) -> Tuple[HttpHead, memoryview]:
+        """
+        Parses a whole raw HTTP message, returns its head and its body. A message without an empty line after
+        its head has an empty body.
+        """
+        # bytes.find is needed to look for the end of the head, only the part of a view that can hold the head is
+        # copied
+        head_area = (
+            raw_message[:max_head_size].tobytes()
+            if isinstance(raw_message, memoryview)
+            else raw_message
+        )
+        head_start = _skip_empty_lines(head_area)
+
+        if head_start == len(raw_message):
+            raise HttpParseError("The message is empty")
+
+        head_end = _find_head_end(head_area, head_start, head_start, max_head_size)
+
+        if head_end == -1:
+            if len(raw_message) - head_start > max_head_size:
+                raise HttpParseError("The head of the message is too large")
+            head_end = len(raw_message)
+
+        return (
+            _parse_head(head_area[head_start:head_end]),
+            memoryview(raw_message)[head_end:],
+        )
+
+    @property
+    def body(self) -> memoryview:
+        """
+        The part of the body received so far.
+        """
+        if len(self._body_parts) == 1:
+            return self._body_parts[0]
+
+        return memoryview(b"".join(self._body_parts))
+
+    def feed(self, data: BytesLike) -> bool:
+        """
+        Parses the next piece of the message, returns whether its head is complete.
+        """
+        if self.head is not None:
+            if data:
+                self._body_parts.append(memoryview(data))
+            return True
+
+        if isinstance(data, memoryview):
+            # bytes.find is needed to look for the end of the head
+            data = data.tobytes()
+
+        if not self._buffer:
+            self._buffer = data
+        else:
+            if not isinstance(self._buffer, bytearray):
+                self._buffer = bytearray(self._buffer)
+
+            self._buffer += data
+
+        head_end = self._find_head_end()
+
+        if head_end == -1:
+            if len(self._buffer) - max(self._head_start, 0) > self.max_head_size:
+                raise HttpParseError("The head of the message is too large")
+            return False
+
+        self._complete_head(head_end)
+        return True
+
+    def end(self):
+        """
+        Tells the parser the message is complete: the lines received are the head of a message without body.
+        """
+        if self.head is not None:
+            return
+
+        if self._head_start == -1:
+            raise HttpParseError("The message is empty")
+
+        self._complete_head(len(self._buffer))
+
+    def _find_head_end(self) -> int:
+        # Returns where the empty line ending the head ends in the buffer, or -1 if it was not received yet
+        if self._head_start == -1:
+            head_start = _skip_empty_lines(self._buffer)
+
+            if head_start == len(self._buffer):
+                return -1
+
+            self._head_start = self._scan_start = head_start
+
+        head_end = _find_head_end(
+            self._buffer, self._head_start, self._scan_start, self.max_head_size
+        )
+        # The separators are up to 3 bytes long, the next search starts before the end of this piece
+        self._scan_start = max(self._head_start, len(self._buffer) - 2)
+        return head_end
+
+    def _complete_head(self, head_end: int):
+        self.head = _parse_head(self._buffer[self._head_start : head_end])
+        body = memoryview(self._buffer)[head_end:]
+        self._body_parts = [body] if body else []
+        self._buffer = b""
+
+
+def _skip_empty_lines(buffer: BytesLike) -> int:
+    # The empty lines before the start line are ignored (RFC 9112), returns where the start line starts
+    index = 0
+
+    while index < len(buffer) and buffer[index] in b"\r\n":
+        index += 1
+
+    return index
+
+
+def _find_head_end(
+    buffer: BytesLike, head_start: int, scan_start: int, max_head_size: int
+) -> int:
+    # Returns where the empty line ending the head ends in the buffer, or -1 if it is not in the buffer. The empty
+    # line is a LF followed by a LF or a CRLF. Both are looked for, the most likely one (given the end of the start
+    # line) first, and the other one only before it, so that the body is never scanned.
+    limit = head_start + max_head_size
+    first_line_end = buffer.find(b"\n", head_start, limit)
+    separators = (
+        (b"\n\r\n", b"\n\n")
+        if first_line_end > 0 and buffer[first_line_end - 1] == 13
+        else (b"\n\n", b"\n\r\n")
+    )
+    head_end = -1
+
+    for separator in separators:
+        index = buffer.find(separator, scan_start, limit)
+
+        if index != -1:
+            head_end = index + len(separator)
+            limit = head_end - 1
+
+    return head_end
+
+
+def _parse_head(raw_head: BytesLike) -> HttpHead:
+    lines = raw_head.decode(HTTP_HEAD_ENCODING).replace("\r\n", "\n").split("\n")
+    # The head ends with the empty line (or with the end of the message)
+    header_lines = [line for line in lines[1:] if line]
+    parts = [line.partition(":") for line in header_lines]
+    headers = [
+        (name, value.strip())
+        for name, separator, value in parts
+        if separator and name and name == name.strip()
+    ]
+
+    if len(headers) != len(parts):
+        headers = _parse_header_lines(header_lines)
+
+    return HttpHead(lines[0], headers)
+
+
+def _parse_header_lines(lines: List[str]) -> List[Tuple[str, str]]:
+    # The slow path, for the heads holding a header continued on the next line (or a malformed one)
+    headers = []
+
+    for line in lines:
+        if line[0] in " \t":
+            # A header continued on the next line (obsolete line folding)
+            if not headers:
+                raise HttpParseError("The first header starts with a whitespace")
+
+            name, value = headers[-1]
+            headers[-1] = (name, f"{value} {line.strip()}")
+            continue
+
+        name, separator, value = line.partition(":")
+
+        if not separator or not name or name != name.strip():
+            raise HttpParseError(f"Malformed header line: {line!r}")
+
+        headers.append((name, value.strip()))
+
+    return headers
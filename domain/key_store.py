@@ -0,0 +1,130 @@
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from typing import Optional
+
+from domain.crypto import CryptoContainer
+
+__all__ = ("KeyStore", "DEFAULT_KEY_STORE_DIRECTORY", "load_crypto_container")
+
+# The directory where the launch scripts keep the keys of the nodes
+DEFAULT_KEY_STORE_DIRECTORY = "keys"
+
+# The files holding the keys of an identity
+PUBLIC_KEY_FILE = "public_key.pem"
+PRIVATE_KEY_FILE = "private_key.pem"
+X25519_PRIVATE_KEY_FILE = "x25519_private_key.pem"
+
+# The directory (in the key store) holding the pre-generated key sets not claimed by an identity yet
+POOL_DIRECTORY = "pool"
+
+
+class KeyStore:
+    """
+    Keeps the keys of the nodes on disk, so that a node restarting keeps its keys (and skips the generation of an
+    RSA key pair, which takes a while).
+
+    The keys of each identity (e.g. "node-localhost-8080") are kept in their own directory. The key sets can be
+    generated ahead of time with pregenerate, a new identity then claims one of them instead of generating its
+    own. The key sets are written in a temporary directory and moved in place at once, so several processes can
+    share a key store and a key set is never seen half written.
+    """
+
+    def __init__(self, directory: str = DEFAULT_KEY_STORE_DIRECTORY):
+        self.directory = directory
+        self.pool_directory = os.path.join(directory, POOL_DIRECTORY)
+        os.makedirs(self.pool_directory, mode=0o700, exist_ok=True)
+
+    def load_or_create(self, identity: str) -> CryptoContainer:
+        """
+        Returns the keys of the given identity, claiming a pre-generated key set or generating one if it has none.
+        """
+        identity_directory = self._identity_directory(identity)
+
+        if not os.path.isdir(identity_directory):
+            if not self._claim_pregenerated_keys(identity_directory):
+                self._move_key_set(self._write_key_set(), identity_directory)
+
+        return _load_key_set(identity_directory)
+
+    def pregenerate(self, count: int):
+        """
+        Generates count key sets for the identities to come.
+        """
+        for _ in range(count):
+            self._move_key_set(
+                self._write_key_set(),
+                os.path.join(self.pool_directory, uuid.uuid4().hex),
+            )
+
+    def pool_size(self) -> int:
+        """
+        Returns the number of pre-generated key sets not claimed yet.
+        """
+        return len(os.listdir(self.pool_directory))
+
+    def _identity_directory(self, identity: str) -> str:
+        if identity == POOL_DIRECTORY:
+            raise ValueError(f"{POOL_DIRECTORY} cannot be used as an identity")
+
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", identity))
+
+    def _claim_pregenerated_keys(self, identity_directory: str) -> bool:
+        for key_set in sorted(os.listdir(self.pool_directory)):
+            try:
+                os.rename(os.path.join(self.pool_directory, key_set), identity_directory)
+                return True
+            except FileNotFoundError:
+                # Claimed by another process in the meantime
+                continue
+            except OSError:
+                # The identity got its keys from another process in the meantime
+                return True
+
+        return False
+
+    def _write_key_set(self) -> str:
+        # Only readable by the owner, like the private keys it holds
+        directory = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        CryptoContainer().save(
+            os.path.join(directory, PUBLIC_KEY_FILE),
+            os.path.join(directory, PRIVATE_KEY_FILE),
+            os.path.join(directory, X25519_PRIVATE_KEY_FILE),
+        )
+        return directory
+
+    @staticmethod
+    def _move_key_set(directory: str, destination: str):
+        try:
+            os.rename(directory, destination)
+        except OSError:
+            # The destination got its keys from another process in the meantime
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _load_key_set(directory: str) -> CryptoContainer:
+    return CryptoContainer(
+        public_key_path=os.path.join(directory, PUBLIC_KEY_FILE),
+        private_key_path=os.path.join(directory, PRIVATE_KEY_FILE),
+        x25519_private_key_path=os.path.join(directory, X25519_PRIVATE_KEY_FILE),
+    )
+
+
+def load_crypto_container(
+    identity: str,
+    key_store: Optional[KeyStore] = None,
+    public_key_path=None,
+    private_key_path=None,
+) -> CryptoContainer:
+    """
+    Returns the keys of a node: the ones at the given paths if any, else the ones of its identity in the key store
+    if any, else new ones (lost when the node stops).
+    """
+    if key_store is not None and not private_key_path:
+        return key_store.load_or_create(identity)
+
+    return CryptoContainer(
+        public_key_path=public_key_path, private_key_path=private_key_path
+    )
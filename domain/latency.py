@@ -0,0 +1,53 @@
+import math
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+__all__ = (
+    "LatencyWindow",
+    "DEFAULT_LATENCY_WINDOW_SIZE",
+    "MIN_LATENCY_SAMPLES",
+)
+
+# The number of response times kept, the oldest ones are dropped first
+DEFAULT_LATENCY_WINDOW_SIZE = 200
+
+# The number of response times needed before a percentile is computed, fewer would not tell much about the tail
+MIN_LATENCY_SAMPLES = 20
+
+
+class LatencyWindow:
+    """
+    The response times (in seconds) of the last size messages, to compute their percentiles (e.g. to hedge a
+    request still waiting for its response after the 95th percentile). It can be shared by several threads.
+    """
+
+    def __init__(
+        self,
+        size: int = DEFAULT_LATENCY_WINDOW_SIZE,
+        min_samples: int = MIN_LATENCY_SAMPLES,
+    ):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def add(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Returns the given percentile (between 0 and 100) of the response times (nearest-rank), None while fewer
+        than min_samples are known.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        if len(latencies) < max(self.min_samples, 1):
+            return None
+
+        rank = math.ceil(percentile / 100 * len(latencies))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
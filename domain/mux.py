@@ -0,0 +1,350 @@
+import asyncio
+import http.client
+import socket
+import struct
+from threading import Lock
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import aiohttp
+
+from domain.crypto import encrypt_using_symmetric_key
+from domain.stream import STREAM_CHUNK_SIZE, StreamError
+from domain.tor_message import TOR_MESSAGE_CONTENT_TYPE
+
+__all__ = (
+    "MUX_END_FLAG",
+    "MUX_RESET_FLAG",
+    "MUX_CONTROL_STREAM_ID",
+    "MAX_MUX_STREAMS",
+    "MUX_IDLE_TIMEOUT",
+    "MuxStreamAssembler",
+    "MuxConnection",
+    "AsyncMuxConnection",
+    "encode_mux_frame",
+    "encode_mux_message",
+    "read_mux_frames",
+    "async_read_mux_frames",
+    "split_mux_message",
+)
+
+# A multiplexed connection carries the messages of many streams at the same time, as a sequence of frames: the id of
+# the stream (4 bytes), flags (1 byte), the length of the payload (4 bytes) then the payload itself (one chunk of a
+# message, encrypted once per remaining hop). The frames of different streams are interleaved, so a large or slow
+# message does not hold back the others.
+MUX_FRAME_HEADER_FORMAT = "!IBI"
+MUX_FRAME_HEADER_SIZE = struct.calcsize(MUX_FRAME_HEADER_FORMAT)
+MAX_MUX_FRAME_SIZE = 2 * STREAM_CHUNK_SIZE
+
+# The last frame of a message
+MUX_END_FLAG = 1
+# The stream failed (e.g. the target server could not be reached), the frame has no payload and is relayed as is
+MUX_RESET_FLAG = 2
+
+# The frames of stream 0 have no payload and are ignored. One is sent when a connection is opened, the head of the
+# request is then sent at once (aiohttp only sends it with the first chunk of the body).
+MUX_CONTROL_STREAM_ID = 0
+
+# The number of messages being received at the same time on a connection
+MAX_MUX_STREAMS = 256
+
+# The time (in seconds) a multiplexed connection stays open without receiving anything, the nodes forget an idle
+# circuit after CIRCUIT_LIFETIME seconds anyway
+MUX_IDLE_TIMEOUT = 600
+
+# The time (in seconds) to wait for a node to accept a multiplexed connection
+MUX_CONNECT_TIMEOUT = 15
+
+# The number of frames waiting to be sent on an AsyncMuxConnection, the senders wait beyond that
+MUX_SEND_QUEUE_SIZE = 64
+
+
+def encode_mux_frame(stream_id: int, flags: int, payload: bytes = b"") -> bytes:
+    return struct.pack(MUX_FRAME_HEADER_FORMAT, stream_id, flags, len(payload)) + payload
+
+
+def _decode_mux_frame_header(header: bytes) -> Tuple[int, int, int]:
+    if len(header) != MUX_FRAME_HEADER_SIZE:
+        raise StreamError("The connection ended in the middle of a frame")
+
+    stream_id, flags, length = struct.unpack(MUX_FRAME_HEADER_FORMAT, header)
+
+    if length > MAX_MUX_FRAME_SIZE:
+        raise StreamError(f"The connection carries a frame of {length} bytes")
+
+    return stream_id, flags, length
+
+
+def read_mux_frames(read: Callable[[int], bytes]) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Yields the frames (stream id, flags and payload) read with the given function until the end of the connection,
+    the frames of the control stream are skipped. The function must return exactly the number of bytes asked for
+    unless the connection ended (e.g. the read method of a ChunkedReader or of an http.client response).
+    """
+    while header := read(MUX_FRAME_HEADER_SIZE):
+        stream_id, flags, length = _decode_mux_frame_header(header)
+        payload = read(length) if length else b""
+
+        if len(payload) != length:
+            raise StreamError("The connection ended in the middle of a frame")
+
+        if stream_id != MUX_CONTROL_STREAM_ID:
+            yield stream_id, flags, payload
+
+
+async def async_read_mux_frames(reader) -> AsyncIterator[Tuple[int, int, bytes]]:
+    """
+    Same as read_mux_frames but reads from an asyncio (or aiohttp) stream reader.
+    """
+    while header := await reader.read(MUX_FRAME_HEADER_SIZE):
+        if len(header) < MUX_FRAME_HEADER_SIZE:
+            header += await reader.readexactly(MUX_FRAME_HEADER_SIZE - len(header))
+
+        stream_id, flags, length = _decode_mux_frame_header(header)
+        payload = await reader.readexactly(length) if length else b""
+
+        if stream_id != MUX_CONTROL_STREAM_ID:
+            yield stream_id, flags, payload
+
+
+def split_mux_message(message: bytes) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Splits a message into the payloads of its frames (views of the message), with their flags. An empty message is
+    sent as a single empty frame.
+    """
+    message = memoryview(message)
+    last_start = max(len(message) - 1, 0) // STREAM_CHUNK_SIZE * STREAM_CHUNK_SIZE
+
+    for start in range(0, last_start + 1, STREAM_CHUNK_SIZE):
+        yield (
+            MUX_END_FLAG if start == last_start else 0,
+            message[start : start + STREAM_CHUNK_SIZE],
+        )
+
+
+def encode_mux_message(
+    stream_id: int, message: bytes, sym_keys: Sequence[bytes]
+) -> List[bytes]:
+    """
+    Returns the frames carrying a message in the given stream, the payload of each frame being encrypted with the
+    given session keys (the last one first, see encrypt_for_circuit).
+    """
+    frames = []
+
+    for flags, chunk in split_mux_message(message):
+        for sym_key in sym_keys[::-1]:
+            chunk = encrypt_using_symmetric_key(chunk, sym_key)
+
+        frames.append(encode_mux_frame(stream_id, flags, chunk))
+
+    return frames
+
+
+class MuxStreamAssembler:
+    """
+    Gathers the (decrypted) payloads of the frames received on a multiplexed connection into messages, by stream. At
+    most max_streams messages can be partially received at the same time.
+    """
+
+    def __init__(self, max_streams: int = MAX_MUX_STREAMS):
+        self.max_streams = max_streams
+        self._chunks: Dict[int, List[bytes]] = {}
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def feed(self, stream_id: int, flags: int, chunk: bytes) -> Optional[bytes]:
+        """
+        Adds the payload of a frame, returns the whole message once its last frame is received (None before). A reset
+        stream is forgotten.
+        """
+        if flags & MUX_RESET_FLAG:
+            self._chunks.pop(stream_id, None)
+            return None
+
+        chunks = self._chunks.get(stream_id)
+
+        if chunks is None:
+            if flags & MUX_END_FLAG:
+                # A message sent in a single frame is not copied
+                return chunk
+
+            if len(self._chunks) >= self.max_streams:
+                raise StreamError(f"More than {self.max_streams} streams at the same time")
+
+            chunks = self._chunks[stream_id] = []
+
+        chunks.append(chunk)
+
+        if flags & MUX_END_FLAG:
+            del self._chunks[stream_id]
+            return b"".join(chunks)
+
+        return None
+
+
+class MuxConnection:
+    """
+    A multiplexed connection to a node: a POST request whose body and response are both sent with the chunked
+    transfer encoding, the frames of the body being sent while the frames of the response are read (by another
+    thread), see frames. It can be shared by several threads sending frames.
+
+    Check the status before using it, the connection is only open if it is 200.
+    """
+
+    def __init__(
+        self, address: str, path: str, idle_timeout: float = MUX_IDLE_TIMEOUT
+    ):
+        """
+        :param address: The address of the node (ip:port)
+        :param path: The path of the request, e.g. /circuit/<circuit_id>/mux
+        :param idle_timeout: The time (in seconds) after which the connection is considered lost if nothing was
+        received
+        """
+        self._lock = Lock()
+        self._connection = http.client.HTTPConnection(
+            address, timeout=MUX_CONNECT_TIMEOUT
+        )
+        self._connection.putrequest("POST", path, skip_accept_encoding=True)
+        self._connection.putheader("Content-Type", TOR_MESSAGE_CONTENT_TYPE)
+        self._connection.putheader("Transfer-Encoding", "chunked")
+        self._connection.endheaders()
+
+        try:
+            self.send(encode_mux_frame(MUX_CONTROL_STREAM_ID, 0))
+            self._response = self._connection.getresponse()
+        except BaseException:
+            self._connection.close()
+            raise
+
+        self.status = self._response.status
+
+        if self.status == 200:
+            self._connection.sock.settimeout(idle_timeout)
+        else:
+            self._connection.close()
+
+    def send(self, frame: bytes):
+        """
+        Sends a frame (see encode_mux_frame), raises OSError if the connection is closed.
+        """
+        with self._lock:
+            # http.client would open a new connection
+            if self._connection.sock is None:
+                raise ConnectionResetError("The multiplexed connection is closed")
+
+            self._connection.send(b"%x\r\n%s\r\n" % (len(frame), frame))
+
+    def frames(self) -> Iterator[Tuple[int, int, bytes]]:
+        """
+        Yields the frames received until the node ends the connection, see read_mux_frames.
+        """
+        return read_mux_frames(self._response.read)
+
+    def end(self):
+        """
+        Ends the body of the request: no more frames are sent, the node still sends the responses of the streams in
+        progress before ending the connection.
+        """
+        try:
+            # An empty chunk ends the body
+            self.send(b"")
+        except OSError:
+            pass
+
+    def shutdown(self):
+        """
+        Shuts the connection down without closing it, the thread reading its frames sees the end of the connection
+        (the connection is then closed with close).
+        """
+        with self._lock:
+            if self._connection.sock is not None:
+                try:
+                    self._connection.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        self._connection.close()
+
+
+class AsyncMuxConnection:
+    """
+    The asyncio counterpart of MuxConnection, on an aiohttp session. Open it with open before using it.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        idle_timeout: float = MUX_IDLE_TIMEOUT,
+    ):
+        self.session = session
+        self.url = url
+        self.idle_timeout = idle_timeout
+        self.status: Optional[int] = None
+        self._closed = False
+        self._frames: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(
+            MUX_SEND_QUEUE_SIZE
+        )
+        self._response: Optional[aiohttp.ClientResponse] = None
+
+    async def open(self) -> int:
+        """
+        Opens the connection, returns the status of the response (the connection is only open if it is 200).
+        """
+        self._frames.put_nowait(encode_mux_frame(MUX_CONTROL_STREAM_ID, 0))
+        self._response = await self.session.post(
+            self.url,
+            data=self._body(),
+            headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=MUX_CONNECT_TIMEOUT,
+                sock_read=self.idle_timeout,
+            ),
+        )
+        self.status = self._response.status
+
+        if self.status != 200:
+            self.close()
+
+        return self.status
+
+    async def _body(self):
+        while (frame := await self._frames.get()) is not None:
+            yield frame
+
+    async def send(self, frame: bytes):
+        """
+        Same as MuxConnection.send.
+        """
+        if self._closed:
+            raise ConnectionResetError("The multiplexed connection is closed")
+
+        await self._frames.put(frame)
+
+    def frames(self) -> AsyncIterator[Tuple[int, int, bytes]]:
+        return async_read_mux_frames(self._response.content)
+
+    async def end(self):
+        if not self._closed:
+            await self._frames.put(None)
+
+    def close(self):
+        self._closed = True
+
+        if self._response is not None:
+            self._response.close()
+
+        # The frames are not sent anymore, the senders waiting for room in the queue are released
+        while not self._frames.empty():
+            self._frames.get_nowait()
@@ -0,0 +1,115 @@
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from models import TorNode
+
+__all__ = ("NodeTable", "DEFAULT_CHANGE_LOG_SIZE")
+
+# The number of changes remembered by a NodeTable, to tell a reader what changed since the version it last read
+DEFAULT_CHANGE_LOG_SIZE = 10000
+
+
+class NodeTable:
+    """
+    The table of the nodes known by a registry, indexed by address (ip, port), so that adding, removing and
+    looking up a node take constant time whatever the size of the network.
+
+    A node registering again replaces its previous entry. The version of the table increases on each change (a
+    node registering again with the same public key is not a change), so that a reader can tell whether the
+    table changed since it last read it, and which nodes changed (see changes_since).
+    """
+
+    def __init__(self, change_log_size: int = DEFAULT_CHANGE_LOG_SIZE):
+        self._nodes: Dict[Tuple[str, int], TorNode] = {}
+        self._lock = Lock()
+        self.version = 0
+        # The address of the node changed by each of the last versions, oldest first
+        self._changes: Deque[Tuple[int, Tuple[str, int]]] = deque(
+            maxlen=change_log_size
+        )
+
+    def add(self, node: TorNode) -> bool:
+        """
+        Adds a node, or replaces the node with the same address. Returns whether the table changed.
+        """
+        address = _address(node.ip, node.port)
+
+        with self._lock:
+            if self._nodes.get(address) == node:
+                return False
+
+            self._nodes[address] = node
+            self._log_change(address)
+            return True
+
+    def remove(self, ip: str, port: int) -> Optional[TorNode]:
+        """
+        Removes the node with the given address, returns it or None if it is unknown.
+        """
+        with self._lock:
+            address = _address(ip, port)
+            node = self._nodes.pop(address, None)
+
+            if node is not None:
+                self._log_change(address)
+
+            return node
+
+    def get(self, ip: str, port: int) -> Optional[TorNode]:
+        return self._nodes.get(_address(ip, port))
+
+    def snapshot(self) -> Tuple[int, List[TorNode]]:
+        """
+        Returns the version of the table and its nodes, consistent with each other.
+        """
+        with self._lock:
+            return self.version, list(self._nodes.values())
+
+    def changes_since(
+        self, version: int
+    ) -> Optional[Tuple[int, List[TorNode], List[Tuple[str, int]]]]:
+        """
+        Returns the current version of the table, the nodes added or replaced since the given version and the
+        addresses of the nodes removed since then. Returns None if the changes are not known anymore (too many
+        changes since then) or if the version is not a version of this table.
+        """
+        with self._lock:
+            if version > self.version or (
+                version < self.version and self._changes[0][0] > version + 1
+            ):
+                return None
+
+            changed_addresses = {
+                address
+                for change_version, address in self._changes
+                if change_version > version
+            }
+            added_nodes = [
+                self._nodes[address]
+                for address in changed_addresses
+                if address in self._nodes
+            ]
+            removed_addresses = [
+                address for address in changed_addresses if address not in self._nodes
+            ]
+            return self.version, added_nodes, removed_addresses
+
+    def __contains__(self, address: Tuple[str, int]) -> bool:
+        return _address(*address) in self._nodes
+
+    def __iter__(self) -> Iterator[TorNode]:
+        # Iterates over a copy, so that the table can change in the meantime
+        return iter(self.snapshot()[1])
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _log_change(self, address: Tuple[str, int]):
+        self.version += 1
+        self._changes.append((self.version, address))
+
+
+def _address(ip: str, port: int) -> Tuple[str, int]:
+    # The clients read the port from the directory as a string
+    return ip, int(port)
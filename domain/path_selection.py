@@ -0,0 +1,107 @@
+import heapq
+import random
+import statistics
+from typing import List, Optional, Sequence
+
+from models import TorNode
+
+__all__ = (
+    "select_path",
+    "node_weights",
+    "cap_weights",
+    "DEFAULT_MAX_NODE_SHARE",
+)
+
+# The largest share of the total weight a single node can take, so that the best nodes are picked more often but
+# do not end up in every circuit
+DEFAULT_MAX_NODE_SHARE = 0.2
+
+# Added to the latency (in seconds) of the nodes, so that a node a few microseconds away (e.g. on the same
+# machine) does not take all the weight
+LATENCY_FLOOR = 0.005
+
+
+def select_path(
+    nodes: Sequence[TorNode],
+    path_length: int,
+    max_node_share: float = DEFAULT_MAX_NODE_SHARE,
+) -> List[TorNode]:
+    """
+    Picks path_length distinct nodes, each one with a probability following its weight (see node_weights). The
+    nodes are picked uniformly if none of them reports its capacity or latency.
+    """
+    if path_length > len(nodes):
+        raise ValueError("Not enough nodes to build a path")
+
+    weights = cap_weights(node_weights(nodes), max_node_share)
+
+    # Weighted sampling without replacement (Efraimidis and Spirakis): the nodes with the largest
+    # random() ** (1 / weight) are picked
+    return [
+        node
+        for _, node in heapq.nlargest(
+            path_length,
+            (
+                (random.random() ** (1 / weight), node)
+                for node, weight in zip(nodes, weights)
+            ),
+            key=lambda item: item[0],
+        )
+    ]
+
+
+def node_weights(nodes: Sequence[TorNode]) -> List[float]:
+    """
+    Returns the weight of each node: its capacity divided by its latency. A node not reporting its capacity (or
+    its latency) is given the median of the ones reported by the other nodes, and so is a node reporting a capacity
+    that is not positive (or a negative latency), so that every weight is positive.
+    """
+    capacities = [_positive(node.capacity) for node in nodes]
+    latencies = [
+        None if node.latency is None or node.latency < 0 else node.latency
+        for node in nodes
+    ]
+    median_capacity = _median(capacities) or 1
+    median_latency = _median(latencies) or 0
+
+    return [
+        (capacity or median_capacity)
+        / ((median_latency if latency is None else latency) + LATENCY_FLOOR)
+        for capacity, latency in zip(capacities, latencies)
+    ]
+
+
+def cap_weights(weights: Sequence[float], max_share: float) -> List[float]:
+    """
+    Lowers the largest weights so that none of them is more than max_share of the total, the other weights are
+    left as they are. The weights become equal if max_share is too low for that (less than 1 / the number of
+    weights).
+    """
+    if max_share * len(weights) <= 1:
+        return [1.0] * len(weights)
+
+    capped = set()
+
+    while max_share * len(capped) < 1:
+        # The capped weights are set to the value making each of them exactly max_share of the new total
+        remaining_weight = sum(w for i, w in enumerate(weights) if i not in capped)
+        limit = max_share * remaining_weight / (1 - max_share * len(capped))
+        newly_capped = {
+            i for i, w in enumerate(weights) if i not in capped and w > limit
+        }
+
+        if not newly_capped:
+            return [limit if i in capped else w for i, w in enumerate(weights)]
+
+        capped |= newly_capped
+
+    return [1.0] * len(weights)
+
+
+def _positive(value: Optional[float]) -> Optional[float]:
+    return value if value is not None and value > 0 else None
+
+
+def _median(values) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
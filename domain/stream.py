@@ -0,0 +1,247 @@
+import struct
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Callable, Iterable, Iterator
+
+__all__ = (
+    "STREAM_CHUNK_SIZE",
+    "StreamError",
+    "ChunkedReader",
+    "encode_stream_record",
+    "read_stream_records",
+    "async_read_stream_records",
+    "encode_stream_chunks",
+    "async_encode_stream_chunks",
+    "split_into_chunks",
+    "decode_stream_chunks",
+    "async_decode_stream_chunks",
+    "split_raw_http_message",
+    "write_http_chunk",
+)
+
+# The size of the chunks a message is split into when streamed through a circuit
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# A stream is a sequence of records: the length of the record (4 bytes) followed by the record itself (one chunk,
+# encrypted once per remaining hop). Records longer than MAX_STREAM_RECORD_SIZE are refused so that the memory used by
+# a stream stays bounded.
+STREAM_RECORD_LENGTH_FORMAT = "!I"
+STREAM_RECORD_LENGTH_SIZE = struct.calcsize(STREAM_RECORD_LENGTH_FORMAT)
+MAX_STREAM_RECORD_SIZE = 2 * STREAM_CHUNK_SIZE
+
+# Before being encrypted, every chunk is prefixed by its sequence number (4 bytes) and flags (1 byte) so that the
+# receiver notices a missing, reordered or truncated chunk. The last chunk of a stream is empty and flagged.
+STREAM_CHUNK_HEADER_FORMAT = "!IB"
+STREAM_CHUNK_HEADER_SIZE = struct.calcsize(STREAM_CHUNK_HEADER_FORMAT)
+LAST_CHUNK_FLAG = 1
+
+
+class StreamError(Exception):
+    """
+    Raised when a stream is malformed, incomplete or its chunks are out of order.
+    """
+
+
+class ChunkedReader:
+    """
+    A file-like object reading the body of an HTTP message sent with the chunked transfer encoding.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self._chunk_left = 0
+        self._done = False
+
+    def read(self, size: int) -> bytes:
+        data = bytearray()
+
+        while len(data) < size and not self._done:
+            if self._chunk_left == 0:
+                # the chunk size may be followed by extensions (";name=value")
+                chunk_size = int(self.file.readline().split(b";", 1)[0], 16)
+
+                if chunk_size == 0:
+                    # skip the trailers
+                    while self.file.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    self._done = True
+                    break
+
+                self._chunk_left = chunk_size
+
+            part = self.file.read(min(size - len(data), self._chunk_left))
+
+            if not part:
+                raise StreamError("The chunked body ended unexpectedly")
+
+            data += part
+            self._chunk_left -= len(part)
+
+            if self._chunk_left == 0:
+                # the CRLF ending the chunk
+                self.file.readline()
+
+        return bytes(data)
+
+
+def write_http_chunk(file: BinaryIO, data: bytes):
+    """
+    Writes data as one chunk of an HTTP body sent with the chunked transfer encoding (empty data ends the body).
+    """
+    file.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+
+def encode_stream_record(record: bytes) -> bytes:
+    return struct.pack(STREAM_RECORD_LENGTH_FORMAT, len(record)) + record
+
+
+def _decode_stream_record_length(header: bytes) -> int:
+    if len(header) != STREAM_RECORD_LENGTH_SIZE:
+        raise StreamError("The stream ended in the middle of a record")
+
+    (length,) = struct.unpack(STREAM_RECORD_LENGTH_FORMAT, header)
+
+    if length > MAX_STREAM_RECORD_SIZE:
+        raise StreamError(f"The stream contains a record of {length} bytes")
+
+    return length
+
+
+def read_stream_records(read: Callable[[int], bytes]) -> Iterator[bytes]:
+    """
+    Yields the records read with the given function (e.g. the read method of a file) until the end of the stream.
+    """
+    while header := _read_exactly(read, STREAM_RECORD_LENGTH_SIZE):
+        length = _decode_stream_record_length(header)
+        record = _read_exactly(read, length)
+
+        if len(record) != length:
+            raise StreamError("The stream ended in the middle of a record")
+
+        yield record
+
+
+async def async_read_stream_records(reader) -> AsyncIterator[bytes]:
+    """
+    Same as read_stream_records but reads from an asyncio (or aiohttp) stream reader.
+    """
+    while header := await reader.read(STREAM_RECORD_LENGTH_SIZE):
+        if len(header) < STREAM_RECORD_LENGTH_SIZE:
+            header += await reader.readexactly(STREAM_RECORD_LENGTH_SIZE - len(header))
+
+        yield await reader.readexactly(_decode_stream_record_length(header))
+
+
+def _read_exactly(read: Callable[[int], bytes], size: int) -> bytes:
+    data = read(size)
+
+    while data and len(data) < size:
+        part = read(size - len(data))
+
+        if not part:
+            break
+
+        data += part
+
+    return data
+
+
+def encode_stream_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Numbers the given chunks and adds the (empty) last chunk, see decode_stream_chunks.
+    """
+    sequence = 0
+
+    for chunk in chunks:
+        if chunk:
+            yield struct.pack(STREAM_CHUNK_HEADER_FORMAT, sequence, 0) + chunk
+            sequence += 1
+
+    yield struct.pack(STREAM_CHUNK_HEADER_FORMAT, sequence, LAST_CHUNK_FLAG)
+
+
+async def async_encode_stream_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Same as encode_stream_chunks for an asynchronous iterable.
+    """
+    sequence = 0
+
+    async for chunk in chunks:
+        if chunk:
+            yield struct.pack(STREAM_CHUNK_HEADER_FORMAT, sequence, 0) + chunk
+            sequence += 1
+
+    yield struct.pack(STREAM_CHUNK_HEADER_FORMAT, sequence, LAST_CHUNK_FLAG)
+
+
+def split_into_chunks(
+    chunks: Iterable[bytes], chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Splits the given chunks so that none of them is longer than chunk_size.
+    """
+    for chunk in chunks:
+        for start in range(0, len(chunk), chunk_size):
+            yield chunk[start : start + chunk_size]
+
+
+def _decode_stream_chunk(chunk: bytes, expected_sequence: int) -> bool:
+    sequence, flags = struct.unpack_from(STREAM_CHUNK_HEADER_FORMAT, chunk)
+
+    if sequence != expected_sequence:
+        raise StreamError(f"Expected chunk {expected_sequence}, received {sequence}")
+
+    return bool(flags & LAST_CHUNK_FLAG)
+
+
+def decode_stream_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Yields the content of chunks encoded with encode_stream_chunks, raises a StreamError if a chunk is missing or if
+    the stream ends before its last chunk.
+    """
+    chunks = iter(chunks)
+
+    for sequence, chunk in enumerate(chunks):
+        if _decode_stream_chunk(chunk, sequence):
+            # Reading until the end of the stream also consumes the end of the underlying body, so that the connection
+            # is not reset when closed with unread data
+            if next(chunks, None) is not None:
+                raise StreamError("The stream continues after its last chunk")
+            return
+
+        yield chunk[STREAM_CHUNK_HEADER_SIZE:]
+
+    raise StreamError("The stream ended before its last chunk")
+
+
+async def async_decode_stream_chunks(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Same as decode_stream_chunks for an asynchronous iterable.
+    """
+    chunks = aiter(chunks)
+    sequence = 0
+
+    async for chunk in chunks:
+        if _decode_stream_chunk(chunk, sequence):
+            if await anext(chunks, None) is not None:
+                raise StreamError("The stream continues after its last chunk")
+            return
+
+        yield chunk[STREAM_CHUNK_HEADER_SIZE:]
+        sequence += 1
+
+    raise StreamError("The stream ended before its last chunk")
+
+
+def split_raw_http_message(raw_message: bytes) -> tuple[bytes, bytes]:
+    """
+    Splits a raw HTTP message into its head (start line and headers) and its body, at the first empty line.
+    """
+    ends = [
+        index + len(separator)
+        for separator in (b"\r\n\r\n", b"\n\n")
+        if (index := raw_message.find(separator)) != -1
+    ]
+
+    if not ends:
+        return raw_message, b""
+
+    return raw_message[: min(ends)], raw_message[min(ends) :]
@@ -1,8 +1,20 @@
-from typing import List, Tuple
-
-from cryptography.fernet import Fernet
-
-from domain.crypto import encrypt_message_using_public_key
+import ipaddress
+import struct
+from typing import List, Optional, Sequence, Tuple, Union
+
+from domain.compression import (
+    DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+    compress_payload,
+    decode_compression,
+    decompress_payload,
+    encode_compression,
+)
+from domain.crypto import (
+    DEFAULT_CIPHER_SUITES,
+    decrypt_using_symmetric_key,
+    encrypt_message_using_public_key,
+    public_key_cache,
+)
 from models.node import TorNode
 
 __all__ = (
@@ -10,90 +22,199 @@ __all__ = (
     "decode_tor_message_for_intermediate_node",
     "encode_tor_message_for_intermediate_node",
     "decode_tor_message_for_final_node",
+    "decode_final_node_compression",
+    "encode_node_address",
+    "decode_node_address",
     "is_final_node",
     "create_onion_message",
-    "peel_response"
+    "peel_response",
+    "TOR_MESSAGE_CONTENT_TYPE",
 )
 
+# The content type of every message exchanged between the client and the nodes
+TOR_MESSAGE_CONTENT_TYPE = "application/octet-stream"
+
+FINAL_NODE_FLAG = 1
+INTERMEDIATE_NODE_FLAG = 0
+# The flag for the final node when the payloads it exchanges with the client are compressed (see domain.compression)
+FINAL_NODE_COMPRESSED_FLAG = 2
+
+# The address types (same values as in SOCKS5), followed by the address itself and the port
+ADDRESS_TYPE_IPV4 = 1
+ADDRESS_TYPE_DOMAIN = 3
+ADDRESS_TYPE_IPV6 = 4
+
+
+def encode_node_address(ip: str, port: int) -> bytes:
+    """
+    Encodes a node address in binary: the address type (1 byte), the address (4 bytes for IPv4, 16 bytes for IPv6,
+    or the length of the domain name on 1 byte followed by the domain name) and the port (2 bytes).
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        domain = ip.encode("idna")
+        header = struct.pack("!BB", ADDRESS_TYPE_DOMAIN, len(domain)) + domain
+    else:
+        address_type = ADDRESS_TYPE_IPV4 if address.version == 4 else ADDRESS_TYPE_IPV6
+        header = struct.pack("!B", address_type) + address.packed
+
+    return header + struct.pack("!H", int(port))
+
+
+def decode_node_address(message: bytes) -> Tuple[str, int, int]:
+    """
+    Decodes a node address encoded with encode_node_address at the start of the given message.
+
+    :return: The ip, the port and the length of the encoded address
+    """
+    address_type = message[0]
+
+    if address_type == ADDRESS_TYPE_DOMAIN:
+        end = 2 + message[1]
+        ip = bytes(message[2:end]).decode("idna")
+    else:
+        end = 5 if address_type == ADDRESS_TYPE_IPV4 else 17
+        ip = str(ipaddress.ip_address(bytes(message[1:end])))
+
+    (port,) = struct.unpack_from("!H", message, end)
 
-def encode_tor_message_for_final_node(message: str) -> str:
+    return ip, port, end + 2
+
+
+def encode_tor_message_for_final_node(
+    message: bytes,
+    compression: Optional[str] = None,
+    compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+) -> bytes:
     """
     Encode a message to be sent to the final node, 1 is the flag for the final node
+
+    With a compression, the flag is 2 and is followed by the byte identifying the compression of the response, then
+    the message compressed with compress_payload (left as is when smaller than compression_threshold).
     """
-    return f"1\n" + message
+    if compression is None:
+        return bytes((FINAL_NODE_FLAG,)) + message
+
+    return bytes(
+        (FINAL_NODE_COMPRESSED_FLAG, encode_compression(compression))
+    ) + compress_payload(message, compression, compression_threshold)
 
 
 def encode_tor_message_for_intermediate_node(
-    encrypted_message: str, next_node: TorNode
-) -> str:
+    encrypted_message: bytes, next_node: TorNode
+) -> bytes:
     """
     Encode a message to be sent to the next node, 0 is the flag for the intermediate node
-    After the 0, the next node address is written, then the encrypted message just after exactly one line break.
+    After the 0, the next node address is written (see encode_node_address), then the encrypted message.
     """
-    return f"0\n{next_node.ip}:{next_node.port}\n" + encrypted_message
+    return (
+        bytes((INTERMEDIATE_NODE_FLAG,))
+        + encode_node_address(next_node.ip, next_node.port)
+        + encrypted_message
+    )
 
 
-def is_final_node(tor_message: str) -> bool:
+def is_final_node(tor_message: bytes) -> bool:
     """
     Check if the message is for the final node or not
     """
-    return tor_message[0] == "1"
+    return tor_message[0] in (FINAL_NODE_FLAG, FINAL_NODE_COMPRESSED_FLAG)
 
 
-def decode_tor_message_for_final_node(tor_message: str) -> str:
+def decode_tor_message_for_final_node(tor_message: bytes) -> Union[bytes, memoryview]:
     """
-    Decode a message for the final node
+    Decode a message for the final node (a view of the message, it is not copied, unless it was compressed)
     """
-    tor_message = tor_message[2:]
-    return tor_message
+    if tor_message[0] == FINAL_NODE_COMPRESSED_FLAG:
+        return decompress_payload(memoryview(tor_message)[2:])
 
+    return memoryview(tor_message)[1:]
 
-def decode_tor_message_for_intermediate_node(tor_message: str) -> Tuple[str, str]:
+
+def decode_final_node_compression(tor_message: bytes) -> Optional[str]:
     """
-    Decode a message for the intermediate node.
-    The message is split into 2 parts, the first part is the next node address, the
-    second part is the encrypted message to be sent to the next node.
+    Returns the compression the final node uses for its response (see compress_payload), None if it must be sent
+    as is.
     """
+    if tor_message[0] == FINAL_NODE_COMPRESSED_FLAG:
+        if len(tor_message) < 2:
+            raise ValueError("The compression of the response is missing")
+
+        return decode_compression(tor_message[1])
+
+    return None
 
-    tor_message = tor_message[2:]
-    first_line_end_index = tor_message.find("\n")
-    next_node = tor_message[:first_line_end_index]
-    http_message = tor_message[first_line_end_index + 1 :]
 
-    return next_node, http_message
+def decode_tor_message_for_intermediate_node(
+    tor_message: bytes,
+) -> Tuple[str, memoryview]:
+    """
+    Decode a message for the intermediate node.
+    The message is split into 2 parts, the first part is the next node address (as ip:port), the
+    second part is the encrypted message to be sent to the next node (a view of the message, it is not copied).
+    Raises a ValueError if the next node address is malformed.
+    """
+    tor_message = memoryview(tor_message)
+    try:
+        ip, port, address_length = decode_node_address(tor_message[1:])
+    except (IndexError, struct.error) as exception:
+        raise ValueError("The next node address is truncated") from exception
+    host = f"[{ip}]" if ":" in ip else ip
 
+    return f"{host}:{port}", tor_message[1 + address_length :]
 
-def peel_response(response, sym_keys) -> str:
+
+def peel_response(
+    response: bytes, sym_keys, compression: Optional[str] = None
+) -> bytes:
     """
     Peels the response from the final node to get the original message.
 
-    To achieve this, the response is decrypted using the symmetric keys in the reverse order.
+    To achieve this, the response is decrypted using the symmetric keys in the reverse order, then decompressed if
+    the message was sent with a compression (see create_onion_message).
     """
     for sym_key in sym_keys[::-1]:
-        response = Fernet(sym_key).decrypt(response.encode("utf-8")).decode("utf-8")
+        response = decrypt_using_symmetric_key(response, sym_key)
+
+    if compression is not None:
+        return bytes(decompress_payload(response))
+
     return response
 
 
 def create_onion_message(
-    path: List[TorNode], http_message: str
-) -> tuple[list[bytes], str]:
+    path: List[TorNode],
+    http_message: Union[str, bytes],
+    cipher_suites: Sequence[str] = DEFAULT_CIPHER_SUITES,
+    compression: Optional[str] = None,
+    compression_threshold: int = DEFAULT_PAYLOAD_COMPRESSION_THRESHOLD,
+) -> tuple[list[bytes], bytes]:
     """
     Creates the onion message to send through the Tor network.
 
     To achieve this, the message is encrypted using the symmetric keys in the reverse order (path speaking, last to first).
+
+    With a compression (one supported by the final node, see select_compression), the message is compressed before
+    being encrypted and so is the response, see peel_response.
     """
-    tor_message = encode_tor_message_for_final_node(http_message)
+    if isinstance(http_message, str):
+        http_message = http_message.encode("utf-8")
+
+    tor_message = encode_tor_message_for_final_node(
+        http_message, compression, compression_threshold
+    )
     tor_message, first_sym_key = encrypt_message_using_public_key(
-        tor_message, path[-1].public_key.encode("utf-8")
+        tor_message, public_key_cache.get(path[-1]), cipher_suites
     )
     sym_keys = [first_sym_key]
 
-    for node in path[::-1][1:]:
+    for index in range(len(path) - 2, -1, -1):
         tor_message = encode_tor_message_for_intermediate_node(
-            tor_message, path[path.index(node) + 1]
+            tor_message, path[index + 1]
         )
         tor_message, sym_key = encrypt_message_using_public_key(
-            tor_message, node.public_key.encode("utf-8")
+            tor_message, public_key_cache.get(path[index]), cipher_suites
         )
         sym_keys.append(sym_key)
 
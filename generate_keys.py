@@ -0,0 +1,19 @@
+import argparse
+
+from domain import DEFAULT_KEY_STORE_DIRECTORY, KeyStore
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates key sets ahead of time, claimed by the nodes starting without keys"
+    )
+    parser.add_argument("count", type=int)
+    parser.add_argument(
+        "--key-store",
+        default=DEFAULT_KEY_STORE_DIRECTORY,
+        help="directory where the keys are kept",
+    )
+    args = parser.parse_args()
+
+    key_store = KeyStore(args.key_store)
+    key_store.pregenerate(args.count)
+    print(f"{key_store.pool_size()} key sets ready in {args.key_store}")
@@ -1,7 +1,24 @@
-import sys
+import argparse
 
+from clients.arguments import (
+    add_concurrency_arguments,
+    add_key_store_arguments,
+    key_store_from_arguments,
+)
 from clients.auth_server import AuthServerNode
 
 if __name__ == "__main__":
-    auth_node = AuthServerNode((sys.argv[1], int(sys.argv[2])))
+    parser = argparse.ArgumentParser(description="Starts an auth server")
+    parser.add_argument("ip")
+    parser.add_argument("port", type=int)
+    add_concurrency_arguments(parser)
+    add_key_store_arguments(parser)
+    args = parser.parse_args()
+
+    auth_node = AuthServerNode(
+        (args.ip, args.port),
+        max_workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        key_store=key_store_from_arguments(args),
+    )
     auth_node.serve_forever()
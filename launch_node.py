@@ -1,9 +1,85 @@
-import sys
+import argparse
 
+from clients.arguments import (
+    add_concurrency_arguments,
+    add_connection_pool_arguments,
+    add_exit_cache_arguments,
+    add_key_store_arguments,
+    exit_cache_from_arguments,
+    key_store_from_arguments,
+)
+from clients.async_server_node import AsyncServerNode
+from clients.concurrency import DEFAULT_MAX_DETACHED_REQUESTS
 from clients.server_node import ServerNode
 
 if __name__ == "__main__":
-    server_node = ServerNode(
-        (sys.argv[1], int(sys.argv[2])), (sys.argv[3], int(sys.argv[4]))
+    parser = argparse.ArgumentParser(description="Starts a tor node")
+    parser.add_argument("ip")
+    parser.add_argument("port", type=int)
+    parser.add_argument("registry_ip")
+    parser.add_argument("registry_port", type=int)
+    parser.add_argument(
+        "--engine",
+        choices=("threaded", "asyncio"),
+        default="threaded",
+        help="threaded: one thread per request in flight, asyncio: a single event loop "
+        "(the --workers option is then the number of threads running the cryptographic operations)",
     )
+    parser.add_argument(
+        "--crypto-processes",
+        type=int,
+        default=0,
+        help="number of processes running the cryptographic operations (0 to run them in the threads)",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=None,
+        help="capacity reported to the registry, the clients pick the nodes with a larger capacity more often "
+        "(threaded engine: the number of workers by default)",
+    )
+    parser.add_argument(
+        "--max-mux-connections",
+        type=int,
+        default=DEFAULT_MAX_DETACHED_REQUESTS,
+        help="threaded engine: number of multiplexed connections relayed at the same time (each one in a thread of "
+        "its own), the next ones get a 503",
+    )
+    add_concurrency_arguments(parser)
+    add_connection_pool_arguments(parser)
+    add_key_store_arguments(parser)
+    add_exit_cache_arguments(parser)
+    args = parser.parse_args()
+
+    # Only pass the pool size when given, each engine has its own default
+    pool_options = dict(
+        pool_idle_timeout=args.pool_idle_timeout,
+        dns_cache_ttl=args.dns_cache_ttl,
+        prewarm_origins=args.prewarm_origins,
+        key_store=key_store_from_arguments(args),
+        capacity=args.capacity,
+        exit_cache=exit_cache_from_arguments(args),
+    )
+
+    if args.pool_size is not None:
+        pool_options["pool_size"] = args.pool_size
+
+    if args.engine == "asyncio":
+        server_node = AsyncServerNode(
+            (args.ip, args.port),
+            (args.registry_ip, args.registry_port),
+            crypto_workers=args.workers,
+            crypto_processes=args.crypto_processes,
+            **pool_options,
+        )
+    else:
+        server_node = ServerNode(
+            (args.ip, args.port),
+            (args.registry_ip, args.registry_port),
+            max_workers=args.workers,
+            max_in_flight=args.max_in_flight,
+            max_mux_connections=args.max_mux_connections,
+            crypto_processes=args.crypto_processes,
+            **pool_options,
+        )
     server_node.serve_forever()
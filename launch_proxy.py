@@ -1,9 +1,43 @@
+import argparse
 import asyncio
-import sys
 
-from clients.proxy import start_proxy
+from clients.async_client import DEFAULT_MAX_REQUESTS_PER_CIRCUIT
+from clients.circuit_pool import DEFAULT_CIRCUIT_POOL_SIZE
+from clients.proxy import DEFAULT_MAX_CONCURRENT_REQUESTS, start_proxy
 
 if __name__ == "__main__":
-    host = sys.argv[1]
-    port = int(sys.argv[2])
-    asyncio.run(start_proxy(host, port, (sys.argv[3], int(sys.argv[4]))))
+    parser = argparse.ArgumentParser(description="Starts a proxy sending the requests through the tor network")
+    parser.add_argument("ip")
+    parser.add_argument("port", type=int)
+    parser.add_argument("registry_ip")
+    parser.add_argument("registry_port", type=int)
+    parser.add_argument(
+        "--max-concurrent-requests",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        help="number of requests sent through the tor network at the same time, the next ones wait",
+    )
+    parser.add_argument(
+        "--circuits",
+        type=int,
+        default=DEFAULT_CIRCUIT_POOL_SIZE,
+        help="number of circuits kept ready",
+    )
+    parser.add_argument(
+        "--max-requests-per-circuit",
+        type=int,
+        default=DEFAULT_MAX_REQUESTS_PER_CIRCUIT,
+        help="number of requests in flight at the same time on a circuit",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        start_proxy(
+            args.ip,
+            args.port,
+            (args.registry_ip, args.registry_port),
+            max_concurrent_requests=args.max_concurrent_requests,
+            circuit_pool_size=args.circuits,
+            max_requests_per_circuit=args.max_requests_per_circuit,
+        )
+    )
@@ -1,2 +1,3 @@
 from .http_message import *
-from .node import *
\ No newline at end of file
+from .node import *
+from .circuit import *
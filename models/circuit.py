@@ -0,0 +1,41 @@
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .node import TorNode
+
+__all__ = ("Circuit", "CircuitHop")
+
+
+@dataclass
+class Circuit:
+    """
+    The client side view of a circuit: the path, the circuit id used by each hop and the
+    session key negotiated with each hop (all in path order, entry node first).
+    """
+
+    path: List[TorNode]
+    circuit_ids: List[str]
+    sym_keys: List[bytes]
+    expires_at: float
+    # The compression of the payloads exchanged with the exit node (None if they are not compressed)
+    compression: Optional[str] = None
+
+    def is_expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+
+@dataclass
+class CircuitHop:
+    """
+    The node side view of a circuit: the session key shared with the client and where to
+    forward the messages (next_node is None for the exit node).
+    """
+
+    circuit_id: str
+    sym_key: bytes
+    next_node: Optional[str]
+    next_circuit_id: Optional[str]
+    expires_at: float
+    # The compression of the payloads exchanged with the client (exit node only)
+    compression: Optional[str] = None
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Union
 
 __all__ = ("RawHttpRequest", "RawHttpResponse")
 
@@ -8,9 +9,10 @@ class RawHttpRequest:
     host: str
     http_version: str
     path: str
-    method: int
+    method: str
     headers: str
-    body: str
+    # A memoryview when the message was parsed from bytes
+    body: Union[str, memoryview]
 
 
 @dataclass
@@ -19,4 +21,5 @@ class RawHttpResponse:
     status: str
     url: str
     headers: str
-    body: str
+    # A memoryview when the message was parsed from bytes
+    body: Union[str, memoryview]
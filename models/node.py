@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 __all__ = ("TorNode",)
 
@@ -7,6 +8,10 @@ class TorNode:
     ip: str
     port: int
     public_key: str
+    # The number of requests the node handles at the same time, as reported by the node
+    capacity: Optional[int] = None
+    # The latency (in seconds) of the node, as measured by the registry
+    latency: Optional[float] = None
 
     def __hash__(self):
         return hash((self.ip, self.port))
@@ -0,0 +1,154 @@
+import contextlib
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from clients.async_server_node import AsyncServerNode
+from clients.registry_node import RegistryNode
+from clients.server_node import ServerNode
+
+# The time (in seconds) the slow endpoint of the target server takes to answer
+SLOW_RESPONSE_DELAY = 1.5
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_in_background(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+class TargetServer(ThreadingHTTPServer):
+    """
+    A target server counting the requests it receives, by method and path. /slow answers after
+    SLOW_RESPONSE_DELAY seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.received = {}
+        self._lock = threading.Lock()
+        super().__init__(("127.0.0.1", free_port()), _TargetHandler)
+
+    @property
+    def host(self) -> str:
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, method: str, path: str) -> int:
+        with self._lock:
+            return self.received.get((method, path), 0)
+
+    def record(self, method: str, path: str):
+        with self._lock:
+            self.received[method, path] = self.received.get((method, path), 0) + 1
+
+
+class _TargetHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._answer()
+
+    def _answer(self):
+        self.server.record(self.command, self.path)
+
+        if self.path == "/slow":
+            time.sleep(SLOW_RESPONSE_DELAY)
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+        except OSError:
+            # The exit node stopped waiting
+            pass
+
+    def log_message(self, format, *args):
+        return None
+
+
+@pytest.fixture
+def target_server():
+    server = TargetServer()
+    serve_in_background(server)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@contextlib.contextmanager
+def running_tor_network(node_class, nodes_count: int = 3, **node_options):
+    """
+    Runs a registry and nodes_count nodes registered to it, gives the address of the registry.
+    """
+    registry = RegistryNode(("127.0.0.1", free_port()), health_check_interval=None)
+    serve_in_background(registry)
+    nodes = [
+        node_class(("127.0.0.1", free_port()), registry.server_address, **node_options)
+        for _ in range(nodes_count)
+    ]
+
+    for node in nodes:
+        serve_in_background(node)
+
+    registry_url = f"http://127.0.0.1:{registry.server_address[1]}/"
+    deadline = time.monotonic() + 10
+
+    while len(requests.get(registry_url).json()) < nodes_count:
+        assert time.monotonic() < deadline, "The nodes did not register"
+        time.sleep(0.1)
+
+    try:
+        yield registry.server_address
+    finally:
+        for node in nodes:
+            if isinstance(node, ServerNode):
+                # Not closed, its workers may still hold kept alive connections
+                node.shutdown()
+
+        registry.shutdown()
+        registry.server_close()
+
+
+@pytest.fixture(params=[ServerNode, AsyncServerNode], ids=["threaded", "asyncio"])
+def tor_network(request):
+    """
+    A registry and three nodes (of the engine of the test) registered to it, gives the address of the registry.
+    """
+    with running_tor_network(request.param) as registry_address:
+        yield registry_address
+
+
+@pytest.fixture(params=[ServerNode, AsyncServerNode], ids=["threaded", "asyncio"])
+def node(request):
+    """
+    A single node (of the engine of the test), its circuits are added by the tests.
+    """
+    registry = RegistryNode(("127.0.0.1", free_port()), health_check_interval=None)
+    serve_in_background(registry)
+    node = request.param(("127.0.0.1", free_port()), registry.server_address)
+    serve_in_background(node)
+
+    while not requests.get(f"http://127.0.0.1:{registry.server_address[1]}/").json():
+        time.sleep(0.1)
+
+    yield node
+
+    if isinstance(node, ServerNode):
+        node.shutdown()
+
+    registry.shutdown()
+    registry.server_close()
@@ -0,0 +1,26 @@
+import argparse
+
+from clients.arguments import (
+    add_exit_cache_arguments,
+    add_key_store_arguments,
+    exit_cache_from_arguments,
+    key_store_from_arguments,
+)
+from domain import HttpCache, KeyStore
+
+
+def parse(*arguments) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    add_key_store_arguments(parser)
+    add_exit_cache_arguments(parser)
+    return parser.parse_args(arguments)
+
+
+def test_key_store(tmp_path):
+    assert isinstance(key_store_from_arguments(parse("--key-store", str(tmp_path))), KeyStore)
+    assert key_store_from_arguments(parse("--ephemeral-keys")) is None
+
+
+def test_exit_cache():
+    assert exit_cache_from_arguments(parse()) is None
+    assert isinstance(exit_cache_from_arguments(parse("--cache-size", "1")), HttpCache)
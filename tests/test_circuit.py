@@ -0,0 +1,57 @@
+import os
+
+import pytest
+import requests
+
+from domain import TOR_MESSAGE_CONTENT_TYPE, encode_tor_message_for_intermediate_node
+from models import TorNode
+
+CIRCUIT_ID = "00" * 16
+CIRCUIT_IDS = bytes(32)
+
+
+def create_circuit(node, body: bytes) -> requests.Response:
+    return requests.post(
+        f"http://127.0.0.1:{node.server_address[1]}/circuit",
+        data=body,
+        headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+        timeout=10,
+    )
+
+
+@pytest.mark.parametrize(
+    "body",
+    [b"", b"\x00", b"\x00\x00", b"\x00\x00\x01", b"\x00\x00" + os.urandom(100), os.urandom(1000)],
+    ids=["empty", "no-length", "no-suite", "no-key", "x25519-garbage", "rsa-garbage"],
+)
+def test_handshake_not_encrypted_for_the_node(node, body):
+    assert create_circuit(node, body).status_code == 400
+
+
+@pytest.mark.parametrize(
+    "handshake",
+    [b"", CIRCUIT_IDS, CIRCUIT_IDS + b"\x00", CIRCUIT_IDS + b"\x00\x01\x7f\x00", CIRCUIT_IDS + b"\x02", CIRCUIT_IDS + b"\x02\xff"],
+    ids=["empty", "no-tor-message", "no-next-node", "truncated-next-node", "no-compression", "unknown-compression"],
+)
+def test_truncated_handshake(node, handshake):
+    encrypted_handshake, _ = node.crypto.encrypt(handshake)
+    response = create_circuit(node, encrypted_handshake)
+
+    assert response.status_code == 400
+    assert node.circuits.get(CIRCUIT_ID) is None
+
+
+def test_onion_status_of_the_next_node_is_forwarded(node):
+    # The node is its own next node, which rejects the unknown compression
+    exit_message, _ = node.crypto.encrypt(b"\x02\xff")
+    relay_message, _ = node.crypto.encrypt(
+        encode_tor_message_for_intermediate_node(exit_message, TorNode(*node.server_address, ""))
+    )
+    response = requests.post(
+        f"http://127.0.0.1:{node.server_address[1]}/",
+        data=relay_message,
+        headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+        timeout=10,
+    )
+
+    assert response.status_code == 400
@@ -0,0 +1,79 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+import domain.compression
+from domain import (
+    PAYLOAD_COMPRESSION_ZLIB,
+    PAYLOAD_COMPRESSION_ZSTD,
+    SUPPORTED_PAYLOAD_COMPRESSIONS,
+    compress_payload,
+    decompress_payload,
+    select_compression,
+)
+
+PAYLOAD = b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n" + b"<p>Hello world</p>" * 1000
+
+
+@pytest.mark.parametrize("compression", SUPPORTED_PAYLOAD_COMPRESSIONS)
+def test_round_trip(compression):
+    compressed_payload = compress_payload(PAYLOAD, compression)
+
+    assert len(compressed_payload) < len(PAYLOAD) / 10
+    assert bytes(decompress_payload(compressed_payload)) == PAYLOAD
+
+
+def test_small_payload_sent_as_is():
+    assert compress_payload(b"small", PAYLOAD_COMPRESSION_ZLIB) == b"\x00small"
+    assert bytes(decompress_payload(b"\x00small")) == b"small"
+
+
+def test_incompressible_payload_sent_as_is():
+    payload = os.urandom(4096)
+
+    assert compress_payload(payload, PAYLOAD_COMPRESSION_ZLIB) == b"\x00" + payload
+
+
+@pytest.mark.parametrize("payload", [b"", b"\x01not zlib", b"\x09unknown"])
+def test_corrupted_payload(payload):
+    with pytest.raises(ValueError):
+        decompress_payload(payload)
+
+
+def test_too_large_payload(monkeypatch):
+    compressed_payload = compress_payload(PAYLOAD, PAYLOAD_COMPRESSION_ZLIB)
+    monkeypatch.setattr(domain.compression, "MAX_DECOMPRESSED_PAYLOAD_SIZE", len(PAYLOAD) - 1)
+
+    with pytest.raises(ValueError):
+        decompress_payload(compressed_payload)
+
+
+def test_zlib_without_zstandard(monkeypatch):
+    # An import of a module set to None in sys.modules raises ImportError
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+    try:
+        compression = importlib.reload(domain.compression)
+
+        assert compression.SUPPORTED_PAYLOAD_COMPRESSIONS == (PAYLOAD_COMPRESSION_ZLIB,)
+        assert (
+            compression.select_compression(
+                compression.DEFAULT_PAYLOAD_COMPRESSIONS,
+                (PAYLOAD_COMPRESSION_ZSTD, PAYLOAD_COMPRESSION_ZLIB),
+            )
+            == PAYLOAD_COMPRESSION_ZLIB
+        )
+
+        with pytest.raises(ValueError):
+            compression.decompress_payload(b"\x02zstd frame")
+    finally:
+        monkeypatch.undo()
+        importlib.reload(domain.compression)
+
+
+def test_select_compression():
+    assert select_compression((PAYLOAD_COMPRESSION_ZLIB,), SUPPORTED_PAYLOAD_COMPRESSIONS) == PAYLOAD_COMPRESSION_ZLIB
+    assert select_compression((), SUPPORTED_PAYLOAD_COMPRESSIONS) is None
+    assert select_compression((PAYLOAD_COMPRESSION_ZLIB,), ()) is None
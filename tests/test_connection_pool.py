@@ -0,0 +1,67 @@
+import socket
+import time
+
+import requests
+
+from clients.registry_node import RegistryNode
+from clients.server_node import ServerNode
+from domain import ConnectionPool, IDLE_REUSE_MARGIN, reuse_timeout
+from tests.conftest import free_port, serve_in_background
+
+
+def test_reuse_timeout():
+    assert reuse_timeout(4) == 4 - IDLE_REUSE_MARGIN
+    assert reuse_timeout(IDLE_REUSE_MARGIN / 2) == 0
+
+
+def test_connection_not_reused_before_the_server_closes_it(target_server):
+    pool = ConnectionPool(idle_timeout=1)
+    origin = f"http://{target_server.host}"
+
+    try:
+        pool.request("GET", f"{origin}/fast")
+        pool.request("GET", f"{origin}/fast")
+        time.sleep(reuse_timeout(1) + 0.1)
+        pool.request("GET", f"{origin}/fast")
+    finally:
+        pool.close()
+
+    assert pool.stats.as_dict()[origin] == {
+        "created": 2,
+        "reused": 1,
+        "expired": 1,
+    }
+
+
+def test_node_closes_idle_connections():
+    registry = RegistryNode(("127.0.0.1", free_port()), health_check_interval=None)
+    serve_in_background(registry)
+    node = ServerNode(("127.0.0.1", free_port()), registry.server_address, pool_idle_timeout=1)
+    serve_in_background(node)
+
+    try:
+        while not requests.get(f"http://127.0.0.1:{registry.server_address[1]}/").json():
+            time.sleep(0.1)
+
+        with socket.create_connection(node.server_address) as connection:
+            connection.sendall(b"GET /key HTTP/1.1\r\nHost: node\r\n\r\n")
+            connection.settimeout(5)
+            started = time.monotonic()
+            received = b""
+
+            while True:
+                data = connection.recv(65536)
+
+                if not data:
+                    break
+
+                received += data
+
+        # The idle connection was closed after the idle timeout of the pools, freeing its worker
+        assert received.startswith(b"HTTP/1.1 200")
+        assert time.monotonic() - started < 2
+    finally:
+        node.shutdown()
+        node.server_close()
+        registry.shutdown()
+        registry.server_close()
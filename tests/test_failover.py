@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+import domain.http_message
+from clients.client import TorClient
+from domain import CircuitError, CircuitTimeoutError
+from tests.conftest import SLOW_RESPONSE_DELAY, free_port
+
+
+@pytest.fixture(autouse=True)
+def short_exit_timeout(monkeypatch):
+    # The exit nodes stop waiting for /slow before it answers
+    monkeypatch.setattr(domain.http_message, "EXIT_REQUEST_TIMEOUT", 0.5)
+
+
+@pytest.fixture
+def client(tor_network):
+    client = TorClient(tor_network, circuit_pool_size=2)
+    yield client
+    client.close()
+
+
+def test_post_timing_out_is_sent_once(client, target_server):
+    message = f"POST /slow HTTP/1.1\r\nHost: {target_server.host}\r\nContent-Length: 4\r\n\r\nbody"
+
+    with pytest.raises(CircuitTimeoutError):
+        client.send_http_message(message.encode())
+
+    time.sleep(SLOW_RESPONSE_DELAY)
+    assert target_server.count("POST", "/slow") == 1
+
+
+def test_get_timing_out_is_sent_again(client, target_server):
+    message = f"GET /slow HTTP/1.1\r\nHost: {target_server.host}\r\n\r\n"
+
+    with pytest.raises(CircuitError):
+        client.send_http_message(message.encode())
+
+    time.sleep(SLOW_RESPONSE_DELAY)
+    assert target_server.count("GET", "/slow") == client.circuits.size + 1
+
+
+def test_post_to_unreachable_target_server_is_sent_again(client):
+    # Nothing listens on that port: the message is never forwarded, it goes through every circuit
+    message = f"POST / HTTP/1.1\r\nHost: 127.0.0.1:{free_port()}\r\nContent-Length: 0\r\n\r\n"
+
+    with pytest.raises(CircuitError):
+        client.send_http_message(message.encode())
+
+
+def test_post_is_answered(client, target_server):
+    message = f"POST /fast HTTP/1.1\r\nHost: {target_server.host}\r\nContent-Length: 4\r\n\r\nbody"
+
+    assert client.send_http_message(message.encode()).endswith(b"ok")
+    assert target_server.count("POST", "/fast") == 1
+
+
+def test_hedge_delay_falls_back_to_hedge_after(tor_network):
+    client = TorClient(tor_network, hedge_after=2.0, hedge_percentile=95)
+
+    try:
+        assert client.hedge_delay() == 2.0
+
+        for _ in range(client.latencies.min_samples):
+            client.latencies.add(0.25)
+
+        assert client.hedge_delay() == 0.25
+    finally:
+        client.close()
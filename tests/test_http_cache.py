@@ -0,0 +1,177 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from domain import CachedResponse, HttpCache, freshness_lifetime
+from domain.http_cache import MAX_HEURISTIC_FRESHNESS
+
+URL = "http://example.com/page"
+
+
+def response(headers: dict, body: bytes = b"body", stored_at=None) -> CachedResponse:
+    return CachedResponse(
+        status_code=200,
+        reason="OK",
+        url=URL,
+        headers=list(headers.items()),
+        body=body,
+        stored_at=stored_at if stored_at is not None else time.time(),
+        lifetime=0,
+    )
+
+
+def store(cache: HttpCache, headers: dict, request_headers=None, **kwargs) -> bool:
+    return cache.store(URL, request_headers or {}, response(headers, **kwargs), headers)
+
+
+def test_freshness_lifetime():
+    now = time.time()
+
+    assert freshness_lifetime(200, {"Cache-Control": "max-age=60"}) == 60
+    # s-maxage is for the shared caches, it wins over max-age
+    assert freshness_lifetime(200, {"Cache-Control": "max-age=60, s-maxage=10"}) == 10
+    assert freshness_lifetime(200, {"Cache-Control": "max-age=soon"}) == 0
+    assert freshness_lifetime(
+        200, {"Date": formatdate(now, usegmt=True), "Expires": formatdate(now + 120, usegmt=True)}
+    ) == pytest.approx(120, abs=1)
+    assert freshness_lifetime(200, {"Expires": "0"}) == 0
+    assert freshness_lifetime(
+        200, {"Date": formatdate(now, usegmt=True), "Last-Modified": formatdate(now - 1000, usegmt=True)}
+    ) == pytest.approx(100, abs=1)
+    assert freshness_lifetime(200, {"Last-Modified": formatdate(0, usegmt=True)}) == MAX_HEURISTIC_FRESHNESS
+    assert freshness_lifetime(500, {"Last-Modified": formatdate(now - 1000, usegmt=True)}) == 0
+    assert freshness_lifetime(200, {}) == 0
+
+
+def test_fresh_response_is_a_hit():
+    cache = HttpCache()
+
+    assert store(cache, {"Cache-Control": "max-age=60"})
+    entry = cache.lookup(URL, {})
+
+    assert entry.body == b"body"
+    assert cache.is_usable(entry, {})
+    assert not cache.is_usable(entry, {"Cache-Control": "no-cache"})
+    assert cache.stats()["hits"] == 1
+
+
+def test_stale_response_is_revalidated():
+    cache = HttpCache()
+    store(
+        cache,
+        {"Cache-Control": "max-age=10", "ETag": '"v1"'},
+        stored_at=time.time() - 20,
+    )
+    entry = cache.lookup(URL, {})
+
+    assert not entry.is_fresh()
+    assert entry.validators() == {"If-None-Match": '"v1"'}
+
+    renewed_entry = cache.revalidated(URL, entry, {"Cache-Control": "max-age=30"})
+
+    assert renewed_entry.is_fresh()
+    assert renewed_entry.lifetime == 30
+    assert renewed_entry.get_header("ETag") == '"v1"'
+    assert cache.lookup(URL, {}).is_fresh()
+    assert cache.stats()["revalidations"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 0
+
+
+def test_initial_age_counts():
+    cache = HttpCache()
+    store(cache, {"Cache-Control": "max-age=60", "Age": "59"})
+
+    assert cache.lookup(URL, {}).age() >= 59
+    store(cache, {"Cache-Control": "max-age=60", "Age": "61"})
+
+    assert not cache.lookup(URL, {}).is_fresh()
+
+
+def test_no_cache_response_is_always_revalidated():
+    cache = HttpCache()
+    store(cache, {"Cache-Control": "no-cache, max-age=60", "ETag": '"v1"'})
+
+    assert not cache.lookup(URL, {}).is_fresh()
+
+
+@pytest.mark.parametrize(
+    "headers, request_headers",
+    [
+        ({"Cache-Control": "no-store, max-age=60"}, {}),
+        ({"Cache-Control": "private, max-age=60"}, {}),
+        ({"Cache-Control": "max-age=60", "Set-Cookie": "id=1"}, {}),
+        ({"Cache-Control": "max-age=60", "Vary": "*"}, {}),
+        ({"Cache-Control": "max-age=60"}, {"Cookie": "id=1"}),
+        # Neither fresh nor revalidable
+        ({}, {}),
+    ],
+)
+def test_not_stored(headers, request_headers):
+    assert not store(HttpCache(), headers, request_headers)
+
+
+def test_cookie_request_public_response_is_stored():
+    assert store(HttpCache(), {"Cache-Control": "public, max-age=60"}, {"Cookie": "id=1"})
+
+
+def test_cacheable_requests():
+    assert HttpCache.is_cacheable_request("GET", {})
+    assert not HttpCache.is_cacheable_request("POST", {})
+    assert not HttpCache.is_cacheable_request("GET", {"Authorization": "Bearer x"})
+    assert not HttpCache.is_cacheable_request("GET", {"If-None-Match": '"v1"'})
+    assert not HttpCache.is_cacheable_request("GET", {"Cache-Control": "no-store"})
+
+
+def test_vary():
+    cache = HttpCache()
+    headers = {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+    store(cache, headers, {"Accept-Language": "fr"}, body=b"bonjour")
+    store(cache, headers, {"Accept-Language": "en"}, body=b"hello")
+
+    assert cache.lookup(URL, {"Accept-Language": "fr"}).body == b"bonjour"
+    assert cache.lookup(URL, {"accept-language": "en"}).body == b"hello"
+    assert cache.lookup(URL, {}) is None
+
+
+def test_invalidate():
+    cache = HttpCache()
+    store(cache, {"Cache-Control": "max-age=60"})
+    cache.invalidate(URL)
+
+    assert cache.lookup(URL, {}) is None
+
+
+def test_least_recently_used_dropped_first():
+    cache = HttpCache(max_size=3000)
+
+    for index in range(3):
+        cache.store(
+            f"{URL}/{index}",
+            {},
+            response({"Cache-Control": "max-age=60"}, body=b"x" * 1000),
+            {"Cache-Control": "max-age=60"},
+        )
+        # The first one is used again, the second one is the least recently used
+        cache.lookup(f"{URL}/0", {})
+
+    assert cache.lookup(f"{URL}/1", {}) is None
+    assert cache.lookup(f"{URL}/0", {}) is not None
+    assert cache.lookup(f"{URL}/2", {}) is not None
+
+
+def test_disk_tier(tmp_path):
+    cache = HttpCache(max_size=1500, path=str(tmp_path))
+
+    for index in range(2):
+        cache.store(
+            f"{URL}/{index}",
+            {},
+            response({"Cache-Control": "max-age=60"}, body=bytes([index]) * 1000),
+            {"Cache-Control": "max-age=60"},
+        )
+
+    # The first one was moved to the disk, and is found by a new cache using the same directory
+    assert len(cache) == 2
+    assert HttpCache(max_size=1500, path=str(tmp_path)).lookup(f"{URL}/0", {}).body == b"\x00" * 1000
@@ -0,0 +1,116 @@
+import pytest
+
+from domain import HttpMessageParser, HttpParseError
+
+REQUEST = (
+    b"POST /items?id=1 HTTP/1.1\r\n"
+    b"Host: example.com\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 11\r\n"
+    b"\r\n"
+    b"hello\r\n\r\nyo"
+)
+
+
+def test_parse():
+    head, body = HttpMessageParser.parse(REQUEST)
+
+    assert head.start_line == "POST /items?id=1 HTTP/1.1"
+    assert head.headers == [
+        ("Host", "example.com"),
+        ("Content-Type", "text/plain"),
+        ("Content-Length", "11"),
+    ]
+    assert head.get_header("content-length") == "11"
+    assert head.get_header("Accept") is None
+    # The empty lines of the body are not mistaken for the end of the head
+    assert bytes(body) == b"hello\r\n\r\nyo"
+
+
+def test_body_is_a_view_of_the_message():
+    message = bytearray(REQUEST)
+    _, body = HttpMessageParser.parse(message)
+    message[-2:] = b"!!"
+
+    assert bytes(body).endswith(b"!!")
+
+
+def test_parse_lf_lines_and_leading_empty_lines():
+    head, body = HttpMessageParser.parse(b"\r\n\nGET / HTTP/1.1\nHost: a\n\nbody")
+
+    assert head.start_line == "GET / HTTP/1.1"
+    assert head.headers == [("Host", "a")]
+    assert bytes(body) == b"body"
+
+
+def test_parse_without_empty_line():
+    head, body = HttpMessageParser.parse(b"GET / HTTP/1.1\r\nHost: a")
+
+    assert head.headers == [("Host", "a")]
+    assert bytes(body) == b""
+
+
+def test_parse_folded_header():
+    head, _ = HttpMessageParser.parse(b"GET / HTTP/1.1\r\nX-Long: a\r\n  b\r\n\r\n")
+
+    assert head.headers == [("X-Long", "a b")]
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        b"",
+        b"\r\n\r\n",
+        b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+        b"GET / HTTP/1.1\r\nName : value\r\n\r\n",
+        b"GET / HTTP/1.1\r\n folded first\r\n\r\n",
+    ],
+)
+def test_parse_malformed(message):
+    with pytest.raises(HttpParseError):
+        HttpMessageParser.parse(message)
+
+
+def test_head_too_large():
+    with pytest.raises(HttpParseError):
+        HttpMessageParser.parse(b"GET / HTTP/1.1\r\nX: " + b"a" * 100, max_head_size=64)
+
+
+@pytest.mark.parametrize("piece_size", [1, 2, 3, 7, len(REQUEST)])
+def test_feed_in_pieces(piece_size):
+    parser = HttpMessageParser()
+    pieces = [REQUEST[index : index + piece_size] for index in range(0, len(REQUEST), piece_size)]
+    complete = [parser.feed(piece) for piece in pieces]
+
+    assert complete[-1]
+    assert parser.head == HttpMessageParser.parse(REQUEST)[0]
+    assert bytes(parser.body) == b"hello\r\n\r\nyo"
+
+
+def test_feed_head_too_large():
+    parser = HttpMessageParser(max_head_size=64)
+
+    with pytest.raises(HttpParseError):
+        for _ in range(10):
+            parser.feed(b"X-Header: value\r\n")
+
+
+def test_end_without_body():
+    parser = HttpMessageParser()
+
+    assert not parser.feed(b"HTTP/1.1 204 No Content\r\nServer: x")
+    parser.end()
+
+    assert parser.head.start_line == "HTTP/1.1 204 No Content"
+    assert parser.head.headers == [("Server", "x")]
+
+
+def test_end_empty_message():
+    with pytest.raises(HttpParseError):
+        HttpMessageParser().end()
+
+
+def test_format_headers():
+    head, _ = HttpMessageParser.parse(REQUEST)
+
+    assert head.format_headers(("content-length",)) == "Host: example.com\r\nContent-Type: text/plain"
@@ -0,0 +1,34 @@
+from domain import LatencyWindow
+
+
+def test_no_percentile_before_enough_samples():
+    window = LatencyWindow(min_samples=3)
+    window.add(1.0)
+    window.add(2.0)
+
+    assert window.percentile(95) is None
+
+
+def test_nearest_rank_percentile():
+    window = LatencyWindow(min_samples=1)
+
+    for latency in range(1, 101):
+        window.add(latency / 100)
+
+    assert window.percentile(95) == 0.95
+    assert window.percentile(50) == 0.5
+    assert window.percentile(100) == 1.0
+    assert window.percentile(0) == 0.01
+
+
+def test_oldest_samples_are_dropped():
+    window = LatencyWindow(size=10, min_samples=1)
+
+    for _ in range(10):
+        window.add(5.0)
+
+    for _ in range(10):
+        window.add(1.0)
+
+    assert len(window) == 10
+    assert window.percentile(100) == 1.0
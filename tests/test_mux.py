@@ -0,0 +1,93 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from clients.client import TorClient
+from clients.server_node import ServerNode
+from domain import (
+    MUX_END_FLAG,
+    MUX_RESET_FLAG,
+    MuxStreamAssembler,
+    StreamError,
+    encode_mux_frame,
+    read_mux_frames,
+    split_mux_message,
+)
+from domain.stream import STREAM_CHUNK_SIZE
+from tests.conftest import running_tor_network
+
+
+def test_frames_round_trip():
+    frames = (
+        encode_mux_frame(0, 0)
+        + encode_mux_frame(1, 0, b"he")
+        + encode_mux_frame(2, MUX_END_FLAG, b"other")
+        + encode_mux_frame(1, MUX_END_FLAG, b"llo")
+    )
+    offset = 0
+
+    def read(size):
+        nonlocal offset
+        offset += size
+        return frames[offset - size : offset]
+
+    assembler = MuxStreamAssembler()
+    messages = [
+        (stream_id, assembler.feed(stream_id, flags, payload))
+        for stream_id, flags, payload in read_mux_frames(read)
+    ]
+
+    # The frames of the control stream are skipped
+    assert messages == [(1, None), (2, b"other"), (1, b"hello")]
+    assert len(assembler) == 0
+
+
+def test_split_message():
+    message = b"x" * (2 * STREAM_CHUNK_SIZE + 1)
+    chunks = list(split_mux_message(message))
+
+    assert [flags for flags, _ in chunks] == [0, 0, MUX_END_FLAG]
+    assert b"".join(chunks_ for _, chunks_ in chunks) == message
+    assert list(split_mux_message(b"")) == [(MUX_END_FLAG, b"")]
+
+
+def test_reset_stream_is_forgotten():
+    assembler = MuxStreamAssembler()
+    assembler.feed(1, 0, b"part")
+    assembler.feed(1, MUX_RESET_FLAG, b"")
+
+    assert len(assembler) == 0
+
+
+def test_too_many_streams():
+    assembler = MuxStreamAssembler(max_streams=1)
+    assembler.feed(1, 0, b"part")
+
+    with pytest.raises(StreamError):
+        assembler.feed(2, 0, b"part")
+
+
+def test_mux_connections_do_not_hold_the_workers(target_server):
+    # More multiplexed circuits than workers go through each node
+    with running_tor_network(ServerNode, max_workers=4) as registry:
+        mux_client = TorClient(registry, circuit_pool_size=6, multiplex=True)
+        client = TorClient(registry, circuit_pool_size=1)
+        message = f"GET /fast HTTP/1.1\r\nHost: {target_server.host}\r\n\r\n".encode()
+        deadline = time.monotonic() + 10
+
+        try:
+            while len(mux_client.circuits) < 6:
+                assert time.monotonic() < deadline, "The circuits were not built"
+                time.sleep(0.1)
+
+            with ThreadPoolExecutor(8) as executor:
+                responses = list(executor.map(mux_client.send_http_message, [message] * 12))
+
+            assert all(response.endswith(b"ok") for response in responses)
+            assert len(mux_client._muxes) == 6
+            # The workers of the nodes still handle the other requests
+            assert client.send_http_message(message).endswith(b"ok")
+        finally:
+            client.close()
+            mux_client.close()
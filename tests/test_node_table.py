@@ -0,0 +1,97 @@
+import json
+
+from domain import NodeTable, RegistryDirectory, update_known_nodes
+from models import TorNode
+
+
+def node(port: int, public_key: str = "key") -> TorNode:
+    return TorNode("127.0.0.1", port, public_key)
+
+
+def test_versions():
+    table = NodeTable()
+
+    assert table.add(node(1))
+    assert table.add(node(2))
+    # Registering again with the same key is not a change
+    assert not table.add(node(1))
+    assert table.add(node(1, "new key"))
+    assert table.remove("127.0.0.1", 2) == node(2)
+    assert table.remove("127.0.0.1", 2) is None
+
+    assert table.version == 4
+    assert len(table) == 1
+    assert ("127.0.0.1", "1") in table
+    assert table.get("127.0.0.1", 1).public_key == "new key"
+
+
+def test_changes_since():
+    table = NodeTable()
+    table.add(node(1))
+    table.add(node(2))
+    version = table.version
+    table.add(node(3))
+    table.add(node(1, "new key"))
+    table.remove("127.0.0.1", 2)
+
+    current_version, added_nodes, removed_addresses = table.changes_since(version)
+
+    assert current_version == table.version
+    assert sorted(added_nodes, key=lambda n: n.port) == [node(1, "new key"), node(3)]
+    assert removed_addresses == [("127.0.0.1", 2)]
+    assert table.changes_since(table.version) == (table.version, [], [])
+
+
+def test_added_then_removed_node_is_removed():
+    table = NodeTable()
+    table.add(node(1))
+    table.remove("127.0.0.1", 1)
+
+    assert table.changes_since(0) == (2, [], [("127.0.0.1", 1)])
+
+
+def test_unknown_changes():
+    table = NodeTable(change_log_size=2)
+
+    for port in range(4):
+        table.add(node(port))
+
+    # The changes made since version 1 are not remembered anymore
+    assert table.changes_since(1) is None
+    assert table.changes_since(2) is not None
+    # Not a version of this table
+    assert table.changes_since(table.version + 1) is None
+
+
+def test_directory_delta_matches_the_directory():
+    table = NodeTable()
+    directory = RegistryDirectory(table)
+
+    for port in range(5):
+        table.add(node(port))
+
+    snapshot = directory.snapshot()
+    known_nodes = update_known_nodes([], json.loads(snapshot.body), delta=False)
+
+    table.remove("127.0.0.1", 0)
+    table.add(TorNode("127.0.0.1", 1, "key", capacity=8, latency=0.01))
+    table.add(node(5))
+
+    delta = directory.delta(snapshot.version)
+    known_nodes = update_known_nodes(known_nodes, json.loads(delta.body), delta=True)
+    expected_nodes = update_known_nodes([], json.loads(directory.snapshot().body), delta=False)
+
+    assert delta.since == snapshot.version
+    assert delta.version == directory.version
+    assert sorted(known_nodes, key=lambda n: int(n.port)) == sorted(
+        expected_nodes, key=lambda n: int(n.port)
+    )
+    # The same document is served to the clients asking for the same changes
+    assert directory.delta(snapshot.version) is delta
+
+
+def test_directory_delta_of_another_registry():
+    directory = RegistryDirectory(NodeTable())
+
+    assert directory.delta("other-0") is None
+    assert directory.delta(f"{directory.epoch}-x") is None
@@ -0,0 +1,59 @@
+import pytest
+
+from domain import cap_weights, node_weights, select_path
+from domain.path_selection import LATENCY_FLOOR
+from models import TorNode
+
+
+def node(port, capacity=None, latency=None) -> TorNode:
+    return TorNode("127.0.0.1", port, "key", capacity=capacity, latency=latency)
+
+
+def test_cap_weights_lowers_the_largest_weights():
+    weights = cap_weights([10, 1, 1, 1, 1, 1, 1], max_share=0.25)
+
+    assert max(weights) / sum(weights) == pytest.approx(0.25)
+    assert weights[1:] == [1] * 6
+
+
+def test_cap_weights_caps_several_weights():
+    weights = cap_weights([10, 8, 1, 1, 1, 1, 1, 1], max_share=0.2)
+    total = sum(weights)
+
+    assert weights[0] / total == pytest.approx(0.2)
+    assert weights[1] / total == pytest.approx(0.2)
+    assert weights[2:] == [1] * 6
+
+
+def test_cap_weights_leaves_small_weights():
+    assert cap_weights([1, 2, 3, 4], max_share=0.5) == [1, 2, 3, 4]
+
+
+def test_cap_weights_too_low_share():
+    assert cap_weights([1, 2, 3], max_share=0.3) == [1.0, 1.0, 1.0]
+
+
+def test_node_weights():
+    weights = node_weights([node(1, 10, 0.095), node(2, 20, 0.095), node(3)])
+
+    assert weights[0] == pytest.approx(10 / (0.095 + LATENCY_FLOOR))
+    assert weights[1] == 2 * weights[0]
+    # The median of the other nodes
+    assert weights[2] == pytest.approx(15 / (0.095 + LATENCY_FLOOR))
+
+
+def test_node_weights_are_positive():
+    weights = node_weights([node(1, 0), node(2, -5, -1), node(3, 4, 0.1)])
+
+    assert all(weight > 0 for weight in weights)
+    assert weights[0] == weights[1] == pytest.approx(4 / (0.1 + LATENCY_FLOOR))
+
+
+def test_select_path():
+    nodes = [node(port, capacity) for port, capacity in enumerate([0, 1, 2, 3])]
+    path = select_path(nodes, 3)
+
+    assert len(set(path)) == 3
+
+    with pytest.raises(ValueError):
+        select_path(nodes, 5)
@@ -0,0 +1,26 @@
+import pytest
+import requests
+
+from clients.registry_node import RegistryNode
+from tests.conftest import free_port, serve_in_background
+
+
+@pytest.fixture
+def registry_url():
+    registry = RegistryNode(("127.0.0.1", free_port()), health_check_interval=None)
+    serve_in_background(registry)
+    yield f"http://127.0.0.1:{registry.server_address[1]}"
+    registry.shutdown()
+    registry.server_close()
+
+
+@pytest.mark.parametrize("capacity", ["0", "-4", "many"])
+def test_invalid_capacity(registry_url, capacity):
+    response = requests.post(f"{registry_url}/add/{free_port()}", params={"capacity": capacity})
+
+    assert response.status_code == 400
+    assert not requests.get(f"{registry_url}/").json()
+
+
+def test_invalid_port(registry_url):
+    assert requests.post(f"{registry_url}/add/port").status_code == 400
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+import requests
+from cryptography.fernet import Fernet
+
+from domain import (
+    TOR_MESSAGE_CONTENT_TYPE,
+    decode_stream_chunks,
+    decrypt_using_symmetric_key,
+    encode_stream_chunks,
+    encode_stream_record,
+    encrypt_using_symmetric_key,
+    read_stream_records,
+)
+from tests.conftest import free_port
+
+SYM_KEY = Fernet.generate_key()
+
+
+def send_stream(node, circuit_id: str, chunks, records: bytes = None) -> requests.Response:
+    if records is None:
+        records = b"".join(
+            encode_stream_record(encrypt_using_symmetric_key(chunk, SYM_KEY))
+            for chunk in encode_stream_chunks(chunks)
+        )
+
+    return requests.post(
+        f"http://127.0.0.1:{node.server_address[1]}/circuit/{circuit_id}/stream",
+        data=records,
+        headers={"Content-Type": TOR_MESSAGE_CONTENT_TYPE},
+        timeout=10,
+    )
+
+
+def test_next_node_down(node):
+    node.circuits.add("relay", SYM_KEY, f"127.0.0.1:{free_port()}", "next")
+    response = send_stream(node, "relay", [b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n"])
+
+    assert response.status_code == 502
+    # The rest of the circuit is broken, so is this part
+    assert node.circuits.get("relay") is None
+
+
+def test_exit_stream(node, target_server):
+    node.circuits.add("exit", SYM_KEY)
+    response = send_stream(node, "exit", [f"GET /fast HTTP/1.1\r\nHost: {target_server.host}\r\n\r\n".encode()])
+    chunks = decode_stream_chunks(
+        decrypt_using_symmetric_key(record, SYM_KEY)
+        for record in read_stream_records(io.BytesIO(response.content).read)
+    )
+
+    assert response.status_code == 200
+    assert b"".join(chunks).endswith(b"\r\n\r\nok")
+
+
+@pytest.mark.parametrize(
+    "message, status_code",
+    [
+        # The target server cannot be connected to
+        (b"GET / HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n" % free_port(), 502),
+        (b"GET / HTTP/1.1\r\nmalformed header\r\n\r\n", 400),
+    ],
+    ids=["unreachable", "malformed"],
+)
+def test_exit_stream_failure(node, message, status_code):
+    node.circuits.add("exit", SYM_KEY)
+
+    assert send_stream(node, "exit", [message]).status_code == status_code
+
+
+@pytest.mark.parametrize("relay", [False, True], ids=["exit", "relay"])
+def test_record_not_encrypted_with_the_session_key(node, target_server, relay):
+    node.circuits.add("circuit", SYM_KEY, target_server.host if relay else None, "next")
+    records = encode_stream_record(b"not encrypted with the session key")
+
+    assert send_stream(node, "circuit", [], records).status_code == 400